@@ -0,0 +1,67 @@
+"""Analyze recorded session logs in parallel into one results table (CSV).
+
+Sessions already in the table are skipped, so the same command resumes an
+interrupted batch or adds new sessions to it.
+
+Run from the repository root:
+  python Benchmarks/analyzeSessions.py sessions/*.sglog [--results results.csv] [--processes 8]
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from SoundGuidanceLib import SessionAnalysis
+
+
+def translationMatrix(offset):
+  """Tip matrix with the given translation, None (the recorded calibration) without one."""
+  if offset is None:
+    return None
+  matrix = np.identity(4)
+  matrix[0:3, 3] = offset
+  return matrix
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('sessions', nargs='+', help='Session log files')
+  parser.add_argument('--results', default='sessionResults.csv')
+  parser.add_argument('--processes', type=int, help='Worker processes (default: one per core)')
+  parser.add_argument('--pointer-tip-offset', type=float, nargs=3,
+    help='Pointer tip in PointerToTracker coordinates (default: PointerTipToPointer stored in the session)')
+  parser.add_argument('--needle-tip-offset', type=float, nargs=3,
+    help='Needle tip in NeedleToTracker coordinates (default: NeedleTipToNeedle stored in the session)')
+  parser.add_argument('--needle-axis', type=float, nargs=3, default=list(SessionAnalysis.NEEDLE_AXIS),
+    help='Needle direction in NeedleToTracker coordinates')
+  parser.add_argument('--reference',
+    help='Node the fiducials move with, e.g. ReferenceToTracker (default: the one stored in the session)')
+  parser.add_argument('--fiducials', type=float, nargs=9, metavar='XYZ',
+    help='Target, surface and x axis points when the sessions have none in their metadata')
+  parser.add_argument('--target-radius', type=float, default=5.0, help='Distance (mm) counted as reaching the target')
+  parser.add_argument('--zones', type=float, nargs='+', default=list(SessionAnalysis.DEFAULT_ZONE_EDGES),
+    help='Distances (mm) between the distance zones')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+  startTime = time.time()
+  analyzed, failures = SessionAnalysis.analyzeSessions(args.sessions, args.results, args.processes,
+    pointerTipMatrix=translationMatrix(args.pointer_tip_offset),
+    needleTipMatrix=translationMatrix(args.needle_tip_offset),
+    needleAxis=args.needle_axis,
+    referenceNode=args.reference,
+    fiducials=np.reshape(args.fiducials, (3, 3)).tolist() if args.fiducials else None,
+    targetRadius=args.target_radius,
+    zoneEdges=args.zones)
+  print('%s: %d sessions analyzed in %.1f s, %d failed' % (args.results, analyzed, time.time() - startTime, len(failures)))
+  return 1 if failures else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,73 @@
+"""Micro-benchmark of OSC message encoding.
+
+Compares the pyOSC path previously used by SendOSC (one OSCMessage reused and
+appended to on every send) and a fresh pyOSC message per send with the
+preallocated encoders in SoundGuidanceLib.OSCEncoder.
+
+Run from the repository root:
+  python Benchmarks/benchmarkOSCEncoder.py [--iterations N]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from SoundGuidanceLib.OSCEncoder import OSCBundleEncoder, OSCMessageEncoder
+
+ADDRESS = "/dumpOSC/DistanceTipTarget"
+
+
+def benchmarkPyOSC(numberOfSends):
+  try:
+    import OSC
+  except ImportError:
+    print('pyOSC not available, skipping pyOSC benchmarks')
+    return
+
+  grownMessage = OSC.OSCMessage()
+  grownMessage.setAddress(ADDRESS)
+  def appendToGrownMessage():
+    grownMessage.append(0.5)
+    grownMessage.getBinary()
+  report('pyOSC reused message (old SendOSC.send)', appendToGrownMessage, numberOfSends)
+  print('  final packet size: %d bytes' % len(grownMessage.getBinary()))
+
+  def freshMessage():
+    message = OSC.OSCMessage(ADDRESS)
+    message.append(0.5)
+    message.getBinary()
+  report('pyOSC new message per send', freshMessage, numberOfSends)
+
+  def threeMessages():
+    for axis in 'xyz':
+      message = OSC.OSCMessage("/dumpOSC/needltip/" + axis)
+      message.append(1.0)
+      message.getBinary()
+  report('pyOSC needle tip, 3 messages', threeMessages, numberOfSends)
+
+
+def benchmarkEncoder(numberOfSends):
+  encoder = OSCMessageEncoder(ADDRESS, 'f')
+  values = (0.5,)
+  report('OSCMessageEncoder', lambda: encoder.encode(values), numberOfSends)
+  print('  packet size: %d bytes' % len(encoder.encode(values)))
+
+  bundleEncoder = OSCBundleEncoder([OSCMessageEncoder("/dumpOSC/needltip/" + axis, 'f') for axis in 'xyz'])
+  valuesList = ((1.0,), (2.0,), (3.0,))
+  report('OSCBundleEncoder needle tip, 1 bundle', lambda: bundleEncoder.encode(valuesList), numberOfSends)
+
+
+def report(name, function, numberOfSends):
+  seconds = timeit.timeit(function, number=numberOfSends)
+  print('%-45s %8.2f us/send' % (name, 1e6 * seconds / numberOfSends))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--iterations', type=int, default=20000, help='Sends timed per benchmark (default: 20000)')
+  args = parser.parse_args()
+  benchmarkPyOSC(args.iterations)
+  benchmarkEncoder(args.iterations)
@@ -0,0 +1,67 @@
+"""Headless end-to-end benchmark of the guidance pipeline.
+
+Pushes synthetic or recorded pointer poses through the same stages as
+SoundGuidanceLogic.calculateDistance at several rates, sends the OSC output
+to a loopback receiver and writes the statistics as JSON.
+
+Run from the repository root:
+  python Benchmarks/benchmarkPipeline.py [--session file.sglog] [--output results.json]
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from SoundGuidanceLib import Benchmark
+from SoundGuidanceLib.GuidanceCore import GuidanceCore
+from SoundGuidanceLib.OSCTransport import OSCTransport
+from SoundGuidanceLib.SessionLog import SessionReader, recordsToMatrices
+
+TARGET = [0.0, 0.0, 0.0]
+SURFACE = [0.0, 0.0, -60.0]
+X_AXIS = [30.0, 0.0, -60.0]
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--session', help='Session log to take the PointerToTracker poses from')
+  parser.add_argument('--duration', type=float, default=2.0, help='Seconds per rate')
+  parser.add_argument('--rates', type=int, nargs='+', default=list(Benchmark.DEFAULT_RATES))
+  parser.add_argument('--output', default='pipelineBenchmark.json')
+  args = parser.parse_args()
+
+  frameCount = lambda rateHz: int(args.duration * rateHz)
+  maximumFrames = max(max(frameCount(rateHz) for rateHz in args.rates), 200)
+  if args.session:
+    reader = SessionReader(args.session)
+    poses = recordsToMatrices(reader.nodeRecords('PointerToTracker'))
+    frameCount = lambda rateHz: min(int(args.duration * rateHz), len(poses))
+  else:
+    poses = Benchmark.syntheticPoses(maximumFrames, TARGET)
+
+  core = GuidanceCore()
+  core.setFiducials(TARGET, SURFACE, X_AXIS)
+  sink = Benchmark.LoopbackOSCSink()
+  sink.start()
+  transport = OSCTransport('127.0.0.1', sink.port)
+  transport.start()
+  try:
+    results = Benchmark.runBenchmarkSuite(lambda: Benchmark.headlessPipeline(core, transport, poses),
+      frameCount, args.rates, sink, transport)
+  finally:
+    transport.stop()
+    sink.stop()
+  Benchmark.writeResults(results, args.output)
+
+  for rateResult in results['rates']:
+    print('%5d Hz: pipeline p99 %.3f ms, end-to-end p50 %s ms, %.0f packets/s, %d frames lost' % (
+      rateResult['rateHz'], rateResult['pipelineLatencyMs']['p99'],
+      '%.3f' % rateResult['endToEndLatencyMs']['p50'] if rateResult['endToEndLatencyMs'] else '-',
+      rateResult['packetsPerSecond'], rateResult['framesLost']))
+  print('Results written to %s' % args.output)
+
+
+if __name__ == '__main__':
+  main()
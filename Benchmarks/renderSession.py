@@ -0,0 +1,68 @@
+"""Render the sonification of a recorded session (or a synthetic approach) to a WAV file.
+
+Uses the same distance normalization as the live module and reports how many
+times faster than real time the rendering ran.
+
+Run from the repository root:
+  python Benchmarks/renderSession.py [--session file.sglog] [--samples Sound1.wav ...] [--output session.wav]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from SoundGuidanceLib import Benchmark
+from SoundGuidanceLib.GuidanceCore import distanceToTarget, tipPositions
+from SoundGuidanceLib.OfflineRenderer import (OfflineRenderer, OscillatorVoice, SampleVoice,
+  arrayDistanceChunks, sessionDistanceChunks)
+from SoundGuidanceLib.SessionLog import SessionReader
+
+TARGET = [0.0, 0.0, 0.0]
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--session', help='Session log to take the PointerToTracker poses from')
+  parser.add_argument('--tip-offset', type=float, nargs=3,
+    help='Tip position in PointerToTracker coordinates (default: PointerTipToPointer stored in the session)')
+  parser.add_argument('--reference',
+    help='Node the fiducials move with, e.g. ReferenceToTracker (default: the one stored in the session)')
+  parser.add_argument('--duration', type=float, default=600.0, help='Seconds of the synthetic session')
+  parser.add_argument('--rate', type=float, default=60.0, help='Pose rate (Hz) of the synthetic session')
+  parser.add_argument('--samples', nargs='*', default=[], help='WAV files played per distance zone')
+  parser.add_argument('--zones', type=float, nargs='*', default=[],
+    help='Normalized distances between the zones of the samples')
+  parser.add_argument('--waveform', default='sine', choices=OscillatorVoice.WAVEFORMS)
+  parser.add_argument('--beep', type=float, nargs=2, metavar=('NEAR_HZ', 'FAR_HZ'), help='Beep rate range')
+  parser.add_argument('--sample-rate', type=int, default=44100)
+  parser.add_argument('--output', default='session.wav')
+  args = parser.parse_args()
+
+  if args.session:
+    chunks = sessionDistanceChunks(SessionReader(args.session), tipOffset=args.tip_offset,
+      referenceNodeName=args.reference)
+  else:
+    frameCount = int(args.duration * args.rate)
+    timestamps = np.arange(frameCount) / args.rate
+    chunks = arrayDistanceChunks(timestamps, distanceToTarget(tipPositions(Benchmark.syntheticPoses(frameCount, TARGET)), TARGET))
+
+  voices = [OscillatorVoice(waveform=args.waveform, beepRates=args.beep)]
+  if args.samples:
+    voices.append(SampleVoice.fromWaveFiles(args.samples, args.zones, args.sample_rate))
+  renderer = OfflineRenderer(voices, sampleRate=args.sample_rate, gain=1.0 / len(voices))
+
+  startTime = time.time()
+  sampleCount = renderer.render(chunks, args.output)
+  elapsed = time.time() - startTime
+  audioSeconds = sampleCount / float(args.sample_rate)
+  print('%s: %.1f s of audio rendered in %.2f s (%.0fx real time)' % (
+    args.output, audioSeconds, elapsed, audioSeconds / elapsed if elapsed > 0 else float('inf')))
+
+
+if __name__ == '__main__':
+  main()
@@ -1,14 +1,29 @@
 import os
+import socket
+import sys
+import threading
 import unittest
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
 import math
 import time
-import SimpleITK
 import numpy as np
-import OSC
-import numpy.linalg
+from vtk.util import numpy_support
+from SoundGuidanceLib import AssetCache
+from SoundGuidanceLib.GuidanceCore import GuidanceCore, planeQuadCorners, transformPoints
+from SoundGuidanceLib.Instrumentation import StageProfiler
+from SoundGuidanceLib.MultiTool import ToolFrameEncoder, loadToolConfiguration
+from SoundGuidanceLib.NodeArrays import (NodeArrayCache, arrayFromMatrix, markupsWorldPoints,
+  setTransformToParentArray, transformToParentArray)
+from SoundGuidanceLib.OSCEncoder import FixedShapeEncoder, OSCBundleEncoder, OSCMessageEncoder
+from SoundGuidanceLib.OSCTransport import OSCTransport
+from SoundGuidanceLib.Overlays import LineOverlay, OverlayRegistry, PlaneOverlay, TrailOverlay
+from SoundGuidanceLib.PoseFilter import PoseFilter, distanceRate
+from SoundGuidanceLib.SoundMapping import MappingFile
+from SoundGuidanceLib.TargetIndex import TargetIndex
+from SoundGuidanceLib.TransformCache import NodeToWorldCache, TransformChainCache
+from SoundGuidanceLib.UpdateScheduler import UpdateScheduler, monotonicClock
 #from sympy import Plane, Point, Point3D
 #
 # SoundGuidance
@@ -44,6 +59,7 @@ class SoundGuidanceWidget(ScriptedLoadableModuleWidget):
   """
 
   def setup(self):
+    setupStartTime = time.time()
     ScriptedLoadableModuleWidget.setup(self)
     
     self.logic = SoundGuidanceLogic()
@@ -54,36 +70,16 @@ class SoundGuidanceWidget(ScriptedLoadableModuleWidget):
 
      # Load models first
     self.SoundGuidanceModuleModelsPath = slicer.modules.soundguidance.path.replace("SoundGuidance.py","") + 'Resources/Models/'
+    # Models and transforms are read from compact binary copies after the first session
+    self.assetCacheDirectory = os.path.join(slicer.app.cachePath, 'SoundGuidance', 'Assets')
+
+    # box.stl is not distributed with the module, it is shown only when present
+    self.boxModel = self.getOrLoadModel('boxModel', 'box.stl', [0.098,0.5,0.42], 0.3)
+    self.aroModel = self.getOrLoadModel('aroModel', 'aro.stl', [0.063,0.14,0.5])
 
-    self.boxModel = slicer.util.getNode('boxModel')
-    if not self.boxModel:
-        slicer.util.loadModel(self.SoundGuidanceModuleModelsPath + 'box.stl')
-        self.boxModel = slicer.util.getNode(pattern="box")
-        self.boxModelDisplay=self.boxModel.GetModelDisplayNode()
-        self.boxModelDisplay.SetColor([0.098,0.5,0.42])
-        self.boxModelDisplay.SetOpacity(0.3)
-
-    self.aroModel = slicer.util.getNode('aroModel')
-    if not self.aroModel:
-        slicer.util.loadModel(self.SoundGuidanceModuleModelsPath + 'aro.stl')
-        self.aroModel = slicer.util.getNode(pattern="aro")
-        self.aroModelDisplay=self.aroModel.GetModelDisplayNode()
-        self.aroModelDisplay.SetColor([0.063,0.14,0.5])
-    
     #We create models
-    self.needleModel = slicer.util.getNode('NeedleModel')
-    if not self.needleModel:
-        slicer.util.loadModel(self.SoundGuidanceModuleModelsPath + 'NeedleModel.stl')
-        self.needleModel = slicer.util.getNode(pattern="NeedleModel")
-        self.needleModelDisplay=self.needleModel.GetModelDisplayNode()
-        self.needleModelDisplay.SetColor([0,1,1])
-
-    self.pointerModel = slicer.util.getNode('PointerModel')
-    if not self.pointerModel:
-        slicer.util.loadModel(self.SoundGuidanceModuleModelsPath + 'PointerModel.stl')
-        self.pointerModel = slicer.util.getNode(pattern="PointerModel")
-        self.pointerModelDisplay=self.pointerModel.GetModelDisplayNode()
-        self.pointerModelDisplay.SetColor([0,0,0])
+    self.needleModel = self.getOrLoadModel('NeedleModel', 'NeedleModel.stl', [0,1,1])
+    self.pointerModel = self.getOrLoadModel('PointerModel', 'PointerModel.stl', [0,0,0])
 
     self.targetFiducial = slicer.util.getNode('targetFiducial')
     if not self.targetFiducial:
@@ -126,6 +122,23 @@ class SoundGuidanceWidget(ScriptedLoadableModuleWidget):
     self.QFormLayoutLabel.setStyleSheet(self.defaultStyleSheet)
     parametersFormLayout.addRow(self.QFormLayoutLabel, self.calculateDistanceLabel) 
 
+    # Round trip latency of the audio path, next to the distance it delays
+    self.audioLinkLabel = qt.QLabel('-')
+    self.audioLinkLabel.toolTip = "Round trip time of OSC probe frames acknowledged by the sound engine (last 256 frames)."
+    parametersFormLayout.addRow("Audio link latency: ", self.audioLinkLabel)
+
+    self.measureLatencyCheckBox = qt.QCheckBox()
+    self.measureLatencyCheckBox.toolTip = "Send sequence numbered probe frames to the OSC host and wait for /dumpOSC/ack replies on port 7401."
+    parametersFormLayout.addRow("Measure audio latency: ", self.measureLatencyCheckBox)
+
+    self.localEchoCheckBox = qt.QCheckBox()
+    self.localEchoCheckBox.toolTip = "Answer the probe frames with a local echo server instead of the Pd patch."
+    parametersFormLayout.addRow("Local echo: ", self.localEchoCheckBox)
+
+    self.audioLinkTimer = qt.QTimer()
+    self.audioLinkTimer.setInterval(500)
+    self.audioLinkTimer.connect('timeout()', self.updateAudioLinkLabel)
+
     #
     # Sound Button
     #
@@ -134,6 +147,128 @@ class SoundGuidanceWidget(ScriptedLoadableModuleWidget):
     self.playSoundButton.checkable = True
     parametersFormLayout.addRow(self.playSoundButton)
 
+    # OSC destination
+    self.oscHostLineEdit = qt.QLineEdit(self.logic.oscTransport.host)
+    self.oscHostLineEdit.toolTip = "Host running the sound synthesis (Pd) patch."
+    parametersFormLayout.addRow("OSC host: ", self.oscHostLineEdit)
+
+    self.oscPortSpinBox = qt.QSpinBox()
+    self.oscPortSpinBox.setRange(1, 65535)
+    self.oscPortSpinBox.value = self.logic.oscTransport.port
+    parametersFormLayout.addRow("OSC port: ", self.oscPortSpinBox)
+
+    self.toolConfigurationPathLineEdit = ctk.ctkPathLineEdit()
+    self.toolConfigurationPathLineEdit.filters = ctk.ctkPathLineEdit.Files
+    self.toolConfigurationPathLineEdit.nameFilters = ["Tool configuration (*.json)"]
+    self.toolConfigurationPathLineEdit.toolTip = "Optional JSON file with several tools and OSC receivers, loaded by Calculate Distance."
+    parametersFormLayout.addRow("Tools configuration: ", self.toolConfigurationPathLineEdit)
+
+    self.mappingPathLineEdit = ctk.ctkPathLineEdit()
+    self.mappingPathLineEdit.filters = ctk.ctkPathLineEdit.Files
+    self.mappingPathLineEdit.nameFilters = ["Sound mapping (*.json)"]
+    self.mappingPathLineEdit.toolTip = "Distance to sound parameter mappings (see Resources/Mappings), reloaded when the file is saved."
+    parametersFormLayout.addRow("Sound mapping: ", self.mappingPathLineEdit)
+
+    self.planeSizeSpinBox = qt.QDoubleSpinBox()
+    self.planeSizeSpinBox.setRange(10.0, 500.0)
+    self.planeSizeSpinBox.suffix = " mm"
+    self.planeSizeSpinBox.value = self.logic.planeSize
+    parametersFormLayout.addRow("Entry plane size: ", self.planeSizeSpinBox)
+
+    self.poseBusCheckBox = qt.QCheckBox()
+    self.poseBusCheckBox.toolTip = "Publish every frame in the SoundGuidancePoseBus shared memory block for local processes (SoundGuidanceLib.PoseBus.PoseBusReader)."
+    parametersFormLayout.addRow("Shared memory bus: ", self.poseBusCheckBox)
+
+    self.tipTrailSpinBox = qt.QSpinBox()
+    self.tipTrailSpinBox.setRange(0, 1000)
+    self.tipTrailSpinBox.toolTip = "Number of recent tip positions drawn as a trail (0 to hide it)."
+    parametersFormLayout.addRow("Tip trail length: ", self.tipTrailSpinBox)
+
+    self.poseFilterCheckBox = qt.QCheckBox()
+    self.poseFilterCheckBox.toolTip = "Send the smoothed, predicted distance and its rate as extra OSC arguments."
+    parametersFormLayout.addRow("Smooth and predict: ", self.poseFilterCheckBox)
+
+    self.predictionSpinBox = qt.QSpinBox()
+    self.predictionSpinBox.setRange(0, 200)
+    self.predictionSpinBox.suffix = " ms"
+    self.predictionSpinBox.value = 30
+    self.predictionSpinBox.toolTip = "How far ahead the tip position is predicted to compensate the audio latency."
+    parametersFormLayout.addRow("Prediction: ", self.predictionSpinBox)
+
+    self.guidanceFieldCheckBox = qt.QCheckBox()
+    self.guidanceFieldCheckBox.toolTip = "Precompute distance, depth, lateral offset and surface distance on a grid over the box and send them as /dumpOSC/field. Rebuilt in the background when the fiducials move."
+    parametersFormLayout.addRow("Guidance field: ", self.guidanceFieldCheckBox)
+
+    self.targetSelectionComboBox = qt.QComboBox()
+    self.targetSelectionComboBox.addItem("Nearest target", "nearest")
+    self.targetSelectionComboBox.addItem("Planned order", "planned")
+    self.targetSelectionComboBox.toolTip = "Target sent as /dumpOSC/target when the target list has several points."
+    parametersFormLayout.addRow("Target selection: ", self.targetSelectionComboBox)
+
+    #
+    # Performance Area
+    #
+    performanceCollapsibleButton = ctk.ctkCollapsibleButton()
+    performanceCollapsibleButton.text = "Performance"
+    performanceCollapsibleButton.collapsed = True
+    self.layout.addWidget(performanceCollapsibleButton)
+    performanceFormLayout = qt.QFormLayout(performanceCollapsibleButton)
+
+    self.instrumentationCheckBox = qt.QCheckBox()
+    self.instrumentationCheckBox.toolTip = "Time every stage of the tracker update path. No overhead when unchecked."
+    performanceFormLayout.addRow("Instrument frame stages: ", self.instrumentationCheckBox)
+
+    self.eventRateLabel = qt.QLabel('-')
+    performanceFormLayout.addRow("Event rate: ", self.eventRateLabel)
+
+    self.stageTable = qt.QTableWidget(len(self.logic.stageProfiler.stages), 4)
+    self.stageTable.setHorizontalHeaderLabels(["Count", "p50 (ms)", "p99 (ms)", "Max (ms)"])
+    self.stageTable.setVerticalHeaderLabels([name for name, methodName in self.logic.stageProfiler.stages])
+    self.stageTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+    performanceFormLayout.addRow(self.stageTable)
+
+    self.stageReportPathLineEdit = ctk.ctkPathLineEdit()
+    self.stageReportPathLineEdit.filters = ctk.ctkPathLineEdit.Files | ctk.ctkPathLineEdit.Writable
+    self.stageReportPathLineEdit.nameFilters = ["Stage timings (*.csv *.json)"]
+    self.stageReportPathLineEdit.currentPath = os.path.join(slicer.app.temporaryPath, 'SoundGuidanceStages.csv')
+    performanceFormLayout.addRow("Report file: ", self.stageReportPathLineEdit)
+
+    self.exportStagesButton = qt.QPushButton("Export")
+    self.exportStagesButton.toolTip = "Write the stage timings as CSV, or as JSON with the histogram buckets."
+    performanceFormLayout.addRow(self.exportStagesButton)
+
+    self.stageTableTimer = qt.QTimer()
+    self.stageTableTimer.setInterval(1000)
+    self.stageTableTimer.connect('timeout()', self.updateStageTable)
+
+    #
+    # Session recording Area
+    #
+    recordingCollapsibleButton = ctk.ctkCollapsibleButton()
+    recordingCollapsibleButton.text = "Session recording"
+    recordingCollapsibleButton.collapsed = True
+    self.layout.addWidget(recordingCollapsibleButton)
+    recordingFormLayout = qt.QFormLayout(recordingCollapsibleButton)
+
+    self.sessionPathLineEdit = ctk.ctkPathLineEdit()
+    self.sessionPathLineEdit.filters = ctk.ctkPathLineEdit.Files
+    self.sessionPathLineEdit.nameFilters = ["Session logs (*.sglog)"]
+    self.sessionPathLineEdit.currentPath = os.path.join(slicer.app.temporaryPath, 'SoundGuidanceSession.sglog')
+    recordingFormLayout.addRow("Session file: ", self.sessionPathLineEdit)
+
+    self.recordSessionButton = qt.QPushButton("Record")
+    self.recordSessionButton.toolTip = "Record the tracker transforms to the session file."
+    self.recordSessionButton.checkable = True
+    recordingFormLayout.addRow(self.recordSessionButton)
+
+    self.replayAsFastAsPossibleCheckBox = qt.QCheckBox()
+    self.replayAsFastAsPossibleCheckBox.toolTip = "Replay without the original timing."
+    recordingFormLayout.addRow("Replay as fast as possible: ", self.replayAsFastAsPossibleCheckBox)
+
+    self.replaySessionButton = qt.QPushButton("Replay")
+    self.replaySessionButton.toolTip = "Feed the recorded transforms to the tracker transform nodes."
+    recordingFormLayout.addRow(self.replaySessionButton)
+
 
 
     #Load transformations
@@ -157,20 +292,9 @@ class SoundGuidanceWidget(ScriptedLoadableModuleWidget):
     # Load models first
     self.SoundGuidanceModuleDataPath = slicer.modules.soundguidance.path.replace("SoundGuidance.py","") + 'Resources/Data/'
 
-    self.needleTipToNeedle = slicer.util.getNode('NeedleTipToNeedle')
-    if not self.needleTipToNeedle:
-      slicer.util.loadTransform(self.SoundGuidanceModuleDataPath + 'NeedleTipToNeedle.h5')
-      self.needleTipToNeedle = slicer.util.getNode(pattern="NeedleTipToNeedle")
-
-    self.pointerTipToPointer = slicer.util.getNode('PointerTipToPointer')
-    if not self.pointerTipToPointer:
-        slicer.util.loadTransform(self.SoundGuidanceModuleDataPath + 'PointerTipToPointer.h5')
-        self.pointerTipToPointer = slicer.util.getNode(pattern="PointerTipToPointer")
-      
-    self.boxToReference = slicer.util.getNode('BoxToReference')
-    if not self.boxToReference:
-      slicer.util.loadTransform(self.SoundGuidanceModuleDataPath + 'BoxToReference.h5')
-      self.boxToReference = slicer.util.getNode(pattern="BoxToReference")
+    self.needleTipToNeedle = self.getOrLoadTransform('NeedleTipToNeedle')
+    self.pointerTipToPointer = self.getOrLoadTransform('PointerTipToPointer')
+    self.boxToReference = self.getOrLoadTransform('BoxToReference')
     
         
     
@@ -179,45 +303,40 @@ class SoundGuidanceWidget(ScriptedLoadableModuleWidget):
     if not self.needleModelToNeedleTip:
       self.needleModelToNeedleTip=slicer.vtkMRMLLinearTransformNode()
       self.needleModelToNeedleTip.SetName("needleModelToNeedleTip")
-      matrixNeedleModel = vtk.vtkMatrix4x4()
-      matrixNeedleModel.SetElement( 0, 0, -1 ) # Row 1
-      matrixNeedleModel.SetElement( 0, 1, 0 )
-      matrixNeedleModel.SetElement( 0, 2, 0 )
-      matrixNeedleModel.SetElement( 0, 3, 0 )      
-      matrixNeedleModel.SetElement( 1, 0, 0 )  # Row 2
-      matrixNeedleModel.SetElement( 1, 1, 1 )
-      matrixNeedleModel.SetElement( 1, 2, 0 )
-      matrixNeedleModel.SetElement( 1, 3, 0 )       
-      matrixNeedleModel.SetElement( 2, 0, 0 )  # Row 3
-      matrixNeedleModel.SetElement( 2, 1, 0 )
-      matrixNeedleModel.SetElement( 2, 2, -1 )
-      matrixNeedleModel.SetElement( 2, 3, 0 )
-      self.needleModelToNeedleTip.SetMatrixTransformToParent(matrixNeedleModel)
+      setTransformToParentArray(self.needleModelToNeedleTip, [
+        [-1, 0, 0, 0],
+        [0, 1, 0, 0],
+        [0, 0, -1, 0],
+        [0, 0, 0, 1]])
       slicer.mrmlScene.AddNode(self.needleModelToNeedleTip)
 
     self.pointerModelToPointerTip = slicer.util.getNode('pointerModelToPointerTip')
     if not self.pointerModelToPointerTip:
       self.pointerModelToPointerTip=slicer.vtkMRMLLinearTransformNode()
       self.pointerModelToPointerTip.SetName("pointerModelToPointerTip")
-      matrixPointerModel = vtk.vtkMatrix4x4()
-      matrixPointerModel.SetElement( 0, 0, 0 ) # Row 1
-      matrixPointerModel.SetElement( 0, 1, 0 )
-      matrixPointerModel.SetElement( 0, 2, 1 )
-      matrixPointerModel.SetElement( 0, 3, 0 )      
-      matrixPointerModel.SetElement( 1, 0, 0 )  # Row 2
-      matrixPointerModel.SetElement( 1, 1, 1 )
-      matrixPointerModel.SetElement( 1, 2, 0 )
-      matrixPointerModel.SetElement( 1, 3, 0 )       
-      matrixPointerModel.SetElement( 2, 0, -1 )  # Row 3
-      matrixPointerModel.SetElement( 2, 1, 0 )
-      matrixPointerModel.SetElement( 2, 2, 0 )
-      matrixPointerModel.SetElement( 2, 3, 0 )
-      self.pointerModelToPointerTip.SetMatrixTransformToParent(matrixPointerModel)
+      setTransformToParentArray(self.pointerModelToPointerTip, [
+        [0, 0, 1, 0],
+        [0, 1, 0, 0],
+        [-1, 0, 0, 0],
+        [0, 0, 0, 1]])
       slicer.mrmlScene.AddNode(self.pointerModelToPointerTip)
 
     # connections
     self.applyButton.connect('clicked(bool)', self.onCalculateDistanceButton)
     self.playSoundButton.connect('clicked(bool)', self.onplaySoundButtonClicked)
+    self.recordSessionButton.connect('toggled(bool)', self.onRecordSessionButtonToggled)
+    self.planeSizeSpinBox.connect('valueChanged(double)', self.logic.setPlaneSize)
+    self.tipTrailSpinBox.connect('valueChanged(int)', self.logic.setTipTrailLength)
+    self.poseFilterCheckBox.connect('toggled(bool)', self.onPoseFilterChanged)
+    self.targetSelectionComboBox.connect('currentIndexChanged(int)', self.onTargetSelectionChanged)
+    self.predictionSpinBox.connect('valueChanged(int)', self.onPoseFilterChanged)
+    self.replaySessionButton.connect('clicked(bool)', self.onReplaySessionButtonClicked)
+    self.measureLatencyCheckBox.connect('toggled(bool)', self.onMeasureLatencyToggled)
+    self.instrumentationCheckBox.connect('toggled(bool)', self.onInstrumentationToggled)
+    self.mappingPathLineEdit.connect('currentPathChanged(QString)', self.logic.setMappingFile)
+    self.poseBusCheckBox.connect('toggled(bool)', self.onPoseBusToggled)
+    self.guidanceFieldCheckBox.connect('toggled(bool)', self.onGuidanceFieldToggled)
+    self.exportStagesButton.connect('clicked(bool)', self.onExportStagesButtonClicked)
 
     
     
@@ -236,7 +355,8 @@ class SoundGuidanceWidget(ScriptedLoadableModuleWidget):
     self.needleTipToNeedle.SetAndObserveTransformNodeID(self.needleToTracker.GetID())
 
     #Box and aro
-    self.boxModel.SetAndObserveTransformNodeID(self.boxToReference.GetID())
+    if self.boxModel:
+      self.boxModel.SetAndObserveTransformNodeID(self.boxToReference.GetID())
     self.aroModel.SetAndObserveTransformNodeID(self.boxToReference.GetID())
     self.targetFiducial.SetAndObserveTransformNodeID(self.boxToReference.GetID())
     self.surfaceFiducial.SetAndObserveTransformNodeID(self.boxToReference.GetID())
@@ -247,10 +367,33 @@ class SoundGuidanceWidget(ScriptedLoadableModuleWidget):
     # Add vertical spacer
     self.layout.addStretch(1)
 
+    self.setupTime = time.time() - setupStartTime
+    logging.info('SoundGuidance module setup took %.3f s' % self.setupTime)
+
    
 
+  def getOrLoadModel(self, nodeName, fileName, color, opacity=1.0):
+    """Model node from the scene, or loaded from Resources/Models (None when the file is missing)."""
+    modelNode = slicer.util.getNode(nodeName)
+    if modelNode:
+      return modelNode
+    modelNode = AssetCache.loadModel(self.SoundGuidanceModuleModelsPath + fileName, nodeName, self.assetCacheDirectory)
+    if modelNode:
+      modelNode.GetModelDisplayNode().SetColor(color)
+      modelNode.GetModelDisplayNode().SetOpacity(opacity)
+    return modelNode
+
+  def getOrLoadTransform(self, nodeName):
+    """Transform node from the scene, or loaded from Resources/Data/<nodeName>.h5."""
+    transformNode = slicer.util.getNode(nodeName)
+    if transformNode:
+      return transformNode
+    return AssetCache.loadLinearTransform(self.SoundGuidanceModuleDataPath + nodeName + '.h5', nodeName, self.assetCacheDirectory)
+
   def cleanup(self):
-    pass
+    self.audioLinkTimer.stop()
+    self.stageTableTimer.stop()
+    self.logic.cleanup()
 
   
   def onCalculateDistanceButton(self):
@@ -258,6 +401,10 @@ class SoundGuidanceWidget(ScriptedLoadableModuleWidget):
     self.logic.transferValues(self.needleTipToNeedle, self.pointerTipToPointer, self.needleToTracker, self.targetFiducial, self.surfaceFiducial, self.boxToReference, self.xAxisFiducial)
 
     self.logic.setOutPutDistanceLabel(self.calculateDistanceLabel)
+    self.logic.setSurfaceModel(self.aroModel)
+    toolConfigurationPath = self.toolConfigurationPathLineEdit.currentPath
+    if toolConfigurationPath and os.path.isfile(toolConfigurationPath):
+      self.logic.setToolConfiguration(loadToolConfiguration(toolConfigurationPath))
     
     
     self.logic.plotLineZaxis()
@@ -265,12 +412,78 @@ class SoundGuidanceWidget(ScriptedLoadableModuleWidget):
 
   def onplaySoundButtonClicked(self):
     #IP = "172.16.203.210"
+    self.logic.setOSCDestination(self.oscHostLineEdit.text, self.oscPortSpinBox.value)
     self.logic.changeSendDataStatus()
     #initialization
     #c = SendOSC()
     #c.connect("localhost", 8080)
     #self.logic.activateOSC()
-    
+
+  def onPoseFilterChanged(self, value=None):
+    self.logic.setPoseFilter(self.poseFilterCheckBox.checked, self.predictionSpinBox.value)
+
+  def onTargetSelectionChanged(self, index):
+    self.logic.setTargetSelectionMode(self.targetSelectionComboBox.itemData(index))
+
+  def onRecordSessionButtonToggled(self, checked):
+    if checked:
+      self.logic.startRecording(self.sessionPathLineEdit.currentPath, [self.needleToTracker, self.pointerToTracker, self.referenceToTracker])
+    else:
+      self.logic.stopRecording()
+
+  def onReplaySessionButtonClicked(self):
+    self.logic.startReplay(self.sessionPathLineEdit.currentPath, self.replayAsFastAsPossibleCheckBox.checked)
+
+  def onPoseBusToggled(self, checked):
+    if checked:
+      self.logic.startPoseBus()
+    else:
+      self.logic.stopPoseBus()
+
+  def onGuidanceFieldToggled(self, checked):
+    # The field covers the box, or the aro model when box.stl is not available
+    self.logic.setGuidanceField(checked, self.boxModel if self.boxModel else self.aroModel)
+
+  def onMeasureLatencyToggled(self, checked):
+    if checked:
+      self.logic.setOSCDestination(self.oscHostLineEdit.text, self.oscPortSpinBox.value)
+      self.logic.startLatencyProbe(self.localEchoCheckBox.checked)
+      self.audioLinkTimer.start()
+    else:
+      self.audioLinkTimer.stop()
+      self.logic.stopLatencyProbe()
+      self.audioLinkLabel.setText('-')
+
+  def onInstrumentationToggled(self, checked):
+    self.logic.setInstrumentation(checked)
+    if checked:
+      self.stageTableTimer.start()
+    else:
+      self.stageTableTimer.stop()
+      self.updateStageTable()
+
+  def updateStageTable(self):
+    self.eventRateLabel.setText('%.1f Hz' % self.logic.stageProfiler.eventRate())
+    for row, (name, summary) in enumerate(self.logic.stageProfiler.summary()):
+      values = [str(summary['count'])] + ['%.3f' % summary[key] if key in summary else '-' for key in ('p50', 'p99', 'max')]
+      for column, value in enumerate(values):
+        self.stageTable.setItem(row, column, qt.QTableWidgetItem(value))
+
+  def onExportStagesButtonClicked(self):
+    self.logic.stageProfiler.writeReport(self.stageReportPathLineEdit.currentPath)
+    logging.info('Stage timings written to %s' % self.stageReportPathLineEdit.currentPath)
+
+  def updateAudioLinkLabel(self):
+    summary = self.logic.getLatencySummary()
+    if summary and not summary['ackSupported']:
+      self.audioLinkLabel.setText('no ack support (the Pd patch must echo /dumpOSC/ack to port 7401)')
+      return
+    if not summary or 'p50' not in summary:
+      self.audioLinkLabel.setText('waiting for acknowledgements')
+      return
+    self.audioLinkLabel.setText('p50 %.1f ms, p99 %.1f ms, max %.1f ms, loss %.1f%%' % (
+      summary['p50'], summary['p99'], summary['max'], 100.0 * summary['loss']))
+
 
 #
 # SoundGuidanceLogic
@@ -288,18 +501,100 @@ class SoundGuidanceLogic(ScriptedLoadableModuleLogic):
   def __init__(self):
     self.sendDataOK = False
     self.OSC_active = False
-    self.line = slicer.util.getNode('Line')
-    if not self.line:
-      self.line = slicer.vtkMRMLModelNode()
-      self.line.SetName('Line')
-      linePolyData = vtk.vtkPolyData()
-      self.line.SetAndObservePolyData(linePolyData)      
-      modelDisplay = slicer.vtkMRMLModelDisplayNode()
-      modelDisplay.SetSliceIntersectionVisibility(True)
-      modelDisplay.SetColor(0,1,0)
-      slicer.mrmlScene.AddNode(modelDisplay)      
-      self.line.SetAndObserveDisplayNodeID(modelDisplay.GetID())      
-      slicer.mrmlScene.AddNode(self.line)
+    # Keeps the latest message of every address (distance, target, surface, trajectory, plane, field, ...)
+    self.oscTransport = OSCTransport()
+    self.planeCoordinatesEncoder = OSCBundleEncoder([
+      OSCMessageEncoder("/dumpOSC/plane/x", "f"),
+      OSCMessageEncoder("/dumpOSC/plane/y", "f"),
+      OSCMessageEncoder("/dumpOSC/plane/z", "f")])
+    self.matrixTransfBOX = None
+    self.planeAxisValid = False
+    self.tipHomogeneousPoint = np.ones(4)
+    # Extra tools and receivers from a tool configuration file
+    self.toolCaches = []
+    self.toolPositions = np.zeros((0, 3))
+    self.toolFrameEncoder = None
+    self.triggerNode = None
+    self.oscDestination = (self.oscTransport.host, self.oscTransport.port)
+    # Optional distance to sound parameter mappings, checked for edits every second
+    self.mappingFile = None
+    self.mappingReloadTimer = qt.QTimer()
+    self.mappingReloadTimer.setInterval(1000)
+    self.mappingReloadTimer.connect('timeout()', self.reloadMappingFile)
+    # Latency probes, only while measuring
+    self.oscLink = None
+    self.echoServer = None
+    self.extraReceivers = []
+    self.guidanceCore = GuidanceCore()
+    # World coordinates of the fiducials, exported again only after they moved
+    self.targetPointsCache = None
+    self.surfacePointsCache = None
+    self.xAxisPointsCache = None
+    self.pointerTipCache = None
+    self.needleTipCache = None
+    self.needleTipMatrix = vtk.vtkMatrix4x4()
+    self.needleTipPose = np.identity(4)
+    self.needleAxis = np.array([0.0, 0.0, 1.0])
+    self.poseFilter = PoseFilter()
+    self.targetIndex = TargetIndex()
+    self.targetIndexValid = False
+    self.targetSelectionMode = 'nearest'
+    self.plannedTarget = 0
+    self.targetReachedDistance = 2.0
+    self.poseFilterEnabled = False
+    self.planeSize = 100.0
+    # Overlays and observers are created once and reused by every "Calculate Distance"
+    self.overlays = OverlayRegistry()
+    self.entryPlane = PlaneOverlay(self.overlays, "X-Y Plane", (0.145,0.77,0.596))
+    self.sessionRecorder = None
+    self.recordingObservations = []
+    self.sessionReplayer = None
+    self.replayTimer = qt.QTimer()
+    self.replayTimer.setInterval(1)
+    self.replayTimer.connect('timeout()', self.onReplayTimeout)
+
+    # Audio gets every new pose, display outputs are limited to the screen refresh
+    self.updateScheduler = UpdateScheduler(deferCall=self.deferCall)
+    self.updateScheduler.addConsumer('osc', self.sendTipToTargetDistance, rateHz=0)
+    # A mesh query takes about a millisecond, too long for every tracker frame
+    self.updateScheduler.addConsumer('surface', self.sendSurfaceDistance, rateHz=30)
+    self.updateScheduler.addConsumer('label', self.updateDistanceLabel, rateHz=30)
+    self.updateScheduler.addConsumer('line', self.updateTipToTargetLine, rateHz=60)
+    self.updateScheduler.addConsumer('logger', self.logTipPosition, rateHz=1)
+    self.updateScheduler.addConsumer('bus', self.publishPoseBusFrame, rateHz=0)
+    self.poseBus = None
+    self.setPoseEpsilon(0.01)
+    # Per-stage timings of the tracker update path, only while instrumented
+    self.stageProfiler = StageProfiler([
+      ('callback', 'calculateCallback'),
+      ('transform', 'getPointerTipPosition'),
+      ('distance', 'getDistanceToTarget'),
+      ('label', 'updateDistanceLabel'),
+      ('line', 'drawLineBetweenPoints'),
+      ('send', 'sendData')])
+    self.tipLine = LineOverlay(self.overlays, 'Line', (0,1,0))
+    self.tipTrail = None
+    # Tip to phantom surface distance, searched up to surfaceMaxDistance (mm)
+    self.surfaceModel = None
+    self.surfaceLocator = None
+    self.surfaceModelMTime = None
+    # Background build of the locator: (thread, result list) until it is taken by pollSurfaceLocator
+    self.surfaceLocatorBuild = None
+    self.surfaceMaxDistance = 50.0
+    self.surfaceDistance = float('nan')
+    self.worldToSurfaceMatrix = vtk.vtkMatrix4x4()
+    # Guidance values precomputed in box coordinates, rebuilt in the background after the fiducials move
+    self.guidanceFieldBuilder = None
+    self.guidanceField = None
+    self.guidanceFieldBoundsModel = None
+    self.guidanceFieldFiducials = None
+    self.guidanceFieldSpacing = 2.0
+    self.guidanceFieldTolerance = 0.01
+    self.boxToWorldCache = NodeToWorldCache(None)
+    self.guidanceFieldTimer = qt.QTimer()
+    self.guidanceFieldTimer.setInterval(250)
+    self.guidanceFieldTimer.connect('timeout()', self.pollGuidanceField)
+
   def transferValues(self, needleTTNeedle, pointerTTPointer, needleTTracker, tFiducial,sFiducial, btr, xaf):
 
     self.needleTipToNeedle = needleTTNeedle
@@ -309,108 +604,618 @@ class SoundGuidanceLogic(ScriptedLoadableModuleLogic):
     self.surfaceFiducial = sFiducial
     self.boxToReference = btr
     self.xAxisFiducial = xaf
+    self.targetPointsCache = NodeArrayCache(self.targetFiducial, markupsWorldPoints)
+    self.surfacePointsCache = NodeArrayCache(self.surfaceFiducial, markupsWorldPoints)
+    self.xAxisPointsCache = NodeArrayCache(self.xAxisFiducial, markupsWorldPoints)
+    # World to box is read once per move of the box, not for every point converted in a frame
+    self.boxToWorldCache.removeObservers()
+    self.boxToWorldCache = NodeToWorldCache(self.boxToReference)
+
+    # Only the tracker pose changes per frame, the tip calibration is cached
+    if self.pointerTipCache:
+      self.pointerTipCache.removeObservers()
+    self.pointerTipCache = TransformChainCache(self.pointerTipToPointer)
+    if self.needleTipCache:
+      self.needleTipCache.removeObservers()
+    # Without a needle calibration no trajectory is sent
+    self.needleTipCache = TransformChainCache(self.needleTipToNeedle) if self.needleTipToNeedle else None
+
+    # The target index is rebuilt on the next frame after the targets change
+    self.overlays.observe('targets', self.targetFiducial, 'ModifiedEvent', self.invalidateTargets)
+    self.invalidateTargets()
+
+    # The entry plane basis is in box coordinates, it is recomputed on the next frame
+    # after a fiducial is edited but not when the tracked reference moves the box
+    for name, fiducial in (('target', self.targetFiducial), ('surface', self.surfaceFiducial), ('xAxis', self.xAxisFiducial)):
+      self.overlays.observe(name + 'PlaneAxis', fiducial, 'ModifiedEvent', self.invalidatePlaneAxis)
 
   def addCalculateDistanceObserver(self):
-    print("[TEST] addCalculateDistanceObserver")
-    #self.tipFiducial.SetAndObserveTransformNodeID(self.toolTipToTool.GetID())
-    self.observerTag = self.needleToTracker.AddObserver('ModifiedEvent', self.calculateCallback) # slicer.vtkMRMLMarkupsNode.MarkupAddedEvent
+    triggerNode = self.triggerNode if self.triggerNode else self.needleToTracker
+    self.overlays.observe('calculateDistance', triggerNode, 'ModifiedEvent', self.calculateCallback) # slicer.vtkMRMLMarkupsNode.MarkupAddedEvent
     logging.info('addCalculateDistanceObserver')
-      
+
   def removeCalculateDistanceObserver(self):
-    print("[TEST] removeCalculateDistanceObserver")
-    self.callbackObserverTag = 1
-    if self.callbackObserverTag != -1:
-      self.toolToReference.RemoveObserver(self.observerTag)
-      self.callbackObserverTag = -1
-      logging.info('removeCalculateDistanceObserver')
-      
+    self.overlays.removeObserver('calculateDistance')
+    logging.info('removeCalculateDistanceObserver')
+
+  def cleanup(self):
+    """Stop the outputs and remove the observers and overlays created by the logic."""
+    self.stopSendData()
+    self.stopLatencyProbe()
+    self.stopPoseBus()
+    self.mappingReloadTimer.stop()
+    self.guidanceFieldTimer.stop()
+    self.stopRecording()
+    self.stopReplay()
+    if self.pointerTipCache:
+      self.pointerTipCache.removeObservers()
+    if self.needleTipCache:
+      self.needleTipCache.removeObservers()
+    for toolCache in self.toolCaches:
+      toolCache.removeObservers()
+    self.boxToWorldCache.removeObservers()
+    self.overlays.cleanup()
+
   def calculateCallback(self, transformNode, event=None):
-    self.calculateDistance()
+    if not self.planeAxisValid and self.matrixTransfBOX is not None:
+      self.updatePlaneAxis()
+    if self.toolCaches:
+      self.sendToolOutputs()
+    # Outputs are refreshed by the scheduler, each at its own rate
+    self.updateScheduler.update(self.getPointerTipPosition())
 
   def calculateDistance(self):
+    pointerTipPoint = self.getPointerTipPosition()
+    self.updateDistanceLabel(pointerTipPoint)
+    self.updateTipToTargetLine(pointerTipPoint)
+    self.sendTipToTargetDistance(pointerTipPoint)
+    self.sendSurfaceDistance(pointerTipPoint)
 
-    pointerTipPoint = [0.0,0.0,0.0]
-    
-     
-    m = vtk.vtkMatrix4x4()
-    self.pointerTipToPointer.GetMatrixTransformToWorld(m)
-    pointerTipPoint[0] = m.GetElement(0, 3)
-    pointerTipPoint[1] = m.GetElement(1, 3)
-    pointerTipPoint[2] = m.GetElement(2, 3)
-    
+  def getPointerTipPosition(self):
+    return self.pointerTipCache.getTipPosition()
 
-    distance = math.sqrt(math.pow(pointerTipPoint[0]-self.pos[0], 2) + math.pow(pointerTipPoint[1]-self.pos[1], 2) + math.pow(pointerTipPoint[2]-self.pos[2], 2))
-    
-    # La distancia se da en mm ----> 50mm = 5cm
-    # Voy a normalizar con un tope de 20cm
-    normalizedDistance = [(distance - 0)/200]
-    
-    if self.OSC_active:
-      #print ("HOLAAA")
-      c.send("/dumpOSC/0/0", 0)
+  def getDistanceToTarget(self, pointerTipPoint):
+    return float(self.guidanceCore.distance(self.getBoxPoint(pointerTipPoint)))
 
-    self.outputDistanceLabel.setText('%.1f' % distance)
-    
-    self.pos = [self.pos[i] for i in (0,1,2)]
-    self.drawLineBetweenPoints(pointerTipPoint, self.pos)
+  def updateDistanceLabel(self, pointerTipPoint):
+    self.outputDistanceLabel.setText('%.1f' % self.getDistanceToTarget(pointerTipPoint))
 
-    if self.sendDataOK:
-      self.sendData(normalizedDistance)
+  def updateTipToTargetLine(self, pointerTipPoint):
+    self.drawLineBetweenPoints(pointerTipPoint, self.getWorldTargetPoint())
+    if self.tipTrail:
+      self.tipTrail.addPosition(pointerTipPoint)
+
+  def sendTipToTargetDistance(self, pointerTipPoint):
+    if self.OSC_active:
+      # Through the transport like every other message (the old pyOSC client c no longer exists)
+      self.sendData([0])
+
+    if not self.sendDataOK:
+      return
+
+    distance = self.getDistanceToTarget(pointerTipPoint)
+    normalizedDistance = [float(self.guidanceCore.normalizedDistance(distance))]
+    if self.poseFilterEnabled:
+      # Extra arguments: smoothed and predicted normalized distance, distance rate (mm/s)
+      predictedTipPoint, velocity = self.poseFilter.filter(pointerTipPoint, monotonicClock())
+      smoothedDistance = self.getDistanceToTarget(predictedTipPoint)
+      normalizedDistance.append(float(self.guidanceCore.normalizedDistance(smoothedDistance)))
+      normalizedDistance.append(distanceRate(predictedTipPoint, velocity, self.getWorldTargetPoint()))
+    self.sendData(normalizedDistance)
+    self.sendMappedParameters(distance)
+    if self.oscLink:
+      self.oscLink.sendFrame(normalizedDistance[0:1])
+    self.sendSelectedTarget(pointerTipPoint)
+    self.sendNeedleTrajectory()
+    self.sendPlaneCoordinates(pointerTipPoint)
+    self.sendGuidanceField(pointerTipPoint)
+
+  def logTipPosition(self, pointerTipPoint):
+    logging.debug('Pointer tip at %s, %.1f mm to target' % (list(pointerTipPoint), self.getDistanceToTarget(pointerTipPoint)))
+
+  def invalidateTargets(self, caller=None, event=None):
+    self.targetIndexValid = False
+    self.targetPointsCache.invalidate()
+
+  def updateTargetIndex(self):
+    """Load the box coordinates of all target fiducials into the spatial index.
+
+    The targets move with the box, so the index stays valid while the
+    reference is tracked and is only rebuilt after the target list is edited.
+    """
+    self.targetIndex.build(self.getBoxPoint(self.targetPointsCache.get()))
+    self.plannedTarget = 0
+    self.targetIndexValid = True
+    self.updateScheduler.forgetLastPoses()
+
+  def selectTarget(self, pointerTipPoint):
+    """Index of and distance to the nearest target, or to the next one in the planned order."""
+    if not self.targetIndexValid:
+      self.updateTargetIndex()
+    boxTipPoint = self.getBoxPoint(pointerTipPoint)
+    if self.targetSelectionMode == 'planned':
+      distance = float(np.linalg.norm(self.targetIndex.points[self.plannedTarget] - boxTipPoint))
+      if distance < self.targetReachedDistance and self.plannedTarget + 1 < len(self.targetIndex):
+        self.plannedTarget += 1
+        self.updateScheduler.forgetLastPoses()
+      return self.plannedTarget, distance
+    return self.targetIndex.nearest(boxTipPoint)
+
+  def sendSelectedTarget(self, pointerTipPoint):
+    if not self.targetIndexValid:
+      self.updateTargetIndex()
+    if len(self.targetIndex) < 2:
+      return
+    targetIndex, distance = self.selectTarget(pointerTipPoint)
+    self.oscTransport.sendMessage("/dumpOSC/target", [targetIndex, distance])
+
+  def setSurfaceModel(self, modelNode):
+    """Use the mesh of modelNode (e.g. aro.stl) for the tip to surface distance.
+
+    The locator is built in the model's own (BoxToReference) coordinates, so it
+    stays valid when the box is registered again, and is cached on disk. The
+    first build of a mesh takes a few seconds, so it runs in a background
+    thread and the surface distance is sent once pollSurfaceLocator finds it
+    ready; later startups only load the cache file.
+    """
+    self.surfaceModel = modelNode
+    if not modelNode or not modelNode.GetPolyData():
+      self.surfaceLocator = None
+      self.surfaceLocatorBuild = None
+      self.surfaceModelMTime = None
+      return
+    polyData = modelNode.GetPolyData()
+    if (self.surfaceLocator or self.surfaceLocatorBuild) and self.surfaceModelMTime == polyData.GetMTime():
+      return
+    triangleFilter = vtk.vtkTriangleFilter()
+    triangleFilter.SetInputData(polyData)
+    triangleFilter.PassLinesOff()
+    triangleFilter.PassVertsOff()
+    triangleFilter.Update()
+    triangles = triangleFilter.GetOutput()
+    # Copies, the thread must not read the filter output after it is released
+    vertices = numpy_support.vtk_to_numpy(triangles.GetPoints().GetData()).copy()
+    # Cell array of triangles: (3, id0, id1, id2) per cell
+    cells = numpy_support.vtk_to_numpy(triangles.GetPolys().GetData()).reshape(-1, 4)[:, 1:].copy()
+    cacheDirectory = os.path.join(slicer.app.cachePath, 'SoundGuidance')
+    self.surfaceLocator = None
+    self.surfaceModelMTime = polyData.GetMTime()
+    # A build still running for an older mesh is not taken, its thread only finishes writing its cache file
+    result = []
+    thread = threading.Thread(target=self.buildSurfaceLocator, args=(vertices, cells, cacheDirectory, result),
+      name='SurfaceLocatorBuilder')
+    thread.daemon = True
+    thread.start()
+    self.surfaceLocatorBuild = (thread, result)
+    logging.info('Loading or building the surface locator of %s in the background' % modelNode.GetName())
+
+  def buildSurfaceLocator(self, vertices, triangles, cacheDirectory, result):
+    """Thread target of setSurfaceModel, appends (locator, seconds) or the error to result."""
+    startTime = time.time()
+    # Only needed once a surface model is set, not at module startup
+    from SoundGuidanceLib.SurfaceDistance import loadOrBuildLocator
+    try:
+      result.append((loadOrBuildLocator(vertices, triangles, cacheDirectory), time.time() - startTime))
+    except (IOError, OSError, ValueError) as e:
+      result.append((None, e))
+
+  def pollSurfaceLocator(self):
+    """Take the surface locator once its background build has finished."""
+    if not self.surfaceLocatorBuild or self.surfaceLocatorBuild[0].is_alive():
+      return
+    thread, result = self.surfaceLocatorBuild
+    thread.join()
+    self.surfaceLocatorBuild = None
+    locator, secondsOrError = result[0] if result else (None, 'the build thread stopped')
+    if locator is None:
+      logging.error('Surface locator not built: %s' % secondsOrError)
+      return
+    self.surfaceLocator = locator
+    logging.info('Surface locator for %s ready in %.3f s (one-time cost, the next startups load it from the cache)'
+      % (self.surfaceModel.GetName(), secondsOrError))
+    if self.guidanceFieldBuilder:
+      # The field requested before the locator was ready has no surface distance channel
+      self.guidanceFieldFiducials = None
+      self.requestGuidanceField()
+
+  def getSurfaceDistance(self, pointerTipPoint):
+    """Signed distance (mm, negative inside) from the tip to the surface model."""
+    transformNode = self.surfaceModel.GetParentTransformNode()
+    if transformNode:
+      transformNode.GetMatrixTransformFromWorld(self.worldToSurfaceMatrix)
+    else:
+      self.worldToSurfaceMatrix.Identity()
+    localTipPoint = self.worldToSurfaceMatrix.MultiplyPoint(list(pointerTipPoint[0:3]) + [1.0])
+    closestPoint, signedDistance, triangle = self.surfaceLocator.closestPoint(localTipPoint[0:3], self.surfaceMaxDistance)
+    return signedDistance
+
+  def sendSurfaceDistance(self, pointerTipPoint):
+    """Refresh surfaceDistance and send it, at the rate of the 'surface' scheduler consumer."""
+    self.pollSurfaceLocator()
+    if not self.surfaceLocator or not self.sendDataOK:
+      return
+    self.surfaceDistance = self.getSurfaceDistance(pointerTipPoint)
+    self.oscTransport.sendMessage("/dumpOSC/surfaceDistance", [self.surfaceDistance])
+
+  def setGuidanceField(self, enabled, boundsModel=None):
+    """Send the tip values of a guidance field precomputed over boundsModel as /dumpOSC/field.
+
+    The grid is in BoxToReference coordinates, so it stays valid while the box
+    moves, and is rebuilt in the background (one process per core) when the
+    fiducials move. Without a PythonSlicer interpreter for the worker processes
+    the surface distances are computed in the background thread instead. Tips
+    outside the grid, or before the field is ready, get the same values
+    computed directly.
+    """
+    self.guidanceFieldTimer.stop()
+    self.guidanceField = None
+    self.guidanceFieldFiducials = None
+    self.guidanceFieldBuilder = None
+    if not enabled:
+      return
+    self.guidanceFieldBoundsModel = boundsModel
+    # The field pulls in multiprocessing and concurrent.futures, so it is imported when enabled
+    from SoundGuidanceLib.GuidanceField import GuidanceFieldBuilder, workerExecutable
+    # Workers run the Python interpreter of Slicer, not the application
+    executable = workerExecutable()
+    if not executable:
+      logging.warning('PythonSlicer not found next to %s, the guidance field is built in one process' % sys.executable)
+    self.guidanceFieldBuilder = GuidanceFieldBuilder(os.path.join(slicer.app.cachePath, 'SoundGuidance', 'Fields'),
+      processes=None if executable else 1, executable=executable)
+    self.guidanceFieldTimer.start()
+    self.requestGuidanceField()
+
+  def getWorldToBoxMatrix(self):
+    """World to box (BoxToReference) coordinates as a shared 4x4 array, read again only after the box moved."""
+    return self.boxToWorldCache.getFromWorldArray()
+
+  def getBoxToWorldMatrix(self):
+    """Box (BoxToReference) to world coordinates as a shared 4x4 array, read again only after the box moved."""
+    return self.boxToWorldCache.getToWorldArray()
+
+  def getBoxPoint(self, points):
+    """World points (3,) or (N,3), e.g. the tool tip, in box coordinates.
+
+    The box frame is BoxToReference, in which the fiducials of the guidance core
+    are given. It is not the entry plane frame of GuidanceCore.entryPlaneCoordinates,
+    which matrixTransfBOX maps box coordinates to.
+    """
+    return transformPoints(self.getWorldToBoxMatrix(), np.asarray(points)[..., 0:3])
+
+  def getWorldTargetPoint(self):
+    """Current world position of the target, which moves with the tracked box."""
+    return transformPoints(self.getBoxToWorldMatrix(), self.guidanceCore.targetPoint)
+
+  def setBoxTransform(self, modelNode):
+    """Overlays drawn in box coordinates follow the box through BoxToReference."""
+    modelNode.SetAndObserveTransformNodeID(self.boxToReference.GetID() if self.boxToReference else None)
+
+  def requestGuidanceField(self):
+    """Build the field for the current fiducials, unless it was requested for them already."""
+    if not self.guidanceFieldBuilder or not self.guidanceCore.isReady() or not self.guidanceFieldBoundsModel:
+      return
+    fiducials = np.array([self.guidanceCore.targetPoint, self.guidanceCore.surfacePoint, self.guidanceCore.xAxisPoint])
+    # Modified events without a point edit (e.g. a rename) do not rebuild the field
+    if self.guidanceFieldFiducials is not None and np.max(np.abs(fiducials - self.guidanceFieldFiducials)) <= self.guidanceFieldTolerance:
+      return
+    self.guidanceFieldFiducials = fiducials
+    self.guidanceField = None
+    from SoundGuidanceLib.GuidanceField import fieldGeometry
+    bounds = np.reshape(self.guidanceFieldBoundsModel.GetPolyData().GetBounds(), (3, 2))
+    geometry = fieldGeometry(bounds[:, 0], bounds[:, 1], self.guidanceFieldSpacing)
+    vertices = triangles = None
+    if self.surfaceLocator:
+      vertices, triangles = self.surfaceLocator.vertices, self.surfaceLocator.triangles
+    self.guidanceFieldBuilder.request(geometry, fiducials, vertices, triangles, self.surfaceMaxDistance)
+    logging.info('Building a %s guidance field' % 'x'.join(str(size) for size in geometry.shape))
+
+  def pollGuidanceField(self):
+    field = self.guidanceFieldBuilder.poll() if self.guidanceFieldBuilder else None
+    if field:
+      self.guidanceField = field
+      logging.info('Guidance field ready')
+
+  def getGuidanceValues(self, pointerTipPoint):
+    """Distance, depth, lateral offset and surface distance at the tip (GuidanceField.FIELD_CHANNELS)."""
+    boxPoint = self.getBoxPoint(pointerTipPoint)
+    if self.guidanceField and self.guidanceField.contains(boxPoint):
+      return self.guidanceField.lookup(boxPoint)
+    x, y, depth = self.getPlaneCoordinates(pointerTipPoint)
+    # The surface distance of the last 'surface' consumer run, the mesh is not queried every frame
+    surfaceDistance = self.surfaceDistance if self.surfaceLocator else float('nan')
+    return [self.getDistanceToTarget(pointerTipPoint), depth, math.hypot(x, y), surfaceDistance]
+
+  def sendGuidanceField(self, pointerTipPoint):
+    if not self.guidanceFieldBuilder or self.matrixTransfBOX is None:
+      return
+    self.oscTransport.sendMessage("/dumpOSC/field", [float(value) for value in self.getGuidanceValues(pointerTipPoint)])
+
+  def getNeedleTipPose(self):
+    """Needle tip to world pose as a 4x4 array (reused between frames)."""
+    self.needleTipCache.getTipToWorldMatrix(self.needleTipMatrix)
+    return arrayFromMatrix(self.needleTipMatrix, self.needleTipPose)
+
+  def getNeedleTrajectory(self):
+    """Axis to target distance, angle to zVector, remaining depth and entry plane crossing."""
+    return self.guidanceCore.evaluateTrajectory(np.dot(self.getWorldToBoxMatrix(), self.getNeedleTipPose()), self.needleAxis)
+
+  def sendNeedleTrajectory(self):
+    if not self.needleTipCache or not self.guidanceCore.isReady():
+      return
+    # All metrics in one message so the sound engine gets them together
+    self.oscTransport.sendMessage("/dumpOSC/trajectory", [float(value) for value in self.getNeedleTrajectory()])
+
+  def setNeedleAxis(self, axis):
+    """Direction of the needle shaft in NeedleTipToNeedle coordinates."""
+    self.needleAxis = np.asarray(axis, dtype=float)
+
+  def getPlaneCoordinates(self, pointerTipPoint):
+    """Tip in entry plane coordinates: lateral offsets x, y and depth z (mm)."""
+    self.tipHomogeneousPoint[0:3] = pointerTipPoint[0:3]
+    # matrixTransfBOX maps box coordinates to the entry plane, only the world to box part changes per frame
+    return np.dot(self.matrixTransfBOX, np.dot(self.getWorldToBoxMatrix(), self.tipHomogeneousPoint))[0:3]
+
+  def sendPlaneCoordinates(self, pointerTipPoint):
+    if self.matrixTransfBOX is None:
+      return
+    # One message per axis in a single datagram, routed separately by the Pd patch
+    x, y, z = self.getPlaneCoordinates(pointerTipPoint)
+    self.oscTransport.sendBundle(self.planeCoordinatesEncoder, [[x], [y], [z]])
+
+  def setToolConfiguration(self, configuration):
+    """Track the tools of a configuration from MultiTool.loadToolConfiguration.
+
+    Each tool gets its own cached transform chain, the receivers are added to
+    the OSC destination of the user interface and the trigger node replaces
+    NeedleToTracker as the transform whose updates drive the outputs.
+    """
+    for toolCache in self.toolCaches:
+      toolCache.removeObservers()
+    self.toolCaches = [TransformChainCache(slicer.util.getNode(tool['tipTransform'])) for tool in configuration['tools']]
+    self.toolPositions = np.zeros((len(self.toolCaches), 3))
+    self.toolFrameEncoder = ToolFrameEncoder([tool['name'] for tool in configuration['tools']])
+    self.triggerNode = slicer.util.getNode(configuration['trigger'])
+    self.extraReceivers = configuration['receivers']
+    self.setOSCDestination(*self.oscDestination)
+    if self.overlays.observations.get('calculateDistance'):
+      self.addCalculateDistanceObserver()
+
+  def sendToolOutputs(self):
+    """Evaluate all the tools in one pass and send them as one bundle to every receiver."""
+    if not self.sendDataOK or not self.guidanceCore.isReady():
+      return
+    for toolIndex, toolCache in enumerate(self.toolCaches):
+      self.toolPositions[toolIndex] = toolCache.getTipPosition()
+    result = self.guidanceCore.evaluatePositions(self.getBoxPoint(self.toolPositions))
+    self.oscTransport.sendBundle(self.toolFrameEncoder.bundleEncoder, self.toolFrameEncoder.values(result))
+
+  def setTargetSelectionMode(self, mode):
+    """'nearest' or 'planned' (targets in markups order, next one once reached)."""
+    self.targetSelectionMode = mode
+    self.plannedTarget = 0
+    self.updateScheduler.forgetLastPoses()
+
+  def setPoseFilter(self, enabled, predictionMilliseconds=None):
+    """Smooth the tip position and predict it predictionMilliseconds ahead for the OSC output."""
+    self.poseFilterEnabled = enabled
+    if predictionMilliseconds is not None:
+      self.poseFilter.predictionTime = predictionMilliseconds / 1000.0
+    self.poseFilter.reset()
+
+  def setInstrumentation(self, enabled):
+    """Time the stages of the tracker update path into the stageProfiler histograms."""
+    if enabled:
+      self.stageProfiler.instrument(self)
+    else:
+      self.stageProfiler.uninstrument()
+    # The scheduler and the tracker observer hold bound methods, rebind them
+    self.updateScheduler.getConsumer('label').callback = self.updateDistanceLabel
+    if 'calculateDistance' in self.overlays.observations:
+      self.overlays.removeObserver('calculateDistance')
+      self.addCalculateDistanceObserver()
+
+  def setPoseEpsilon(self, epsilon):
+    """Outputs are not refreshed when the tip moved by no more than epsilon (mm)."""
+    self.updateScheduler.setEpsilon(epsilon)
+
+  def deferCall(self, delaySeconds, function):
+    qt.QTimer.singleShot(int(delaySeconds * 1000), function)
 
   def setOutPutDistanceLabel(self, label):
     self.outputDistanceLabel = label
 
-  def drawLineBetweenPoints(self, point1, point2):        
-    # Create a vtkPoints object and store the points in it
-    points = vtk.vtkPoints()
-    points.InsertNextPoint(point1)
-    points.InsertNextPoint(point2)
-
-    # Create line
-    line = vtk.vtkLine()
-    #line.SetLineWidth(12.0)
-    line.GetPointIds().SetId(0,0) 
-    line.GetPointIds().SetId(1,1)
-    lineCellArray = vtk.vtkCellArray()
-    lineCellArray.InsertNextCell(line)
-    
-    # Update model data
-    self.line.GetPolyData().SetPoints(points)
-    self.line.GetPolyData().SetLines(lineCellArray)
+  def drawLineBetweenPoints(self, point1, point2):
+    # Only the endpoints of the persistent line are written
+    self.tipLine.setEndpoints(point1, point2)
+
+  def setTipTrailLength(self, length):
+    """Show the last length tip positions as a polyline, 0 hides the trail."""
+    length = int(length)
+    if length < 2:
+      if self.tipTrail:
+        self.tipTrail.setVisible(False)
+      self.tipTrail = None
+      return
+    # The same model node is reused, only its point array is reallocated
+    self.tipTrail = TrailOverlay(self.overlays, 'TipTrail', (1,0.5,0), length)
+    self.tipTrail.setVisible(True)
 
   def activateOSC(self):
     self.OSC_active = True
  
   def sendData(self, distance):
+    # Queued for the transport worker thread, never blocks the tracker callback
+    self.oscTransport.sendMessage("/dumpOSC/0/0", distance)
 
-    client = OSC.OSCClient()
-    client.connect(("192.168.0.70",7400))
+  def setOSCDestination(self, host, port):
+    self.oscDestination = (host, int(port))
+    self.oscTransport.setDestinations([self.oscDestination] + self.extraReceivers)
 
-    message = OSC.OSCMessage()
-    message.setAddress("/dumpOSC/0/0")
-    message.append(distance)
-
-    client.send(message)
   def changeSendDataStatus(self):
+    self.oscTransport.start()
     self.sendDataOK = True
 
-  def plotLineZaxis(self):
-
-    # Create a vtkPoints object and store the points in it
-    self.pos = [0.0, 0.0, 0.0, 0.0]  
-    self.targetFiducial.GetNthFiducialWorldCoordinates(0, self.pos)
-    targetP = [self.pos[i] for i in (0,1,2)]
+  def stopSendData(self):
+    self.sendDataOK = False
+    self.oscTransport.stop()
+
+  def startPoseBus(self, name='SoundGuidancePoseBus', capacity=1024):
+    """Publish every frame to local processes through a shared memory ring buffer."""
+    # multiprocessing.shared_memory needs Python 3.8, so the bus is imported when used
+    from SoundGuidanceLib.PoseBus import PoseBusWriter
+    self.stopPoseBus()
+    self.poseBus = PoseBusWriter(name, capacity)
+    logging.info('Publishing guidance frames to shared memory %s' % name)
+
+  def stopPoseBus(self):
+    if self.poseBus:
+      self.poseBus.close()
+      self.poseBus = None
+
+  def publishPoseBusFrame(self, pointerTipPoint):
+    if not self.poseBus or not self.guidanceCore.isReady():
+      return
+    distance = self.getDistanceToTarget(pointerTipPoint)
+    self.poseBus.publish(time.time(), pointerTipPoint, self.getWorldTargetPoint(), distance,
+      float(self.guidanceCore.normalizedDistance(distance)))
+
+  def setMappingFile(self, path):
+    """Send the parameters declared in a sound mapping file, an empty path stops them."""
+    self.mappingReloadTimer.stop()
+    self.mappingFile = None
+    if path and os.path.isfile(path):
+      self.mappingFile = MappingFile(path)
+      self.mappingReloadTimer.start()
+
+  def reloadMappingFile(self):
+    self.mappingFile.reloadIfChanged()
+
+  def sendMappedParameters(self, distance):
+    if not self.mappingFile or not self.mappingFile.mapping:
+      return
+    mapping = self.mappingFile.mapping
+    self.oscTransport.sendBundle(mapping.bundleEncoder, mapping.bundleValues(mapping.evaluate(distance)))
+
+  def startLatencyProbe(self, useLocalEcho=False):
+    """Measure the round trip to the OSC destination (or to a local echo server)."""
+    # asyncio is only available in Python 3, so the link is imported when used
+    from SoundGuidanceLib.OSCLink import EchoServer, OSCLink
+    self.stopLatencyProbe()
+    if useLocalEcho:
+      self.echoServer = EchoServer()
+      self.echoServer.start()
+      self.oscLink = OSCLink('127.0.0.1', self.echoServer.port, localPort=0)
+    else:
+      self.oscLink = OSCLink(self.oscDestination[0], self.oscDestination[1])
+    self.oscLink.start()
+
+  def stopLatencyProbe(self):
+    if self.oscLink:
+      logging.info('Audio link statistics: %s' % self.oscLink.statistics.summary())
+      self.oscLink.stop()
+      self.oscLink = None
+    if self.echoServer:
+      self.echoServer.stop()
+      self.echoServer = None
+
+  def getLatencySummary(self):
+    """Round trip percentiles (ms) and loss of the latency probe, None when not measuring."""
+    if not self.oscLink:
+      return None
+    return self.oscLink.statistics.summary()
+
+  def startRecording(self, path, transformNodes):
+    """Record every matrix update of the given transform nodes to a session log.
+
+    The metadata holds what is needed to evaluate the recorded poses offline:
+    the fiducials in the coordinates of referenceNode (the parent of
+    BoxToReference, whose poses are recorded with the tools) and the tip
+    calibrations pointerTipMatrix and needleTipMatrix.
+    """
+    self.stopRecording()
+    # Session logs are only imported when recording or replaying
+    from SoundGuidanceLib.SessionLog import SessionRecorder
+    metadata = {}
+    if self.guidanceCore.isReady():
+      # Box coordinates to the parent of BoxToReference (world when it has none)
+      referenceNode = self.boxToReference.GetParentTransformNode() if self.boxToReference else None
+      boxToReferenceArray = transformToParentArray(self.boxToReference) if self.boxToReference else np.identity(4)
+      fiducials = transformPoints(boxToReferenceArray,
+        [self.guidanceCore.targetPoint, self.guidanceCore.surfacePoint, self.guidanceCore.xAxisPoint])
+      metadata = {
+        'target': fiducials[0].tolist(),
+        'surface': fiducials[1].tolist(),
+        'xAxis': fiducials[2].tolist(),
+        'referenceNode': referenceNode.GetName() if referenceNode else None,
+        }
+    for key, tipNode in (('pointerTipMatrix', self.pointerTipToPointer), ('needleTipMatrix', self.needleTipToNeedle)):
+      if tipNode:
+        metadata[key] = transformToParentArray(tipNode).tolist()
+    self.sessionRecorder = SessionRecorder(path, [node.GetName() for node in transformNodes], metadata)
+    for nodeIndex, node in enumerate(transformNodes):
+      tag = node.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent,
+        lambda caller, event, nodeIndex=nodeIndex: self.recordTransform(nodeIndex, caller))
+      self.recordingObservations.append((node, tag))
+    logging.info('Recording session to %s' % path)
+
+  def recordTransform(self, nodeIndex, transformNode):
+    self.sessionRecorder.recordMatrix(nodeIndex, transformToParentArray(transformNode))
+
+  def stopRecording(self):
+    for node, tag in self.recordingObservations:
+      node.RemoveObserver(tag)
+    self.recordingObservations = []
+    if self.sessionRecorder:
+      self.sessionRecorder.close()
+      logging.info('Recorded %d transform updates to %s' % (self.sessionRecorder.recordCount, self.sessionRecorder.path))
+      self.sessionRecorder = None
+
+  def startReplay(self, path, asFastAsPossible=False):
+    """Feed a recorded session to the transform nodes with the recorded names."""
+    from SoundGuidanceLib.SessionLog import SessionReader, SessionReplayer
+    self.stopReplay()
+    reader = SessionReader(path)
+    self.replayNodes = dict((name, slicer.util.getNode(name)) for name in reader.nodeNames)
+    self.sessionReplayer = SessionReplayer(reader, self.applyReplayedMatrix)
+    self.sessionReplayer.start()
+    if asFastAsPossible:
+      self.sessionReplayer.replayAll()
+      self.sessionReplayer = None
+    else:
+      self.replayTimer.start()
+
+  def onReplayTimeout(self):
+    self.sessionReplayer.step()
+    if self.sessionReplayer.isFinished():
+      self.stopReplay()
+
+  def stopReplay(self):
+    self.replayTimer.stop()
+    self.sessionReplayer = None
+
+  def applyReplayedMatrix(self, nodeName, matrix):
+    setTransformToParentArray(self.replayNodes[nodeName], matrix)
+
+  def readFiducials(self):
+    """Box coordinates of the target, surface and x axis fiducials.
+
+    The fiducials are children of BoxToReference, so these only change when a
+    fiducial is edited, not when the tracked reference moves.
+    """
+    # First control point of each node, transformed into new arrays so that the cached ones stay intact
+    self.pos = self.getBoxPoint(self.targetPointsCache.get()[0])
+    self.surfPoint = self.getBoxPoint(self.surfacePointsCache.get()[0])
+    return self.pos, self.surfPoint, self.getBoxPoint(self.xAxisPointsCache.get()[0])
 
-    self.surfPoint = [0.0, 0.0, 0.0, 0.0]  
-    self.surfaceFiducial.GetNthFiducialWorldCoordinates(0, self.surfPoint)
-    surfaceP = [self.surfPoint[i] for i in (0,1,2)]
+  def plotLineZaxis(self):
 
-    self.zVector = np.subtract(targetP,surfaceP)
+    targetP, surfaceP, xAxisPoint = self.readFiducials()
+    self.guidanceCore.setFiducials(targetP, surfaceP, xAxisPoint)
+    self.zVector = self.guidanceCore.zVector
 
+    # Create a vtkPoints object and store the points in it
     points = vtk.vtkPoints()
-    points.InsertNextPoint(targetP)
-
-    points.InsertNextPoint(surfaceP)
+    points.SetData(numpy_support.numpy_to_vtk(np.array([targetP, surfaceP]), deep=True))
 
     # Create line
     line = vtk.vtkLine()
@@ -419,65 +1224,40 @@ class SoundGuidanceLogic(ScriptedLoadableModuleLogic):
     lineCellArray = vtk.vtkCellArray()
     lineCellArray.InsertNextCell(line)
 
-    self.lineNode = slicer.vtkMRMLModelNode()
-    self.lineNode.SetName('LineZ')
-    linePolyData = vtk.vtkPolyData()
-    self.lineNode.SetAndObservePolyData(linePolyData)
-    modelDisplay = slicer.vtkMRMLModelDisplayNode()
-    modelDisplay.SetSliceIntersectionVisibility(True)
-    modelDisplay.SetColor(1,1,1)
-    slicer.mrmlScene.AddNode(modelDisplay)
-
-    self.lineNode.SetAndObserveDisplayNodeID(modelDisplay.GetID())
-    slicer.mrmlScene.AddNode(self.lineNode)
-
+    self.lineNode = self.overlays.getModelNode('LineZ', (1,1,1))
     self.lineNode.GetPolyData().SetPoints(points)
     self.lineNode.GetPolyData().SetLines(lineCellArray)
 
-    #self.lineNode.SetAndObserveTransformNodeID(self.boxToReference.GetID())
+    self.setBoxTransform(self.lineNode)
+    self.updateScheduler.reset()
     self.drawPlane(surfaceP, self.zVector)
-    self.definePlaneAxis(surfaceP, self.zVector)
+    self.definePlaneAxis()
+
+  def invalidatePlaneAxis(self, caller=None, event=None):
+    self.planeAxisValid = False
+    # Point edits do not update the markups node modified time in every Slicer version
+    for pointsCache in (self.targetPointsCache, self.surfacePointsCache, self.xAxisPointsCache):
+      pointsCache.invalidate()
+
+  def updatePlaneAxis(self):
+    """Recompute the entry plane basis after a fiducial was edited and move the overlays in place."""
+    targetP, surfaceP, xAxisPoint = self.readFiducials()
+    self.guidanceCore.setFiducials(targetP, surfaceP, xAxisPoint)
+    self.zVector = self.guidanceCore.zVector
+    points = self.lineNode.GetPolyData().GetPoints()
+    points.SetPoint(0, targetP)
+    points.SetPoint(1, surfaceP)
+    points.Modified()
+    self.setPlaneSize(self.planeSize)
+    self.definePlaneAxis()
+    # A still tip has new plane coordinates and distances, they are sent on the next frame
+    self.updateScheduler.forgetLastPoses()
 
   def drawPlane(self, m, V_norm):
-    scene = slicer.mrmlScene
-
-    #create a plane to cut,here it cuts in the XZ direction (xz normal=(1,0,0);XY =(0,0,1),YZ =(0,1,0)
-    planex=vtk.vtkPlane()
-    planex.SetOrigin(m[0],m[1],m[2])
-    planex.SetNormal(V_norm[0],V_norm[1],V_norm[2])
-
-    renderer = slicer.app.layoutManager().threeDWidget(0).threeDView().renderWindow().GetRenderers().GetFirstRenderer()
-    viewSize = renderer.ComputeVisiblePropBounds()
-    #viewSize = (-50.0, 50.0, -50.0, 50.0, -50.0, 50.0)
-
-
-    planexSample = vtk.vtkSampleFunction()
-    planexSample.SetImplicitFunction(planex)
-    planexSample.SetModelBounds(viewSize)
-    #planexSample.SetSampleDimensions(200,200,200)
-    planexSample.ComputeNormalsOff()
-    plane1 = vtk.vtkContourFilter()
-    plane1.SetInputConnection(planexSample.GetOutputPort())
-
-
-    # Create model Plane A node
-    planeA = slicer.vtkMRMLModelNode()
-    planeA.SetScene(scene)
-    planeA.SetName("X-Y Plane")
-    planeA.SetAndObservePolyData(plane1.GetOutput())
-
-    # Create display model Plane A node
-    planeAModelDisplay = slicer.vtkMRMLModelDisplayNode()
-    planeAModelDisplay.SetColor(0.145,0.77,0.596)
-    
-    planeAModelDisplay.BackfaceCullingOff()
-    planeAModelDisplay.SetScene(scene)
-    scene.AddNode(planeAModelDisplay)
-    planeA.SetAndObserveDisplayNodeID(planeAModelDisplay.GetID())
-
-    #Add to scene
-    planeAModelDisplay.SetInputPolyDataConnection(plane1.GetOutputPort())
-    scene.AddNode(planeA)
+    # Square entry plane centered on the surface point, edges along the x axis fiducial
+    corners = planeQuadCorners(m, V_norm, self.planeSize, self.guidanceCore.xAxisPoint - np.asarray(m))
+    self.entryPlane.update(corners)
+    self.setBoxTransform(self.entryPlane.modelNode)
 
     # adjust center of 3d view to plane
     layoutManager = slicer.app.layoutManager()
@@ -485,75 +1265,25 @@ class SoundGuidanceLogic(ScriptedLoadableModuleLogic):
     threeDView = threeDWidget.threeDView()
     threeDView.resetFocalPoint()
 
-  def definePlaneAxis(self, oPoint, zV):
-    
-    xP = [0.0, 0.0, 0.0, 0.0]  
-    self.xAxisFiducial.GetNthFiducialWorldCoordinates(0, xP)
-   # a = Plane(Point3D(1,4,6), normal_vector=(2,4,6))
-    
-    xAxisPoint = [xP[i] for i in (0,1,2)]
- 
-    self.zVector = zV
-    self.xVector = np.subtract(xAxisPoint,oPoint)
-
-    self.yVector = np.cross(self.zVector, self.xVector)
-
-    #Para hallar la matriz de transformacion es necesario tener vectores unitarios!
-
-    xUnitario = self.xVector/numpy.linalg.norm(self.xVector)
-    yUnitario = self.yVector/numpy.linalg.norm(self.yVector)
-    zUnitario = self.zVector/numpy.linalg.norm(self.zVector)
-
-    print type(self.xVector)
-    print ('Vector x:')
-    print (self.xVector)
-    print (self.xVector[0])
-    print ('Vector y:')
-    print (self.yVector)
-    print ('Vector z:')
-    print (self.zVector)
-    print oPoint
-
-    #We create the transformation matrix so that change the coordinates system:
-    R = vtk.vtkMatrix3x3()
-    R.SetElement( 0, 0, xUnitario[0]  ) # Row 1
-    R.SetElement( 0, 1, xUnitario[1]  )
-    R.SetElement( 0, 2, xUnitario[2]  )
-    R.SetElement( 1, 0, yUnitario[0] )  # Row 2
-    R.SetElement( 1, 1, yUnitario[1] )
-    R.SetElement( 1, 2, yUnitario[2] )
-    R.SetElement( 2, 0, zUnitario[0] )  # Row 3
-    R.SetElement( 2, 1, zUnitario[1] )
-    R.SetElement( 2, 2, zUnitario[2] )
-    
-    resultPoint = [0.0, 0.0, 0.0]
-    R.MultiplyPoint(oPoint, resultPoint)
-   
-    matrixTransfBOX = vtk.vtkMatrix4x4()
-    matrixTransfBOX.SetElement( 0, 0, xUnitario[0] ) # Row 1
-    matrixTransfBOX.SetElement( 0, 1, xUnitario[1] )
-    matrixTransfBOX.SetElement( 0, 2, xUnitario[2] )
-    matrixTransfBOX.SetElement( 0, 3, -resultPoint[0] )      
-    matrixTransfBOX.SetElement( 1, 0, yUnitario[0] )  # Row 2
-    matrixTransfBOX.SetElement( 1, 1, yUnitario[1] )
-    matrixTransfBOX.SetElement( 1, 2, yUnitario[2] )
-    matrixTransfBOX.SetElement( 1, 3, -resultPoint[1] )       
-    matrixTransfBOX.SetElement( 2, 0, zUnitario[0] )  # Row 3
-    matrixTransfBOX.SetElement( 2, 1, zUnitario[1] )
-    matrixTransfBOX.SetElement( 2, 2, zUnitario[2] )
-    matrixTransfBOX.SetElement( 2, 3, -resultPoint[2] )
-    matrixTransfBOX.SetElement( 3, 0, 0 )  # Row 4
-    matrixTransfBOX.SetElement( 3, 1, 0)
-    matrixTransfBOX.SetElement( 3, 2, 0 )
-    matrixTransfBOX.SetElement( 3, 3, 1 )
-      
-    print (matrixTransfBOX)
-    #self.planeA.SetAndObserveTransformNodeID(self.boxToReference.GetID())
-    oPoint = oPoint + [1.0]
-    nuevoOrigen = [0.0, 0.0, 0.0 , 0.0]
-    matrixTransfBOX.MultiplyPoint(oPoint, nuevoOrigen)
-
-    print nuevoOrigen
+  def setPlaneSize(self, size):
+    """Edge length (mm) of the entry plane, updated in place if already drawn."""
+    self.planeSize = size
+    if self.guidanceCore.isReady():
+      self.entryPlane.update(planeQuadCorners(self.guidanceCore.surfacePoint, self.guidanceCore.zVector, size,
+        self.guidanceCore.xAxisPoint - self.guidanceCore.surfacePoint))
+
+  def definePlaneAxis(self):
+    # Coordinate system of the entry plane, computed by the guidance core
+    basis = self.guidanceCore.planeBasis
+    self.xVector = basis.xVector
+    self.yVector = basis.yVector
+    self.zVector = basis.zVector
+    self.matrixTransfBOX = basis.matrix
+    self.planeAxisValid = True
+    self.requestGuidanceField()
+
+    logging.debug('Vector x: %s, vector y: %s, vector z: %s, origin: %s' % (self.xVector, self.yVector, self.zVector, basis.origin))
+    logging.debug('Entry plane transform:\n%s' % self.matrixTransfBOX)
 
 class SoundGuidanceTest(ScriptedLoadableModuleTest):
   """
@@ -571,75 +1301,165 @@ class SoundGuidanceTest(ScriptedLoadableModuleTest):
     """Run as few or as many tests as needed here.
     """
     self.setUp()
-    self.test_SoundGuidance1()
-
-  def test_SoundGuidance1(self):
-    """ Ideally you should have several levels of tests.  At the lowest level
-    tests should exercise the functionality of the logic with different inputs
-    (both valid and invalid).  At higher levels your tests should emulate the
-    way the user would interact with your code and confirm that it still works
-    the way you intended.
-    One of the most important features of the tests is that it should alert other
-    developers when their changes will have an impact on the behavior of your
-    module.  For example, if a developer removes a feature that you depend on,
-    your test should break so they know that the feature is needed.
+    self.test_SoundGuidanceDistance()
+    self.setUp()
+    self.test_SoundGuidanceBenchmark()
+
+  def createGuidanceLogic(self):
+    """Build the pointer and needle transform chains and fiducials normally loaded by the widget.
+    The target is at the origin, 60 mm below the surface point. The needle tip
+    is at (10, 0, -100), pointing along +z towards the entry plane.
     """
+    self.pointerToTracker = slicer.vtkMRMLLinearTransformNode()
+    self.pointerToTracker.SetName('PointerToTracker')
+    slicer.mrmlScene.AddNode(self.pointerToTracker)
+    pointerTipToPointer = slicer.vtkMRMLLinearTransformNode()
+    pointerTipToPointer.SetName('PointerTipToPointer')
+    slicer.mrmlScene.AddNode(pointerTipToPointer)
+    pointerTipToPointer.SetAndObserveTransformNodeID(self.pointerToTracker.GetID())
+
+    needleToTracker = slicer.vtkMRMLLinearTransformNode()
+    needleToTracker.SetName('NeedleToTracker')
+    slicer.mrmlScene.AddNode(needleToTracker)
+    needleToTracker.SetMatrixTransformToParent(self.translationMatrix([10, 0, -80]))
+    needleTipToNeedle = slicer.vtkMRMLLinearTransformNode()
+    needleTipToNeedle.SetName('NeedleTipToNeedle')
+    slicer.mrmlScene.AddNode(needleTipToNeedle)
+    needleTipToNeedle.SetMatrixTransformToParent(self.translationMatrix([0, 0, -20]))
+    needleTipToNeedle.SetAndObserveTransformNodeID(needleToTracker.GetID())
+
+    fiducials = []
+    for name, position in (('Target', [0, 0, 0]), ('surfacePoint', [0, 0, -60]), ('xAxisFiducial', [30, 0, -60])):
+      fiducial = slicer.vtkMRMLMarkupsFiducialNode()
+      fiducial.SetName(name)
+      slicer.mrmlScene.AddNode(fiducial)
+      fiducial.AddFiducial(*position)
+      fiducials.append(fiducial)
 
-    self.delayDisplay("Starting the test")
-    #
-    # first, get some data
-    #
-    import urllib
-    downloads = (
-        ('http://slicer.kitware.com/midas3/download?items=5767', 'FA.nrrd', slicer.util.loadVolume),
-        )
-
-    for url,name,loader in downloads:
-      filePath = slicer.app.temporaryPath + '/' + name
-      if not os.path.exists(filePath) or os.stat(filePath).st_size == 0:
-        logging.info('Requesting download %s from %s...\n' % (name, url))
-        urllib.urlretrieve(url, filePath)
-      if loader:
-        logging.info('Loading %s...' % (name,))
-        loader(filePath)
-    self.delayDisplay('Finished with download and loading')
-
-    volumeNode = slicer.util.getNode(pattern="FA")
     logic = SoundGuidanceLogic()
-    self.assertTrue( logic.hasImageData(volumeNode) )
+    logic.transferValues(needleTipToNeedle, pointerTipToPointer, needleToTracker, fiducials[0], fiducials[1], None, fiducials[2])
+    self.distanceLabel = qt.QLabel()
+    logic.setOutPutDistanceLabel(self.distanceLabel)
+    logic.plotLineZaxis()
+    return logic
+
+  def translationMatrix(self, position):
+    m = vtk.vtkMatrix4x4()
+    m.SetElement(0, 3, position[0])
+    m.SetElement(1, 3, position[1])
+    m.SetElement(2, 3, position[2])
+    return m
+
+  def setPointerPosition(self, position):
+    self.pointerToTracker.SetMatrixTransformToParent(self.translationMatrix(position))
+
+  def test_SoundGuidanceDistance(self):
+    """The label and the OSC output show the tip to target distance."""
+    self.delayDisplay("Starting the distance test")
+    logic = self.createGuidanceLogic()
+    from SoundGuidanceLib import Benchmark
+    sink = Benchmark.LoopbackOSCSink()
+    sink.start()
+    logic.setOSCDestination('127.0.0.1', sink.port)
+    logic.changeSendDataStatus()
+
+    self.setPointerPosition([0, 0, 100])
+    logic.calculateDistance()
+    time.sleep(0.2)
+    logic.stopSendData()
+    sink.stop()
+
+    self.assertEqual(self.distanceLabel.text, '100.0')
+    # The distance, plane and trajectory outputs are separate messages, each sent once
+    messages = {}
+    for timestamp, address, arguments in sink.receivedMessages():
+      messages.setdefault(address, []).append(arguments)
+    self.assertEqual(len(messages['/dumpOSC/0/0']), 1)
+    self.assertAlmostEqual(messages['/dumpOSC/0/0'][0][0], 0.5)
+    # The tip is on the z axis of the entry plane, 160 mm from the surface point
+    for axis, expected in (('x', 0.0), ('y', 0.0), ('z', 160.0)):
+      self.assertEqual(len(messages['/dumpOSC/plane/' + axis]), 1)
+      self.assertAlmostEqual(messages['/dumpOSC/plane/' + axis][0][0], expected, places=3)
+    # Axis to target distance, angle, depth and entry plane crossing of the needle
+    self.assertEqual(len(messages['/dumpOSC/trajectory']), 1)
+    for value, expected in zip(messages['/dumpOSC/trajectory'][0], [10.0, 0.0, 100.0, 10.0, 0.0]):
+      self.assertAlmostEqual(value, expected, places=3)
     self.delayDisplay('Test passed!')
 
+  def test_SoundGuidanceBenchmark(self):
+    """Push synthetic pointer poses through the calculateDistance stages at
+    increasing rates and write the latency statistics as JSON.
+    """
+    self.delayDisplay("Starting the pipeline benchmark")
+    logic = self.createGuidanceLogic()
+    from SoundGuidanceLib import Benchmark
+    sink = Benchmark.LoopbackOSCSink()
+    sink.start()
+    logic.setOSCDestination('127.0.0.1', sink.port)
+    logic.changeSendDataStatus()
+    poses = Benchmark.syntheticPoses(1000, logic.guidanceCore.targetPoint)
+
+    def createStages():
+      def eventStage(frame):
+        self.setPointerPosition(poses[frame['index'], 0:3, 3])
+      def transformStage(frame):
+        frame['tip'] = logic.getPointerTipPosition()
+      def distanceStage(frame):
+        frame['distance'] = logic.getDistanceToTarget(frame['tip'])
+      def labelStage(frame):
+        logic.updateDistanceLabel(frame['tip'])
+      def lineStage(frame):
+        logic.updateTipToTargetLine(frame['tip'])
+      def sendStage(frame):
+        frame['sentValue'] = float(logic.guidanceCore.normalizedDistance(frame['distance']))
+        logic.sendData([frame['sentValue']])
+      return [('event', eventStage), ('transform', transformStage), ('distance', distanceStage),
+        ('label', labelStage), ('line', lineStage), ('send', sendStage)]
+
+    results = Benchmark.runBenchmarkSuite(createStages, lambda rateHz: rateHz // 2,
+      sink=sink, transport=logic.oscTransport)
+    logic.stopSendData()
+    sink.stop()
+
+    resultsPath = os.path.join(slicer.app.temporaryPath, 'SoundGuidancePipelineBenchmark.json')
+    Benchmark.writeResults(results, resultsPath)
+    logging.info('Pipeline benchmark results written to %s' % resultsPath)
+
+    self.assertEqual(len(results['rates']), len(Benchmark.DEFAULT_RATES))
+    self.assertGreater(results['rates'][0]['packetsReceived'], 0)
+    self.delayDisplay('Test passed!')
 
-from OSC import OSCClient, OSCMessage
 
 class SendOSC(object):
+    """Sends the fixed guidance messages with preallocated OSC encoders.
+
+    Each call encodes into a reused buffer, so message size stays constant over
+    a session, and the needle tip position goes out as one bundle datagram.
+    """
 
     def __init__(self):
-        self.osc_message = None
-        self.osc_client = OSCClient()
-        self.osc_message = OSCMessage()        
-        
+        self.osc_socket = None
+        self.osc_encoders = FixedShapeEncoder()
+        self.distance_encoder = OSCMessageEncoder("/dumpOSC/DistanceTipTarget", "f")
+        self.needle_tip_encoder = OSCBundleEncoder([
+            OSCMessageEncoder("/dumpOSC/needltip/x", "f"),
+            OSCMessageEncoder("/dumpOSC/needltip/y", "f"),
+            OSCMessageEncoder("/dumpOSC/needltip/z", "f")])
+
         self.ip = ""
         self.port = 0
 
     def connect(self, ip="localhost", port=8080):
         self.ip = ip
         self.port = port
-        self.osc_client.connect((self.ip, self.port))
+        self.osc_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.osc_socket.connect((self.ip, self.port))
 
-    def send(self, address, value):
-        self.osc_message.setAddress(address)
-        self.osc_message.append(value)
-        self.osc_client.send(self.osc_message)
+    def send(self, address, *values):
+        self.osc_socket.send(self.osc_encoders(address, values))
 
     def send_distane(self, distance):
-        oscdump = "/dumpOSC/DistanceTipTarget"
-        self.send(oscdump, distance)
+        self.osc_socket.send(self.distance_encoder.encode((distance,)))
 
     def send_needle_tip_position(self, x, y, z):
-        oscdump = "/dumpOSC/needltip/x"
-        self.send(oscdump, x)
-        oscdump = "/dumpOSC/needltip/y"
-        self.send(oscdump, y)
-        oscdump = "/dumpOSC/needltip/z"
-        self.send(oscdump, z)
\ No newline at end of file
+        self.osc_socket.send(self.needle_tip_encoder.encode(((x,), (y,), (z,))))
@@ -0,0 +1,107 @@
+"""Models and transforms of the module loaded from a compact binary cache.
+
+Reading the STL models (vtkSTLReader merges the points of every triangle) and
+the .h5 transforms (ITK transform IO) is most of the time the module takes to
+open. The first time an asset is loaded its arrays are written to an .npz file
+in the cache directory: float32 points and int32 triangles for a model, the
+4x4 matrix for a linear transform. Later sessions build the nodes straight
+from these arrays. Cache files are keyed by the source file name, size and
+modification time, so an edited asset is converted again.
+"""
+
+import logging
+import os
+
+import numpy as np
+import slicer
+import vtk
+from vtk.util import numpy_support
+
+from .NodeArrays import setTransformToParentArray, transformToParentArray
+
+
+def cachePath(sourcePath, cacheDirectory):
+  status = os.stat(sourcePath)
+  name = os.path.splitext(os.path.basename(sourcePath))[0]
+  return os.path.join(cacheDirectory, '%s-%d-%d.npz' % (name, status.st_size, int(status.st_mtime)))
+
+
+def _saveArrays(path, **arrays):
+  directory = os.path.dirname(path)
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  np.savez(path, **arrays)
+
+
+def readModelArrays(sourcePath):
+  """Points (N,3) and triangles (M,3) of a model file read with VTK."""
+  reader = vtk.vtkSTLReader() if sourcePath.lower().endswith('.stl') else vtk.vtkPolyDataReader()
+  reader.SetFileName(sourcePath)
+  triangleFilter = vtk.vtkTriangleFilter()
+  triangleFilter.SetInputConnection(reader.GetOutputPort())
+  triangleFilter.PassLinesOff()
+  triangleFilter.PassVertsOff()
+  triangleFilter.Update()
+  polyData = triangleFilter.GetOutput()
+  points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData()).astype(np.float32)
+  # Cell array of triangles: (3, id0, id1, id2) per cell
+  triangles = numpy_support.vtk_to_numpy(polyData.GetPolys().GetData()).reshape(-1, 4)[:, 1:].astype(np.int32)
+  return points, triangles
+
+
+def polyDataFromArrays(points, triangles):
+  polyData = vtk.vtkPolyData()
+  vtkPoints = vtk.vtkPoints()
+  vtkPoints.SetData(numpy_support.numpy_to_vtk(np.ascontiguousarray(points, dtype=np.float32), deep=True))
+  polyData.SetPoints(vtkPoints)
+  cells = np.empty((len(triangles), 4), dtype=numpy_support.ID_TYPE_CODE)
+  cells[:, 0] = 3
+  cells[:, 1:] = triangles
+  polys = vtk.vtkCellArray()
+  polys.SetCells(len(triangles), numpy_support.numpy_to_vtkIdTypeArray(cells.ravel(), deep=True))
+  polyData.SetPolys(polys)
+  return polyData
+
+
+def loadModelArrays(sourcePath, cacheDirectory):
+  """Points and triangles of a model, converted to the cache on first use."""
+  path = cachePath(sourcePath, cacheDirectory)
+  if os.path.exists(path):
+    data = np.load(path)
+    return data['points'], data['triangles']
+  points, triangles = readModelArrays(sourcePath)
+  _saveArrays(path, points=points, triangles=triangles)
+  return points, triangles
+
+
+def loadModel(sourcePath, name, cacheDirectory):
+  """Model node named name with the mesh of sourcePath, None if the file is missing."""
+  if not os.path.isfile(sourcePath):
+    logging.warning('Model %s not found, %s is not loaded' % (sourcePath, name))
+    return None
+  points, triangles = loadModelArrays(sourcePath, cacheDirectory)
+  modelNode = slicer.modules.models.logic().AddModel(polyDataFromArrays(points, triangles))
+  modelNode.SetName(name)
+  return modelNode
+
+
+def loadLinearTransform(sourcePath, name, cacheDirectory):
+  """Linear transform node named name read from sourcePath, None if the file is missing."""
+  if not os.path.isfile(sourcePath):
+    logging.warning('Transform %s not found, %s is not loaded' % (sourcePath, name))
+    return None
+  path = cachePath(sourcePath, cacheDirectory)
+  if os.path.exists(path):
+    transformNode = slicer.vtkMRMLLinearTransformNode()
+    transformNode.SetName(name)
+    setTransformToParentArray(transformNode, np.load(path)['matrix'])
+    slicer.mrmlScene.AddNode(transformNode)
+    return transformNode
+
+  loaded, transformNode = slicer.util.loadTransform(sourcePath, returnNode=True)
+  if not loaded:
+    return None
+  transformNode.SetName(name)
+  if transformNode.IsLinear():
+    _saveArrays(path, matrix=transformToParentArray(transformNode))
+  return transformNode
@@ -0,0 +1,223 @@
+"""Latency and throughput benchmark of the guidance pipeline.
+
+A pipeline is a list of (stageName, function) pairs run in order for every
+frame; each function receives a dict describing the frame and may add values
+to it for the following stages. The stage that hands a value to the OSC
+output stores it as frame['sentValue'] so the packet received by the loopback
+sink (a stand-in for the Pd patch) can be matched to the frame it came from.
+
+Only the standard library and NumPy are used, so the same harness runs inside
+Slicer (SoundGuidanceTest) and headless (Benchmarks/benchmarkPipeline.py).
+"""
+
+import json
+import socket
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+
+from .GuidanceCore import tipPositions
+from .OSCEncoder import decodePacket
+from .UpdateScheduler import monotonicClock
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+DEFAULT_RATES = (30, 120, 500, 1000)
+PERCENTILES = (50, 90, 99)
+
+
+def valueKey(value):
+  """Key used to match a float sent over OSC (as float32) to its frame."""
+  return struct.pack('>f', value)
+
+
+class LoopbackOSCSink(object):
+  """UDP receiver on localhost that timestamps every OSC packet it gets."""
+
+  def __init__(self, port=0, clock=monotonicClock):
+    self.clock = clock
+    self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.socket.bind(('127.0.0.1', port))
+    self.socket.settimeout(0.05)
+    self.port = self.socket.getsockname()[1]
+    self.packets = []
+    self.running = False
+    self.thread = None
+
+  def start(self):
+    self.running = True
+    self.thread = threading.Thread(target=self._run, name='LoopbackOSCSink')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    self.running = False
+    self.thread.join()
+    self.socket.close()
+
+  def clear(self):
+    self.packets = []
+
+  def receivedMessages(self):
+    """List of (receiveTime, address, values) for every message received."""
+    messages = []
+    for receiveTime, data in list(self.packets):
+      for address, values in decodePacket(data):
+        messages.append((receiveTime, address, values))
+    return messages
+
+  def _run(self):
+    while self.running:
+      try:
+        data = self.socket.recv(65536)
+      except socket.timeout:
+        continue
+      self.packets.append((self.clock(), data))
+
+
+def syntheticPoses(frameCount, targetPoint, startDistance=150.0, endDistance=1.0):
+  """(N,4,4) tip poses on a helix closing in on the target.
+
+  The distance to the target strictly decreases so every frame sends a
+  different value.
+  """
+  distance = np.linspace(startDistance, endDistance, frameCount)
+  angle = np.linspace(0.0, 8.0 * np.pi, frameCount)
+  direction = np.column_stack((np.cos(angle), np.sin(angle), np.ones(frameCount)))
+  direction /= np.sqrt(np.sum(direction * direction, axis=1))[:, np.newaxis]
+  poses = np.tile(np.identity(4), (frameCount, 1, 1))
+  poses[:, 0:3, 3] = np.asarray(targetPoint, dtype=float) + direction * distance[:, np.newaxis]
+  return poses
+
+
+def headlessPipeline(core, transport, poses, address="/dumpOSC/0/0"):
+  """Same stages as SoundGuidanceLogic.calculateDistance, without Slicer."""
+  def transformStage(frame):
+    frame['tip'] = tipPositions(poses[frame['index']])
+  def distanceStage(frame):
+    frame['distance'] = float(core.distance(frame['tip']))
+  def labelStage(frame):
+    frame['label'] = '%.1f' % frame['distance']
+  def sendStage(frame):
+    frame['sentValue'] = float(core.normalizedDistance(frame['distance']))
+    transport.sendMessage(address, [frame['sentValue']])
+  return [('transform', transformStage), ('distance', distanceStage), ('label', labelStage), ('send', sendStage)]
+
+
+def percentileSummary(values):
+  values = np.asarray(values, dtype=float)
+  if not len(values):
+    return None
+  summary = dict(('p%d' % p, float(v)) for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES)))
+  summary['mean'] = float(np.mean(values))
+  summary['max'] = float(np.max(values))
+  return summary
+
+
+def measureAllocations(stages, frameCount):
+  """Mean bytes allocated (peak above baseline) and net blocks kept per frame."""
+  if tracemalloc is None or not hasattr(tracemalloc, 'reset_peak'):
+    return None
+  tracemalloc.start()
+  peakBytes = []
+  blocksBefore = sys.getallocatedblocks()
+  for index in range(frameCount):
+    frame = {'index': index}
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for name, function in stages:
+      function(frame)
+    peakBytes.append(tracemalloc.get_traced_memory()[1] - baseline)
+  blocksAfter = sys.getallocatedblocks()
+  tracemalloc.stop()
+  return {
+    'peakBytesPerFrame': float(np.mean(peakBytes)),
+    'retainedBlocksPerFrame': float(blocksAfter - blocksBefore) / frameCount,
+    }
+
+
+def runPipeline(stages, frameCount, rateHz, sink=None, transport=None, clock=monotonicClock, settleTime=0.2):
+  """Push frameCount frames through the stages at rateHz and collect statistics."""
+  stageNames = [name for name, function in stages]
+  stageTimes = np.zeros((frameCount, len(stages)))
+  startTimes = np.zeros(frameCount)
+  sentFrames = {}
+  if sink:
+    sink.clear()
+  if transport:
+    transport.resetCounters()
+
+  period = 1.0 / rateHz
+  firstFrameTime = clock()
+  for index in range(frameCount):
+    # Sleep most of the wait, then yield until due so the sender threads can run
+    dueTime = firstFrameTime + index * period
+    while True:
+      remaining = dueTime - clock()
+      if remaining <= 0.0:
+        break
+      time.sleep(remaining - 0.001 if remaining > 0.002 else 0)
+    frame = {'index': index}
+    stageStart = startTimes[index] = clock()
+    for stageIndex, (name, function) in enumerate(stages):
+      function(frame)
+      stageEnd = clock()
+      stageTimes[index, stageIndex] = stageEnd - stageStart
+      stageStart = stageEnd
+    if 'sentValue' in frame:
+      sentFrames[valueKey(frame['sentValue'])] = index
+  duration = clock() - firstFrameTime
+  time.sleep(settleTime)
+
+  result = {
+    'rateHz': rateHz,
+    'frames': frameCount,
+    'durationSeconds': duration,
+    'achievedRateHz': frameCount / duration,
+    'stageLatencyMs': dict((name, percentileSummary(1000.0 * stageTimes[:, i])) for i, name in enumerate(stageNames)),
+    'pipelineLatencyMs': percentileSummary(1000.0 * np.sum(stageTimes, axis=1)),
+    }
+
+  if sink:
+    endToEnd = []
+    receivedFrames = set()
+    for receiveTime, address, values in sink.receivedMessages():
+      if not values:
+        continue
+      index = sentFrames.get(valueKey(values[0]))
+      if index is not None and index not in receivedFrames:
+        receivedFrames.add(index)
+        endToEnd.append(receiveTime - startTimes[index])
+    result['packetsReceived'] = len(sink.packets)
+    result['packetsPerSecond'] = len(sink.packets) / duration
+    result['framesLost'] = len(sentFrames) - len(receivedFrames)
+    result['endToEndLatencyMs'] = percentileSummary(1000.0 * np.asarray(endToEnd))
+  if transport:
+    result['transport'] = transport.getCounters()
+  return result
+
+
+def runBenchmarkSuite(createStages, frameCount, rates=DEFAULT_RATES, sink=None, transport=None, allocationFrames=200):
+  """Run the pipeline at every rate. createStages() returns a fresh stage list."""
+  results = {
+    'python': sys.version.split()[0],
+    'numpy': np.__version__,
+    'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'rates': [],
+    }
+  for rateHz in rates:
+    results['rates'].append(runPipeline(createStages(), frameCount(rateHz) if callable(frameCount) else frameCount,
+      rateHz, sink, transport))
+  results['allocations'] = measureAllocations(createStages(), allocationFrames)
+  return results
+
+
+def writeResults(results, path):
+  with open(path, 'w') as f:
+    json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,176 @@
+"""Guidance geometry of the SoundGuidance module using NumPy only.
+
+No Slicer, VTK or Qt imports so that it can be unit tested, profiled and used
+for offline analysis in a plain Python process. Poses are 4x4 homogeneous
+matrices (or (N,4,4) stacks of them) and points are given in the same
+coordinate system as the fiducials (box coordinates, i.e. the BoxToReference
+frame, in the module, world RAS when analysing recorded world poses). Entry
+plane coordinates are the frame of the entry plane basis built from the
+fiducials: origin at the surface point, z towards the target.
+"""
+
+import collections
+
+import numpy as np
+
+# La distancia se da en mm ----> 50mm = 5cm
+# Se normaliza con un tope de 20cm
+NORMALIZATION_DISTANCE = 200.0
+
+GuidanceResult = collections.namedtuple('GuidanceResult',
+  ['tipPosition', 'distance', 'normalizedDistance', 'entryPlaneCoordinates'])
+
+EntryPlaneBasis = collections.namedtuple('EntryPlaneBasis',
+  ['origin', 'xVector', 'yVector', 'zVector', 'xUnit', 'yUnit', 'zUnit', 'matrix'])
+
+TrajectoryResult = collections.namedtuple('TrajectoryResult',
+  ['axisDistance', 'angle', 'depth', 'entryX', 'entryY'])
+
+# Direction of the needle shaft in the needle tip coordinate system
+NEEDLE_AXIS = (0.0, 0.0, 1.0)
+
+
+def tipPositions(poses):
+  """Translation part of one (4,4) pose or a stack of (N,4,4) poses."""
+  return np.asarray(poses, dtype=float)[..., 0:3, 3]
+
+
+def distanceToTarget(points, targetPoint):
+  """Euclidean distance from one point (3,) or many points (N,3) to the target."""
+  difference = np.asarray(points, dtype=float) - np.asarray(targetPoint, dtype=float)
+  return np.sqrt(np.sum(difference * difference, axis=-1))
+
+
+def normalizeDistance(distance, maxDistance=NORMALIZATION_DISTANCE):
+  """Distance mapped to the range sent to the sound engine (1.0 at maxDistance)."""
+  return np.asarray(distance, dtype=float) / maxDistance
+
+
+def entryPlaneBasis(originPoint, zVector, xAxisPoint):
+  """Coordinate system of the entry plane.
+
+  The z axis points from the surface point to the target, the x axis towards
+  the x axis fiducial and y = z cross x. The returned matrix maps world points
+  to entry plane coordinates (rotation rows are the unit axes and the origin is
+  mapped to zero).
+  """
+  originPoint = np.asarray(originPoint, dtype=float)
+  zVector = np.asarray(zVector, dtype=float)
+  xVector = np.asarray(xAxisPoint, dtype=float) - originPoint
+  yVector = np.cross(zVector, xVector)
+
+  # Para hallar la matriz de transformacion es necesario tener vectores unitarios!
+  xUnit = xVector / np.linalg.norm(xVector)
+  yUnit = yVector / np.linalg.norm(yVector)
+  zUnit = zVector / np.linalg.norm(zVector)
+
+  matrix = np.identity(4)
+  matrix[0:3, 0:3] = (xUnit, yUnit, zUnit)
+  matrix[0:3, 3] = -np.dot(matrix[0:3, 0:3], originPoint)
+  return EntryPlaneBasis(originPoint, xVector, yVector, zVector, xUnit, yUnit, zUnit, matrix)
+
+
+def transformPoints(matrix, points):
+  """Apply a 4x4 matrix to one point (3,) or many points (N,3)."""
+  points = np.asarray(points, dtype=float)
+  return np.dot(points, matrix[0:3, 0:3].T) + matrix[0:3, 3]
+
+
+def trajectoryMetrics(tipPoses, targetPoint, planeBasis, needleAxis=NEEDLE_AXIS):
+  """Needle trajectory relative to the target and the entry plane.
+
+  For one tip-to-world pose (4,4) or many (N,4,4), with the needle pointing
+  along needleAxis in tip coordinates:
+  axisDistance: distance from the target to the needle axis line (mm).
+  angle: angle between the needle and the entry plane z axis (degrees).
+  depth: distance left to the target along the needle (negative once past it).
+  entryX, entryY: where the needle axis crosses the entry plane, in entry plane
+  coordinates (nan when the needle is parallel to the plane).
+  """
+  tipPoses = np.asarray(tipPoses, dtype=float)
+  tipPoints = tipPoses[..., 0:3, 3]
+  directions = np.dot(tipPoses[..., 0:3, 0:3], np.asarray(needleAxis, dtype=float))
+  directions = directions / np.linalg.norm(directions, axis=-1)[..., np.newaxis]
+
+  toTarget = np.asarray(targetPoint, dtype=float) - tipPoints
+  depth = np.sum(toTarget * directions, axis=-1)
+  perpendicular = np.cross(toTarget, directions)
+  axisDistance = np.sqrt(np.sum(perpendicular * perpendicular, axis=-1))
+
+  alignment = np.dot(directions, planeBasis.zUnit)
+  angle = np.degrees(np.arccos(np.clip(alignment, -1.0, 1.0)))
+
+  with np.errstate(divide='ignore', invalid='ignore'):
+    steps = np.dot(planeBasis.origin - tipPoints, planeBasis.zUnit) / np.where(np.abs(alignment) > 1e-9, alignment, np.nan)
+  entryPoints = transformPoints(planeBasis.matrix, tipPoints + directions * steps[..., np.newaxis])
+  return TrajectoryResult(axisDistance, angle, depth, entryPoints[..., 0], entryPoints[..., 1])
+
+
+def planeQuadCorners(originPoint, normal, size, inPlaneDirection=None):
+  """Corners of a size x size square centered on originPoint in the plane.
+
+  Returned as (origin, point1, point2) in the vtkPlaneSource convention. The
+  square edges follow inPlaneDirection projected on the plane when given
+  (e.g. towards the x axis fiducial), otherwise an arbitrary direction.
+  """
+  originPoint = np.asarray(originPoint, dtype=float)
+  normal = np.asarray(normal, dtype=float)
+  normal = normal / np.linalg.norm(normal)
+  if inPlaneDirection is None or np.linalg.norm(np.cross(normal, inPlaneDirection)) < 1e-6:
+    inPlaneDirection = np.identity(3)[np.argmin(np.abs(normal))]
+  uAxis = np.asarray(inPlaneDirection, dtype=float)
+  uAxis = uAxis - np.dot(uAxis, normal) * normal
+  uAxis /= np.linalg.norm(uAxis)
+  vAxis = np.cross(normal, uAxis)
+  corner = originPoint - 0.5 * size * (uAxis + vAxis)
+  return corner, corner + size * uAxis, corner + size * vAxis
+
+
+class GuidanceCore(object):
+  """Tip to target guidance computed from tracker poses.
+
+  Call setFiducials once the target, surface and x axis points are known, then
+  evaluate either one pose or a whole (N,4,4) array of poses.
+  """
+
+  def __init__(self, maxDistance=NORMALIZATION_DISTANCE):
+    self.maxDistance = maxDistance
+    self.targetPoint = None
+    self.surfacePoint = None
+    self.xAxisPoint = None
+    self.zVector = None
+    self.planeBasis = None
+
+  def setFiducials(self, targetPoint, surfacePoint, xAxisPoint):
+    self.targetPoint = np.asarray(targetPoint, dtype=float)[0:3]
+    self.surfacePoint = np.asarray(surfacePoint, dtype=float)[0:3]
+    self.xAxisPoint = np.asarray(xAxisPoint, dtype=float)[0:3]
+    self.zVector = self.targetPoint - self.surfacePoint
+    self.planeBasis = entryPlaneBasis(self.surfacePoint, self.zVector, self.xAxisPoint)
+
+  def isReady(self):
+    return self.planeBasis is not None
+
+  def distance(self, tipPosition):
+    return distanceToTarget(tipPosition, self.targetPoint)
+
+  def normalizedDistance(self, distance):
+    return normalizeDistance(distance, self.maxDistance)
+
+  def entryPlaneCoordinates(self, tipPosition):
+    """Tip position (given in the fiducial frame) in entry plane coordinates."""
+    return transformPoints(self.planeBasis.matrix, tipPosition)
+
+  def evaluatePositions(self, tipPosition):
+    """Guidance values for one tip position (3,) or many (N,3)."""
+    tipPosition = np.asarray(tipPosition, dtype=float)
+    distance = self.distance(tipPosition)
+    return GuidanceResult(tipPosition, distance, self.normalizedDistance(distance), self.entryPlaneCoordinates(tipPosition))
+
+  def evaluate(self, tipPoses):
+    """Guidance values for one tip-to-world pose (4,4) or many (N,4,4)."""
+    return self.evaluatePositions(tipPositions(tipPoses))
+
+  def evaluateTrajectory(self, tipPoses, needleAxis=NEEDLE_AXIS):
+    """Needle trajectory metrics for one tip-to-world pose (4,4) or many (N,4,4)."""
+    return trajectoryMetrics(tipPoses, self.targetPoint, self.planeBasis, needleAxis)
@@ -0,0 +1,353 @@
+"""Guidance values precomputed on a voxel grid in box coordinates.
+
+Once the fiducials are placed, every value sent to the sound engine depends
+only on where the tip is in the box (BoxToReference) coordinate system, like
+the aro.stl and box.stl models and the fiducials themselves. buildGuidanceField
+evaluates them on a regular grid covering the box:
+
+  distance         tip to target distance (mm)
+  depth            entry plane z coordinate, positive below the plane (mm)
+  lateral          distance from the entry plane z axis (mm)
+  surfaceDistance  signed distance to the surface mesh, clamped to
+                   surfaceMaxDistance (nan without a mesh)
+
+The grid is an (nx,ny,nz,channels) float16 or float32 .npy file that is
+memory mapped, and GuidanceField.lookup interpolates all the channels at a
+tip position with one trilinear lookup, whatever the values cost to compute.
+
+The surface distance only depends on the mesh and the grid, so it is kept in
+its own cache file and computed once, spread over a process pool. Moving a
+fiducial only recomputes the cheap closed form channels. Both files are named
+after a hash of everything they depend on and are written under a temporary
+name first, so an interrupted build never leaves a partial cache behind.
+GuidanceFieldBuilder runs the builds in a background thread and keeps only
+the latest request.
+"""
+
+import collections
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import glob
+import hashlib
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+
+import numpy as np
+
+from .GuidanceCore import GuidanceCore
+from .SurfaceDistance import SurfaceLocator, meshHash
+
+# 2: surface distances signed by the pseudo-normal of the closest feature
+# 3: voxels nearest to a mesh vertex no longer lose all their candidate triangles to rounding
+CACHE_VERSION = 3
+
+FIELD_CHANNELS = ('distance', 'depth', 'lateral', 'surfaceDistance')
+
+# Field files of older fiducial placements kept in the cache directory
+KEEP_FIELD_FILES = 16
+
+FieldGeometry = collections.namedtuple('FieldGeometry', ['origin', 'spacing', 'shape'])
+
+# Offsets of the 8 voxels around a point, in the order of the trilinear weights
+_CORNERS = np.array([(i, j, k) for i in (0, 1) for j in (0, 1) for k in (0, 1)])
+
+
+def fieldGeometry(lower, upper, spacing=2.0, margin=20.0):
+  """Grid with spacing (mm) covering the bounds lower..upper plus margin on every side."""
+  origin = np.asarray(lower, dtype=float) - margin
+  extent = np.asarray(upper, dtype=float) + margin - origin
+  shape = tuple(int(count) for count in np.ceil(extent / spacing).astype(int) + 1)
+  return FieldGeometry(origin, float(spacing), shape)
+
+
+def gridPoints(geometry, xStart=0, xEnd=None):
+  """Box coordinates (N,3) of the voxels of the slab xStart..xEnd, in array order."""
+  xEnd = geometry.shape[0] if xEnd is None else xEnd
+  axes = [np.arange(xStart, xEnd), np.arange(geometry.shape[1]), np.arange(geometry.shape[2])]
+  indices = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+  return geometry.origin + indices * geometry.spacing
+
+
+def _digest(*values):
+  digest = hashlib.sha1()
+  for value in values:
+    digest.update(repr(value).encode('utf-8') if not isinstance(value, np.ndarray) else value.tobytes())
+  return digest.hexdigest()
+
+
+def _geometryValues(geometry):
+  return (np.round(geometry.origin, 6), geometry.spacing, geometry.shape)
+
+
+def surfaceKey(geometry, vertices, triangles, maxDistance):
+  return _digest(CACHE_VERSION, meshHash(vertices, triangles), float(maxDistance), *_geometryValues(geometry))
+
+
+def fieldKey(geometry, fiducials, vertices=None, triangles=None, surfaceMaxDistance=50.0, dtype=np.float16):
+  surface = surfaceKey(geometry, vertices, triangles, surfaceMaxDistance) if vertices is not None else None
+  return _digest(CACHE_VERSION, surface, np.dtype(dtype).str, np.asarray(fiducials, dtype=float), *_geometryValues(geometry))
+
+
+def _openTemporary(path, dtype, shape):
+  directory = os.path.dirname(path)
+  if directory and not os.path.isdir(directory):
+    os.makedirs(directory)
+  temporaryPath = '%s.%d.tmp' % (path, os.getpid())
+  return temporaryPath, np.lib.format.open_memmap(temporaryPath, mode='w+', dtype=dtype, shape=shape)
+
+
+def _finishTemporary(temporaryPath, path):
+  os.replace(temporaryPath, path)
+  return np.load(path, mmap_mode='r')
+
+
+def _surfaceSlab(task):
+  """Surface distances of one x slab, written into the memory mapped cache file."""
+  path, geometry, xStart, xEnd, vertices, triangles, maxDistance = task
+  locator = SurfaceLocator(vertices, triangles, build=False)
+  distances = np.load(path, mmap_mode='r+')
+  distances[xStart:xEnd] = locator.signedDistances(gridPoints(geometry, xStart, xEnd), maxDistance).reshape(
+    (xEnd - xStart,) + tuple(geometry.shape[1:]))
+  distances.flush()
+  return xEnd - xStart
+
+
+def workerExecutable(applicationExecutable=None):
+  """Python interpreter to start the worker processes with, None when there is none.
+
+  In a plain Python process that is sys.executable. In Slicer, sys.executable
+  is the application, which cannot run multiprocessing workers, and the
+  PythonSlicer launcher is installed next to it (bin on Linux and Windows,
+  Contents/bin of the macOS bundle), whether or not that is on the PATH.
+  """
+  executable = applicationExecutable or sys.executable
+  if not executable:
+    return None
+  if os.path.basename(executable).lower().startswith('python'):
+    return executable
+  directory = os.path.dirname(os.path.abspath(executable))
+  for candidateDirectory in (directory, os.path.join(directory, os.pardir, 'bin')):
+    for name in ('PythonSlicer', 'PythonSlicer.exe'):
+      candidate = os.path.normpath(os.path.join(candidateDirectory, name))
+      if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+        return candidate
+  return None
+
+
+def _processPool(processes, executable=None):
+  # Workers are started fresh (never forked from a GUI process), with another interpreter when given
+  context = multiprocessing.get_context('spawn')
+  if executable:
+    context.set_executable(executable)
+  return concurrent.futures.ProcessPoolExecutor(processes or os.cpu_count(), mp_context=context)
+
+
+def surfaceDistanceGrid(geometry, vertices, triangles, maxDistance, cacheDirectory, processes=None, executable=None,
+    slabSize=4):
+  """(nx,ny,nz) float32 signed distances to the mesh, read from cacheDirectory when computed before.
+
+  Only the slabs within maxDistance of the mesh bounds are searched, in a pool
+  of processes (processes=1 computes them in this process).
+  """
+  path = os.path.join(cacheDirectory, 'GuidanceSurface-%s.npy' % surfaceKey(geometry, vertices, triangles, maxDistance))
+  if os.path.exists(path):
+    return np.load(path, mmap_mode='r')
+  temporaryPath, distances = _openTemporary(path, np.float32, geometry.shape)
+  distances[...] = maxDistance
+  distances.flush()
+  lower = (np.min(vertices, axis=0)[0] - maxDistance - geometry.origin[0]) / geometry.spacing
+  upper = (np.max(vertices, axis=0)[0] + maxDistance - geometry.origin[0]) / geometry.spacing
+  xRange = range(max(int(np.floor(lower)), 0), min(int(np.ceil(upper)) + 1, geometry.shape[0]), slabSize)
+  tasks = [(temporaryPath, geometry, xStart, min(xStart + slabSize, geometry.shape[0]), vertices, triangles, maxDistance)
+    for xStart in xRange]
+  try:
+    if processes == 1 or len(tasks) < 2:
+      for task in tasks:
+        _surfaceSlab(task)
+    else:
+      with _processPool(processes, executable) as pool:
+        list(pool.map(_surfaceSlab, tasks))
+  except BaseException:
+    del distances
+    os.remove(temporaryPath)
+    raise
+  # The file is closed before it is renamed
+  del distances
+  return _finishTemporary(temporaryPath, path)
+
+
+def _pruneFieldFiles(cacheDirectory, keep=KEEP_FIELD_FILES):
+  paths = sorted(glob.glob(os.path.join(cacheDirectory, 'GuidanceField-*.npy')), key=os.path.getmtime)
+  for path in paths[0:-keep]:
+    try:
+      os.remove(path)
+    except OSError:
+      # Still mapped by a field in use (Windows)
+      pass
+
+
+def buildGuidanceField(geometry, fiducials, cacheDirectory, vertices=None, triangles=None, surfaceMaxDistance=50.0,
+    dtype=np.float16, processes=None, executable=None):
+  """GuidanceField for the target, surface and x axis fiducials given in box coordinates.
+
+  vertices and triangles are the surface mesh in box coordinates (the aro.stl
+  model points). The field is read from cacheDirectory when it was built
+  before for the same grid, fiducials and mesh.
+  """
+  key = fieldKey(geometry, fiducials, vertices, triangles, surfaceMaxDistance, dtype)
+  path = os.path.join(cacheDirectory, 'GuidanceField-%s.npy' % key)
+  if os.path.exists(path):
+    return GuidanceField(geometry, np.load(path, mmap_mode='r'), key)
+
+  surfaceDistances = None
+  if vertices is not None:
+    surfaceDistances = surfaceDistanceGrid(geometry, vertices, triangles, surfaceMaxDistance, cacheDirectory,
+      processes, executable)
+  core = GuidanceCore()
+  core.setFiducials(*fiducials)
+  temporaryPath, values = _openTemporary(path, dtype, tuple(geometry.shape) + (len(FIELD_CHANNELS),))
+  try:
+    for xIndex in range(geometry.shape[0]):
+      # One x slice at a time keeps the temporary arrays small for large grids
+      points = gridPoints(geometry, xIndex, xIndex + 1)
+      planePoints = core.entryPlaneCoordinates(points)
+      slab = values[xIndex].reshape(-1, len(FIELD_CHANNELS))
+      slab[:, 0] = core.distance(points)
+      slab[:, 1] = planePoints[:, 2]
+      slab[:, 2] = np.hypot(planePoints[:, 0], planePoints[:, 1])
+      slab[:, 3] = surfaceDistances[xIndex].ravel() if surfaceDistances is not None else np.nan
+    values.flush()
+  except BaseException:
+    del values
+    os.remove(temporaryPath)
+    raise
+  del values
+  values = _finishTemporary(temporaryPath, path)
+  _pruneFieldFiles(cacheDirectory)
+  return GuidanceField(geometry, values, key)
+
+
+class GuidanceField(object):
+  """Trilinear lookup of all the channels of a field at box coordinate points."""
+
+  def __init__(self, geometry, values, key=None):
+    self.geometry = geometry
+    # Plain ndarray view of the memory map, slicing a np.memmap costs more than the interpolation
+    self.values = np.asarray(values)
+    self.key = key
+    self.origin = np.asarray(geometry.origin, dtype=float)
+    self.spacing = geometry.spacing
+    self.upperIndex = np.array(geometry.shape) - 1
+    self.channels = FIELD_CHANNELS
+    # Python numbers for the single point lookup, numpy scalars are slower there
+    self.originList = [float(value) for value in self.origin]
+    self.upperIndexList = [int(value) for value in self.upperIndex]
+
+  def contains(self, points):
+    """True for the points (3,) or (N,3) inside the grid."""
+    indices = (np.asarray(points, dtype=float) - self.origin) / self.spacing
+    return np.all((indices >= 0) & (indices <= self.upperIndex), axis=-1)
+
+  def lookup(self, points):
+    """Channel values (len(FIELD_CHANNELS),) at one point or (N,len(FIELD_CHANNELS)) at many.
+
+    Points outside the grid get the values of the nearest face (see contains).
+    """
+    points = np.asarray(points, dtype=float)
+    if points.ndim == 1:
+      return self._lookupPoint(points)
+    indices = np.clip((np.atleast_2d(points) - self.origin) / self.spacing, 0, self.upperIndex)
+    lower = np.minimum(indices.astype(int), self.upperIndex - 1)
+    fractions = indices - lower
+    # (N,8) weights of the surrounding voxels: products of (1 - f) or f along each axis
+    weights = np.prod(np.where(_CORNERS, fractions[:, np.newaxis, :], 1.0 - fractions[:, np.newaxis, :]), axis=2)
+    corners = lower[:, np.newaxis, :] + _CORNERS
+    cornerValues = self.values[corners[..., 0], corners[..., 1], corners[..., 2]].astype(float)
+    return np.einsum('nc,ncp->np', weights, cornerValues)
+
+  def _lookupPoint(self, point):
+    # Indices as Python floats, then one (2,2,2,channels) block interpolated along x, y then z
+    lower = []
+    fractions = []
+    for axis in range(3):
+      index = min(max((float(point[axis]) - self.originList[axis]) / self.spacing, 0.0), self.upperIndexList[axis])
+      lowerIndex = min(int(index), self.upperIndexList[axis] - 1)
+      lower.append(lowerIndex)
+      fractions.append(index - lowerIndex)
+    x, y, z = lower
+    block = self.values[x:x + 2, y:y + 2, z:z + 2].astype(float)
+    block = block[0] + (block[1] - block[0]) * fractions[0]
+    block = block[0] + (block[1] - block[0]) * fractions[1]
+    return block[0] + (block[1] - block[0]) * fractions[2]
+
+  def lookupDict(self, point):
+    return dict(zip(self.channels, self.lookup(point)))
+
+
+class GuidanceFieldBuilder(object):
+  """Builds guidance fields in a background thread.
+
+  request() starts a build, or queues it while one is running (only the most
+  recent request is kept); poll(), called from a timer, returns the field of
+  the latest request once it is ready and None otherwise.
+  """
+
+  def __init__(self, cacheDirectory, processes=None, executable=None):
+    self.cacheDirectory = cacheDirectory
+    self.processes = processes
+    self.executable = executable
+    self.thread = None
+    self.pendingArguments = None
+    self.requestedKey = None
+    self.result = None
+
+  def request(self, geometry, fiducials, vertices=None, triangles=None, surfaceMaxDistance=50.0, dtype=np.float16):
+    """Build the field for these arguments (see buildGuidanceField). Returns its key."""
+    self.requestedKey = fieldKey(geometry, fiducials, vertices, triangles, surfaceMaxDistance, dtype)
+    self.pendingArguments = (geometry, fiducials, self.cacheDirectory, vertices, triangles, surfaceMaxDistance, dtype,
+      self.processes, self.executable)
+    if not self.isBuilding():
+      self._start()
+    return self.requestedKey
+
+  def isBuilding(self):
+    return self.thread is not None
+
+  def _start(self):
+    arguments = self.pendingArguments
+    self.pendingArguments = None
+    self.thread = threading.Thread(target=self._build, args=arguments, name='GuidanceFieldBuilder')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _build(self, *arguments):
+    try:
+      self.result = buildGuidanceField(*arguments)
+    except (OSError, ValueError, BrokenProcessPool) as e:
+      logging.error('Guidance field not built: %s' % e)
+      self.result = None
+
+  def poll(self):
+    if self.thread is None or self.thread.is_alive():
+      return None
+    self.thread.join()
+    self.thread = None
+    result = self.result
+    self.result = None
+    if self.pendingArguments:
+      self._start()
+    if result is not None and result.key == self.requestedKey:
+      return result
+    return None
+
+  def wait(self):
+    """Block until the latest request is built and return its field (None if it failed)."""
+    while self.thread is not None:
+      self.thread.join()
+      field = self.poll()
+      if field is not None:
+        return field
+    return None
@@ -0,0 +1,137 @@
+"""Timing probes around the stages of the per-frame guidance path.
+
+Each stage is a method of an object (e.g. SoundGuidanceLogic.getDistanceToTarget).
+StageProfiler.instrument replaces the methods on the instance with wrappers
+that time every call into a fixed-bucket LatencyHistogram, and uninstrument
+removes the wrappers again, so a disabled profiler leaves the original methods
+in place and costs nothing. Histograms have log spaced buckets from 1 us to
+1 s; a percentile is reported as the upper edge of its bucket.
+"""
+
+import bisect
+import csv
+import json
+
+import numpy as np
+
+from .UpdateScheduler import monotonicClock
+
+# Four buckets per octave from 1 us to about 1 s, plus one overflow bucket
+BUCKET_EDGES = tuple(1e-6 * 2.0 ** (index / 4.0) for index in range(81))
+
+
+class LatencyHistogram(object):
+
+  def __init__(self, bucketEdges=BUCKET_EDGES):
+    self.bucketEdges = list(bucketEdges)
+    self.counts = [0] * (len(self.bucketEdges) + 1)
+    self.reset()
+
+  def reset(self):
+    for index in range(len(self.counts)):
+      self.counts[index] = 0
+    self.count = 0
+    self.total = 0.0
+    self.maximum = 0.0
+
+  def add(self, seconds):
+    self.counts[bisect.bisect_left(self.bucketEdges, seconds)] += 1
+    self.count += 1
+    self.total += seconds
+    if seconds > self.maximum:
+      self.maximum = seconds
+
+  def percentile(self, percent):
+    """Upper bucket edge (s) below which percent % of the samples are."""
+    if not self.count:
+      return None
+    index = int(np.searchsorted(np.cumsum(self.counts), self.count * percent / 100.0))
+    return self.bucketEdges[index] if index < len(self.bucketEdges) else self.maximum
+
+  def summary(self):
+    """Count and p50, p99, max and mean in milliseconds."""
+    if not self.count:
+      return {'count': 0}
+    return {
+      'count': self.count,
+      'p50': self.percentile(50) * 1000.0,
+      'p99': self.percentile(99) * 1000.0,
+      'max': self.maximum * 1000.0,
+      'mean': self.total / self.count * 1000.0,
+      }
+
+
+class StageProfiler(object):
+  """Per-stage latency histograms of instrumented methods.
+
+  stages is a list of (stageName, methodName) pairs; the first stage is the
+  event entry point and its call count gives the event rate.
+  """
+
+  def __init__(self, stages, clock=monotonicClock):
+    self.stages = list(stages)
+    self.clock = clock
+    self.histograms = dict((name, LatencyHistogram()) for name, methodName in self.stages)
+    self.instrumented = None
+    self.startTime = None
+
+  def isEnabled(self):
+    return self.instrumented is not None
+
+  def reset(self):
+    for histogram in self.histograms.values():
+      histogram.reset()
+    self.startTime = self.clock()
+
+  def instrument(self, target):
+    """Time every call of the stage methods of target until uninstrument."""
+    self.uninstrument()
+    for name, methodName in self.stages:
+      setattr(target, methodName, self._timed(getattr(target, methodName), self.histograms[name]))
+    self.instrumented = target
+    self.reset()
+
+  def uninstrument(self):
+    if self.instrumented is None:
+      return
+    for name, methodName in self.stages:
+      # Removing the instance attribute exposes the class method again
+      self.instrumented.__dict__.pop(methodName, None)
+    self.instrumented = None
+
+  def _timed(self, function, histogram):
+    clock = self.clock
+    def timedFunction(*args, **kwargs):
+      startTime = clock()
+      try:
+        return function(*args, **kwargs)
+      finally:
+        histogram.add(clock() - startTime)
+    return timedFunction
+
+  def eventRate(self):
+    """Calls per second of the first stage since the last reset."""
+    if self.startTime is None or not self.stages:
+      return 0.0
+    elapsed = self.clock() - self.startTime
+    return self.histograms[self.stages[0][0]].count / elapsed if elapsed > 0 else 0.0
+
+  def summary(self):
+    return [(name, self.histograms[name].summary()) for name, methodName in self.stages]
+
+  def writeReport(self, path):
+    """Write the stage summaries to a .csv file, or to JSON with the bucket counts."""
+    if path.lower().endswith('.csv'):
+      with open(path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['stage', 'count', 'p50_ms', 'p99_ms', 'max_ms', 'mean_ms'])
+        for name, summary in self.summary():
+          writer.writerow([name, summary['count']] + [summary.get(key, '') for key in ('p50', 'p99', 'max', 'mean')])
+      return
+    report = {
+      'eventRate': self.eventRate(),
+      'bucketEdges': list(BUCKET_EDGES),
+      'stages': [dict(summary, stage=name, buckets=list(self.histograms[name].counts)) for name, summary in self.summary()],
+      }
+    with open(path, 'w') as f:
+      json.dump(report, f, indent=2, sort_keys=True)
@@ -0,0 +1,82 @@
+"""Several tracked tools and OSC receivers described by a JSON file.
+
+Teaching sessions track more than one tool and play the sound on more than
+one audio client. The file lists the tools (each with the tip transform node
+that ends its chain), the receivers and the transform node whose updates
+trigger the outputs, e.g.
+
+  {
+    "trigger": "NeedleToTracker",
+    "tools": [
+      {"name": "pointer", "tipTransform": "PointerTipToPointer"},
+      {"name": "needle", "tipTransform": "NeedleTipToNeedle"}
+    ],
+    "receivers": [
+      {"host": "192.168.0.70", "port": 7400},
+      {"host": "192.168.0.71", "port": 7400}
+    ]
+  }
+
+The outputs of all the tools of one tracker update go out as a single OSC
+bundle, so the cost per update is one vectorized evaluation, one encoding and
+one datagram per receiver whatever the number of tools.
+"""
+
+import json
+
+from .OSCEncoder import OSCBundleEncoder, OSCMessageEncoder
+
+DEFAULT_TRIGGER = 'NeedleToTracker'
+
+
+def parseToolConfiguration(configuration):
+  """Checked copy of a configuration dictionary with the defaults filled in."""
+  tools = configuration.get('tools', [])
+  if not tools:
+    raise ValueError('The tool configuration has no tools')
+  names = set()
+  for tool in tools:
+    if 'name' not in tool or 'tipTransform' not in tool:
+      raise ValueError('Each tool needs a name and a tipTransform: %s' % tool)
+    if tool['name'] in names:
+      raise ValueError('Tool %s is configured twice' % tool['name'])
+    names.add(tool['name'])
+  receivers = []
+  for receiver in configuration.get('receivers', []):
+    if 'host' not in receiver or 'port' not in receiver:
+      raise ValueError('Each receiver needs a host and a port: %s' % receiver)
+    receivers.append((str(receiver['host']), int(receiver['port'])))
+  return {
+    'trigger': configuration.get('trigger', DEFAULT_TRIGGER),
+    'tools': [dict(tool) for tool in tools],
+    'receivers': receivers,
+    }
+
+
+def loadToolConfiguration(path):
+  with open(path) as configurationFile:
+    return parseToolConfiguration(json.load(configurationFile))
+
+
+class ToolFrameEncoder(object):
+  """OSC bundle with the outputs of every tool for one tracker update.
+
+  Per tool: <prefix>/<name>/distance (normalized distance) and
+  <prefix>/<name>/plane (x, y, z in entry plane coordinates).
+  """
+
+  def __init__(self, toolNames, prefix='/dumpOSC'):
+    self.toolNames = list(toolNames)
+    messageEncoders = []
+    for name in self.toolNames:
+      messageEncoders.append(OSCMessageEncoder('%s/%s/distance' % (prefix, name), 'f'))
+      messageEncoders.append(OSCMessageEncoder('%s/%s/plane' % (prefix, name), 'fff'))
+    self.bundleEncoder = OSCBundleEncoder(messageEncoders)
+
+  def values(self, result):
+    """Bundle arguments from a GuidanceResult evaluated for all tools at once."""
+    valuesList = []
+    for normalizedDistance, planeCoordinates in zip(result.normalizedDistance.tolist(), result.entryPlaneCoordinates.tolist()):
+      valuesList.append([normalizedDistance])
+      valuesList.append(planeCoordinates)
+    return valuesList
@@ -0,0 +1,105 @@
+"""NumPy views of markups and transform nodes without per element copies.
+
+Matrices are copied between vtkMatrix4x4 and (4,4) float64 arrays with one
+DeepCopy of all 16 elements, and the world coordinates of all the control
+points of a markups node are exported as one (N,3) array (a single
+GetControlPointPositionsWorld call where Slicer has it).
+
+NodeArrayCache keeps the exported array of a node and exports it again only
+when the node, its curve points or one of its parent transforms has a newer
+modified time, so reading fiducials or poses every frame costs a few MTime
+comparisons while nothing moves.
+"""
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+
+def arrayFromMatrix(matrix, array=None):
+  """(4,4) array with the elements of a vtkMatrix4x4, written into array when given."""
+  if array is None:
+    array = np.identity(4)
+  # The static DeepCopy writes the 16 elements into the contiguous array memory
+  matrix.DeepCopy(array.ravel(), matrix)
+  return array
+
+
+def matrixFromArray(array, matrix=None):
+  """vtkMatrix4x4 with the elements of a (4,4) array, written into matrix when given."""
+  if matrix is None:
+    matrix = vtk.vtkMatrix4x4()
+  matrix.DeepCopy(np.ascontiguousarray(array, dtype=float).ravel())
+  return matrix
+
+
+def transformToParentArray(transformNode, array=None):
+  matrix = vtk.vtkMatrix4x4()
+  transformNode.GetMatrixTransformToParent(matrix)
+  return arrayFromMatrix(matrix, array)
+
+
+def transformToWorldArray(transformNode, array=None):
+  matrix = vtk.vtkMatrix4x4()
+  transformNode.GetMatrixTransformToWorld(matrix)
+  return arrayFromMatrix(matrix, array)
+
+
+def setTransformToParentArray(transformNode, array):
+  """Set the matrix of a linear transform node from a (4,4) array (one Modified event)."""
+  transformNode.SetMatrixTransformToParent(matrixFromArray(array))
+
+
+def markupsWorldPoints(markupsNode):
+  """World coordinates of all the control points of a markups node as an (N,3) array."""
+  if hasattr(markupsNode, 'GetControlPointPositionsWorld'):
+    points = vtk.vtkPoints()
+    markupsNode.GetControlPointPositionsWorld(points)
+    if not points.GetNumberOfPoints():
+      return np.zeros((0, 3))
+    return numpy_support.vtk_to_numpy(points.GetData()).astype(float)
+  # Markups fiducial nodes of Slicer versions before the control point API
+  pointCount = markupsNode.GetNumberOfFiducials()
+  array = np.zeros((pointCount, 4))
+  for pointIndex in range(pointCount):
+    markupsNode.GetNthFiducialWorldCoordinates(pointIndex, array[pointIndex])
+  return array[:, 0:3]
+
+
+def modifiedKey(node):
+  """Modified times of a node and of everything its world coordinates depend on."""
+  key = [node.GetMTime()]
+  if hasattr(node, 'GetCurveInputPoly'):
+    # Moving a control point updates the curve points, not always the node itself
+    key.append(node.GetCurveInputPoly().GetPoints().GetMTime())
+  transformNode = node.GetParentTransformNode()
+  while transformNode:
+    key.append(transformNode.GetMTime())
+    key.append(transformNode.GetTransformToParent().GetMTime())
+    transformNode = transformNode.GetParentTransformNode()
+  return tuple(key)
+
+
+class NodeArrayCache(object):
+  """Array exported from a node by read(node), exported again after the node changed.
+
+  e.g. NodeArrayCache(targetFiducial, markupsWorldPoints) or
+  NodeArrayCache(needleToTracker, transformToWorldArray). Returned arrays are
+  shared, callers copy them before modifying them.
+  """
+
+  def __init__(self, node, read):
+    self.node = node
+    self.read = read
+    self.key = None
+    self.array = None
+
+  def invalidate(self, caller=None, event=None):
+    self.key = None
+
+  def get(self):
+    key = modifiedKey(self.node)
+    if key != self.key:
+      self.array = self.read(self.node)
+      self.key = key
+    return self.array
@@ -0,0 +1,124 @@
+import numbers
+import struct
+
+# OSC time tag meaning "process immediately"
+IMMEDIATELY = b'\x00\x00\x00\x00\x00\x00\x00\x01'
+BUNDLE_TAG = b'#bundle\x00'
+
+ARGUMENT_FORMATS = {'f': 'f', 'i': 'i'}
+
+
+def oscString(text):
+  """Return text as a null terminated OSC string padded to a multiple of 4 bytes."""
+  data = text.encode('ascii') if not isinstance(text, bytes) else text
+  return data + b'\x00' * (4 - len(data) % 4)
+
+
+class OSCMessageEncoder(object):
+  """Encoder for one fixed OSC message shape (address and argument types).
+
+  The padded address and type tag string are computed once and copied into a
+  preallocated bytearray. Encoding only writes the arguments in place, so the
+  returned buffer is reused and must be sent before the next encode call.
+  """
+
+  def __init__(self, address, typeTags='f'):
+    for tag in typeTags:
+      if tag not in ARGUMENT_FORMATS:
+        raise ValueError('Unsupported OSC type tag: %s' % tag)
+    self.address = address
+    self.typeTags = typeTags
+    self.header = oscString(address) + oscString(',' + typeTags)
+    self.argumentStruct = struct.Struct('>' + ''.join(ARGUMENT_FORMATS[tag] for tag in typeTags))
+    self.size = len(self.header) + self.argumentStruct.size
+    self.buffer = bytearray(self.size)
+    self.writeHeader(self.buffer, 0)
+
+  def writeHeader(self, buffer, offset):
+    buffer[offset:offset + len(self.header)] = self.header
+
+  def packInto(self, buffer, offset, values):
+    """Write the arguments of a message whose header is already at offset."""
+    self.argumentStruct.pack_into(buffer, offset + len(self.header), *values)
+
+  def encode(self, values):
+    self.argumentStruct.pack_into(self.buffer, len(self.header), *values)
+    return self.buffer
+
+
+class OSCBundleEncoder(object):
+  """Encoder for a fixed OSC bundle made of several message shapes.
+
+  Used to send all the values of one tracking frame as a single datagram.
+  """
+
+  def __init__(self, messageEncoders):
+    self.messageEncoders = list(messageEncoders)
+    self.size = len(BUNDLE_TAG) + len(IMMEDIATELY) + sum(4 + encoder.size for encoder in self.messageEncoders)
+    self.buffer = bytearray(self.size)
+    self.buffer[0:16] = BUNDLE_TAG + IMMEDIATELY
+    self.offsets = []
+    offset = 16
+    for encoder in self.messageEncoders:
+      struct.pack_into('>i', self.buffer, offset, encoder.size)
+      offset += 4
+      encoder.writeHeader(self.buffer, offset)
+      self.offsets.append(offset)
+      offset += encoder.size
+
+  def encode(self, valuesList):
+    """Encode one bundle. valuesList holds one argument sequence per message."""
+    for encoder, offset, values in zip(self.messageEncoders, self.offsets, valuesList):
+      encoder.packInto(self.buffer, offset, values)
+    return self.buffer
+
+
+class FixedShapeEncoder(object):
+  """Callable (address, values) -> bytes that caches one encoder per message shape.
+
+  Floats are encoded as 'f' and integers (including NumPy integers) as 'i',
+  as pyOSC does.
+  """
+
+  def __init__(self):
+    self.encoders = {}
+
+  def __call__(self, address, values):
+    typeTags = ''.join('i' if isinstance(value, numbers.Integral) else 'f' for value in values)
+    encoder = self.encoders.get((address, typeTags))
+    if encoder is None:
+      encoder = OSCMessageEncoder(address, typeTags)
+      self.encoders[(address, typeTags)] = encoder
+    return encoder.encode(values)
+
+
+def _readString(data, offset):
+  end = data.index(b'\x00', offset)
+  return data[offset:end].decode('ascii'), end + 4 - (end - offset) % 4
+
+
+def decodePacket(data):
+  """Decode an OSC message or bundle into a list of (address, values) tuples.
+
+  Supports the 'f', 'i' and 's' argument types; used by test receivers.
+  """
+  data = bytes(data)
+  if data.startswith(BUNDLE_TAG):
+    messages = []
+    offset = 16
+    while offset < len(data):
+      size = struct.unpack_from('>i', data, offset)[0]
+      messages.extend(decodePacket(data[offset + 4:offset + 4 + size]))
+      offset += 4 + size
+    return messages
+  address, offset = _readString(data, 0)
+  typeTags, offset = _readString(data, offset)
+  values = []
+  for tag in typeTags[1:]:
+    if tag == 's':
+      value, offset = _readString(data, offset)
+    else:
+      value = struct.unpack_from('>' + tag, data, offset)[0]
+      offset += 4
+    values.append(value)
+  return [(address, values)]
@@ -0,0 +1,233 @@
+"""Round-trip latency and loss of the OSC path to the sound engine.
+
+OSCLink sends sequence numbered probe frames (<address> seq values...) next to
+the guidance messages and listens for acknowledgements (<ackAddress> seq) on
+its local port. The Pd patch (test_incoming_OSC.pd: routeOSC /dumpOSC/probe,
+packOSC and udpsend connected to the Slicer computer on port 7401) answers by
+sending the sequence number back to that port once it has processed the
+frame; EchoServer does the same locally for testing without Pd. A patch
+without that echo never acknowledges anything, which summary() reports as
+ackSupported False rather than as loss.
+
+Both run an asyncio event loop in a background thread, so neither the probes
+nor the receive path touch the Qt main thread. Requires Python 3.
+"""
+
+import asyncio
+import collections
+import struct
+import threading
+
+import numpy as np
+
+from .OSCEncoder import FixedShapeEncoder, decodePacket
+from .UpdateScheduler import monotonicClock
+
+PROBE_ADDRESS = '/dumpOSC/probe'
+ACK_ADDRESS = '/dumpOSC/ack'
+# Pd echoes the sequence number as a 32 bit float, exact up to 2**24
+SEQUENCE_MODULUS = 1 << 24
+
+
+class LinkStatistics(object):
+  """Rolling round-trip times of the last windowSize acknowledged frames and loss counts."""
+
+  def __init__(self, windowSize=256):
+    self.roundTripTimes = np.zeros(windowSize)
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self.lock:
+      self.count = 0
+      self.index = 0
+      self.sent = 0
+      self.acknowledged = 0
+      self.lost = 0
+
+  def addSent(self):
+    with self.lock:
+      self.sent += 1
+
+  def addRoundTrip(self, roundTripTime):
+    with self.lock:
+      self.roundTripTimes[self.index] = roundTripTime
+      self.index = (self.index + 1) % len(self.roundTripTimes)
+      self.count = min(self.count + 1, len(self.roundTripTimes))
+      self.acknowledged += 1
+
+  def addLost(self, count):
+    with self.lock:
+      self.lost += count
+
+  def summary(self):
+    """Round-trip percentiles and maximum (ms) over the window, and the loss ratio."""
+    with self.lock:
+      roundTripTimes = self.roundTripTimes[0:self.count] * 1000.0
+      sent, acknowledged, lost = self.sent, self.acknowledged, self.lost
+    result = {'sent': sent, 'acknowledged': acknowledged, 'lost': lost,
+      'loss': float(lost) / (acknowledged + lost) if acknowledged + lost else 0.0,
+      # Frames timed out without a single acknowledgement: the receiver does not echo them
+      'ackSupported': bool(acknowledged or not lost)}
+    if len(roundTripTimes):
+      result['p50'] = float(np.percentile(roundTripTimes, 50))
+      result['p99'] = float(np.percentile(roundTripTimes, 99))
+      result['max'] = float(roundTripTimes.max())
+    return result
+
+
+class _EventLoopThread(object):
+  """asyncio event loop running in a daemon thread with one datagram endpoint."""
+
+  def __init__(self, name):
+    self.name = name
+    self.loop = None
+    self.thread = None
+    self.transport = None
+
+  def startLoop(self, protocolFactory, localAddress):
+    self.loop = asyncio.new_event_loop()
+    ready = threading.Event()
+    errors = []
+
+    def run():
+      asyncio.set_event_loop(self.loop)
+      try:
+        self.transport, protocol = self.loop.run_until_complete(
+          self.loop.create_datagram_endpoint(protocolFactory, local_addr=localAddress))
+      except OSError as e:
+        errors.append(e)
+        ready.set()
+        return
+      ready.set()
+      self.loop.run_forever()
+      self.transport.close()
+      self.loop.run_until_complete(asyncio.sleep(0))
+      self.loop.close()
+
+    self.thread = threading.Thread(target=run, name=self.name)
+    self.thread.daemon = True
+    self.thread.start()
+    ready.wait()
+    if errors:
+      self.thread.join()
+      self.thread = None
+      raise errors[0]
+    return self.transport.get_extra_info('sockname')[1]
+
+  def stopLoop(self, timeout=1.0):
+    if not self.thread:
+      return
+    self.loop.call_soon_threadsafe(self.loop.stop)
+    self.thread.join(timeout)
+    self.thread = None
+
+  def isRunning(self):
+    return self.thread is not None
+
+
+class _LinkProtocol(asyncio.DatagramProtocol):
+
+  def __init__(self, handler):
+    self.handler = handler
+
+  def datagram_received(self, data, address):
+    self.handler(data, address)
+
+  def error_received(self, exception):
+    # ICMP errors (no receiver yet) show up as lost frames
+    pass
+
+
+class OSCLink(_EventLoopThread):
+  """Sends probe frames to host:port and matches the acknowledgements to them.
+
+  Frames not acknowledged within timeout seconds are counted as lost.
+  """
+
+  def __init__(self, host="192.168.0.70", port=7400, localPort=7401, address=PROBE_ADDRESS,
+      ackAddress=ACK_ADDRESS, timeout=1.0, clock=monotonicClock):
+    _EventLoopThread.__init__(self, 'OSCLink')
+    self.host = host
+    self.port = port
+    self.localPort = localPort
+    self.address = address
+    self.ackAddress = ackAddress
+    self.timeout = timeout
+    self.clock = clock
+    self.encoder = FixedShapeEncoder()
+    self.statistics = LinkStatistics()
+    self.sequence = 0
+    # Send times of the frames waiting for an acknowledgement, oldest first
+    self.pending = collections.OrderedDict()
+
+  def start(self):
+    if self.isRunning():
+      return
+    self.statistics.reset()
+    self.pending.clear()
+    self.localPort = self.startLoop(lambda: _LinkProtocol(self._received), ('0.0.0.0', self.localPort))
+
+  def stop(self, timeout=1.0):
+    self.stopLoop(timeout)
+
+  def sendFrame(self, values):
+    """Queue one probe frame from any thread. values are sent after the sequence number."""
+    if self.isRunning():
+      self.loop.call_soon_threadsafe(self._send, list(values))
+
+  def _send(self, values):
+    self.sequence = (self.sequence + 1) % SEQUENCE_MODULUS
+    now = self.clock()
+    self._expire(now)
+    self.pending[self.sequence] = now
+    self.transport.sendto(self.encoder(self.address, [self.sequence] + values), (self.host, self.port))
+    self.statistics.addSent()
+
+  def _received(self, data, address):
+    now = self.clock()
+    try:
+      messages = decodePacket(data)
+    except (struct.error, ValueError):
+      return
+    for messageAddress, values in messages:
+      if messageAddress != self.ackAddress or not values:
+        continue
+      sendTime = self.pending.pop(values[0], None)
+      if sendTime is not None:
+        self.statistics.addRoundTrip(now - sendTime)
+    self._expire(now)
+
+  def _expire(self, now):
+    expired = 0
+    while self.pending:
+      sequence, sendTime = next(iter(self.pending.items()))
+      if now - sendTime < self.timeout:
+        break
+      del self.pending[sequence]
+      expired += 1
+    if expired:
+      self.statistics.addLost(expired)
+
+
+class EchoServer(_EventLoopThread):
+  """Local stand-in for the Pd patch that acknowledges every probe frame to its sender."""
+
+  def __init__(self, port=0, address=PROBE_ADDRESS, ackAddress=ACK_ADDRESS):
+    _EventLoopThread.__init__(self, 'OSCEchoServer')
+    self.port = port
+    self.address = address
+    self.ackAddress = ackAddress
+    self.encoder = FixedShapeEncoder()
+
+  def start(self):
+    if not self.isRunning():
+      self.port = self.startLoop(lambda: _LinkProtocol(self._received), ('127.0.0.1', self.port))
+
+  def stop(self, timeout=1.0):
+    self.stopLoop(timeout)
+
+  def _received(self, data, address):
+    for messageAddress, values in decodePacket(data):
+      if messageAddress == self.address and values:
+        self.transport.sendto(self.encoder(self.ackAddress, [values[0]]), address)
@@ -0,0 +1,163 @@
+import collections
+import logging
+import socket
+import struct
+import threading
+
+from .OSCEncoder import FixedShapeEncoder
+
+
+def encodeBundle(bundleEncoder, valuesList):
+  return bundleEncoder.encode(valuesList)
+
+
+class OSCTransport(object):
+  """Long-lived UDP sender for OSC frames.
+
+  Owns a single non-blocking socket and a background worker thread. Frames are
+  handed over through a queue that holds the latest frame of each address (or
+  bundle): a new frame replaces a queued one for the same address, so the
+  caller (the tracker ModifiedEvent callback) never blocks and the receiver
+  always gets the most recent value of every address. Only when more than
+  maxQueueSize addresses are waiting is the oldest one dropped.
+
+  Each frame is encoded once and sent to every destination (several audio
+  clients in a teaching session) from the same socket. The worker drains all
+  queued frames per wake-up.
+  """
+
+  def __init__(self, host="192.168.0.70", port=7400, maxQueueSize=32, encoder=None):
+    # First destination, kept for the single receiver user interface
+    self.host = host
+    self.port = port
+    self.destinations = [(host, port)]
+    self.addresses = []
+    # Only used from the worker thread, so encoders may reuse their buffers
+    self.encoder = encoder if encoder else FixedShapeEncoder()
+    self.maxQueueSize = maxQueueSize
+    # Latest (encode, target, values) per address or bundle encoder, oldest first
+    self.queue = collections.OrderedDict()
+    self.condition = threading.Condition()
+    self.socket = None
+    self.worker = None
+    self.running = False
+    self.resetCounters()
+
+  def resetCounters(self):
+    self.framesQueued = 0
+    self.framesSent = 0
+    self.framesDropped = 0
+    self.sendErrors = 0
+
+  def getCounters(self):
+    return {
+      'queued': self.framesQueued,
+      'sent': self.framesSent,
+      'dropped': self.framesDropped,
+      'errors': self.sendErrors,
+      }
+
+  def setDestination(self, host, port):
+    """Send to a single receiver."""
+    self.setDestinations([(host, port)])
+
+  def setDestinations(self, destinations):
+    """Send every frame to all the (host, port) receivers."""
+    destinations = [(host, int(port)) for host, port in destinations]
+    with self.condition:
+      self.destinations = destinations
+      self.host, self.port = destinations[0] if destinations else (None, None)
+      if self.socket:
+        self._resolveDestinations()
+
+  def start(self):
+    if self.running:
+      return
+    self._connectSocket()
+    self.running = True
+    self.worker = threading.Thread(target=self._run, name='OSCTransport')
+    self.worker.daemon = True
+    self.worker.start()
+    logging.info('OSCTransport started, sending to %s' % ', '.join('%s:%d' % destination for destination in self.destinations))
+
+  def stop(self, timeout=1.0):
+    if not self.running:
+      return
+    with self.condition:
+      self.running = False
+      self.condition.notify()
+    self.worker.join(timeout)
+    self.worker = None
+    self.socket.close()
+    self.socket = None
+    logging.info('OSCTransport stopped (%s)' % self.getCounters())
+
+  def isRunning(self):
+    return self.running
+
+  def sendMessage(self, address, values):
+    """Queue one OSC message. Never blocks; replaces a queued message to the same address."""
+    self._enqueue(self.encoder, address, values)
+
+  def sendBundle(self, bundleEncoder, valuesList):
+    """Queue one OSC bundle built by an OSCBundleEncoder as a single datagram."""
+    self._enqueue(encodeBundle, bundleEncoder, valuesList)
+
+  def _enqueue(self, encode, target, values):
+    # Messages are keyed by their address, bundles by their encoder
+    key = target if isinstance(target, str) else id(target)
+    with self.condition:
+      if key in self.queue:
+        del self.queue[key]
+        self.framesDropped += 1
+      elif len(self.queue) == self.maxQueueSize:
+        self.queue.popitem(last=False)
+        self.framesDropped += 1
+      self.queue[key] = (encode, target, values)
+      self.framesQueued += 1
+      self.condition.notify()
+
+  def _connectSocket(self):
+    if self.socket:
+      self.socket.close()
+    self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # A full send buffer drops the datagram instead of stalling the worker
+    self.socket.setblocking(False)
+    self._resolveDestinations()
+
+  def _resolveDestinations(self):
+    # Host names are resolved once here, not for every datagram
+    self.addresses = [socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_DGRAM)[0][4]
+      for host, port in self.destinations]
+
+  def _run(self):
+    while True:
+      with self.condition:
+        while self.running and not self.queue:
+          self.condition.wait()
+        if not self.running:
+          return
+        frames = list(self.queue.values())
+        self.queue.clear()
+        sock = self.socket
+        addresses = self.addresses
+      for encode, target, values in frames:
+        try:
+          data = encode(target, values)
+        except (struct.error, ValueError, TypeError) as e:
+          # A value the encoder cannot pack (e.g. an int beyond 32 bits) only loses its own frame
+          self.sendErrors += 1
+          logging.error('OSCTransport could not encode %s %s: %s' % (target if isinstance(target, str) else 'bundle', values, e))
+          continue
+        sent = False
+        for address in addresses:
+          try:
+            sock.sendto(data, address)
+            sent = True
+          except (socket.error, OSError) as e:
+            # UDP send errors (e.g. a full send buffer) must not kill the worker
+            self.sendErrors += 1
+            logging.debug('OSCTransport send to %s failed: %s' % (address, e))
+        # Counted once per frame, whatever the number of receivers
+        if sent:
+          self.framesSent += 1
@@ -0,0 +1,314 @@
+"""Offline sonification of recorded guidance sessions into WAV files.
+
+The renderer takes a stream of (timestamps, distances) chunks, e.g. the tip to
+target distances of a session log, normalizes the distances like
+SoundGuidanceLogic.calculateDistance (distance / NORMALIZATION_DISTANCE, the
+value sent as /dumpOSC/0/0) and synthesizes the audio block by block with
+NumPy. Only the current block and the control points it needs are kept in
+memory, so an hour long session renders in constant memory, and a block costs
+a few vectorized operations per voice, far faster than real time.
+
+Voices turn the normalized distance of every sample into audio:
+  OscillatorVoice  phase continuous sine, square or saw whose pitch follows
+                   the distance; the default reproduces the pitch chain of
+                   test_incoming_OSC.pd (* 255, scale 35 42, C major, mtof)
+  SampleVoice      playback of sample arrays (e.g. Sound1.wav .. Sound5.wav
+                   of the patch), one sample per distance zone, restarted
+                   when the zone changes
+"""
+
+import wave
+
+import numpy as np
+
+from .GuidanceCore import NORMALIZATION_DISTANCE, distanceToTarget, normalizeDistance, tipPositions
+from .SessionLog import nodePoses
+
+DEFAULT_SAMPLE_RATE = 44100
+DEFAULT_BLOCK_SIZE = 8192
+
+# Scale degrees selected by "mod 7" in the Pd patch
+MAJOR_SCALE = (0, 2, 4, 5, 7, 9, 11)
+
+
+def midiToFrequency(notes):
+  """Same as the Pd mtof object."""
+  return 440.0 * 2.0 ** ((np.asarray(notes, dtype=float) - 69.0) / 12.0)
+
+
+def patchPitch(normalizedDistances, lowStep=35, highStep=42, scale=MAJOR_SCALE):
+  """Frequencies (Hz) of the pitch chain of test_incoming_OSC.pd.
+
+  The value is multiplied by 255, scaled from [0, 255] to scale steps
+  [lowStep, highStep] and truncated; "div 7" gives the octave and "mod 7" the
+  degree of the scale, so the default goes from C4 at the target to C5 at
+  the normalization distance.
+  """
+  values = np.clip(normalizedDistances, 0.0, 1.0)
+  steps = np.floor(lowStep + (highStep - lowStep) * values).astype(int)
+  octaves, degrees = np.divmod(steps, len(scale))
+  return midiToFrequency(12 * octaves + np.asarray(scale)[degrees])
+
+
+def readWaveFile(path):
+  """Mono float samples in [-1, 1] and the sample rate of an 8, 16, 24 or 32 bit PCM WAV file."""
+  with wave.open(path, 'rb') as waveFile:
+    channels = waveFile.getnchannels()
+    sampleWidth = waveFile.getsampwidth()
+    sampleRate = waveFile.getframerate()
+    data = waveFile.readframes(waveFile.getnframes())
+  if sampleWidth == 1:
+    samples = (np.frombuffer(data, dtype=np.uint8).astype(np.float32) - 128.0) / 128.0
+  elif sampleWidth == 3:
+    raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+    padded = np.zeros((len(raw), 4), dtype=np.uint8)
+    padded[:, 1:4] = raw
+    samples = padded.view('<i4').ravel().astype(np.float32) / 2.0 ** 31
+  elif sampleWidth in (2, 4):
+    samples = np.frombuffer(data, dtype='<i%d' % sampleWidth).astype(np.float32) / 2.0 ** (8 * sampleWidth - 1)
+  else:
+    raise ValueError('%s: unsupported sample width %d' % (path, sampleWidth))
+  return samples.reshape(-1, channels).mean(axis=1), sampleRate
+
+
+class WaveWriter(object):
+  """16 bit mono WAV file written block by block."""
+
+  def __init__(self, path, sampleRate=DEFAULT_SAMPLE_RATE):
+    self.waveFile = wave.open(path, 'wb')
+    self.waveFile.setnchannels(1)
+    self.waveFile.setsampwidth(2)
+    self.waveFile.setframerate(sampleRate)
+    self.sampleCount = 0
+
+  def write(self, samples):
+    """Append float samples, clipped to [-1, 1]."""
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767.0).astype('<i2')
+    self.waveFile.writeframes(pcm.tobytes())
+    self.sampleCount += len(pcm)
+
+  def close(self):
+    self.waveFile.close()
+
+
+class OscillatorVoice(object):
+  """Oscillator whose frequency is a function of the normalized distance.
+
+  frequency maps an array of normalized distances to Hz (patchPitch by
+  default). With a beep rate range (nearRate, farRate) in Hz the tone is
+  gated on and off, faster close to the target.
+  """
+
+  WAVEFORMS = ('sine', 'square', 'saw')
+
+  def __init__(self, frequency=patchPitch, waveform='sine', amplitude=0.5, beepRates=None, dutyCycle=0.5):
+    if waveform not in self.WAVEFORMS:
+      raise ValueError('Unknown waveform %s' % waveform)
+    self.frequency = frequency
+    self.waveform = waveform
+    self.amplitude = amplitude
+    self.beepRates = beepRates
+    self.dutyCycle = dutyCycle
+    self.reset()
+
+  def reset(self):
+    self.phase = 0.0
+    self.beepPhase = 0.0
+
+  def render(self, normalizedDistances, sampleRate):
+    increments = self.frequency(normalizedDistances) / float(sampleRate)
+    phases, self.phase = _accumulatePhase(self.phase, increments)
+    if self.waveform == 'sine':
+      block = np.sin(2.0 * np.pi * phases)
+    elif self.waveform == 'square':
+      block = np.where(phases < 0.5, 1.0, -1.0)
+    else:
+      block = 2.0 * phases - 1.0
+    block *= self.amplitude
+    if self.beepRates is not None:
+      nearRate, farRate = self.beepRates
+      rates = farRate + (nearRate - farRate) * (1.0 - np.clip(normalizedDistances, 0.0, 1.0))
+      beepPhases, self.beepPhase = _accumulatePhase(self.beepPhase, rates / float(sampleRate))
+      block *= beepPhases < self.dutyCycle
+    return block
+
+
+class SampleVoice(object):
+  """Sample playback selected by distance zone.
+
+  samples is a list of float arrays and zoneEdges the normalized distances
+  where the zones change (len(samples) - 1 increasing values): zone i covers
+  [zoneEdges[i - 1], zoneEdges[i]). A sample starts from the beginning when
+  its zone is entered and loops while the tip stays in the zone, or plays
+  once when loop is False.
+  """
+
+  def __init__(self, samples, zoneEdges=(), amplitude=0.5, loop=True):
+    if len(zoneEdges) != len(samples) - 1:
+      raise ValueError('%d samples need %d zone edges' % (len(samples), len(samples) - 1))
+    self.lengths = np.array([len(sample) for sample in samples])
+    if not self.lengths.all():
+      raise ValueError('Empty sample')
+    # Padded to a (zones, longest) table so that one fancy index reads every zone
+    self.table = np.zeros((len(samples), self.lengths.max()), dtype=np.float32)
+    for index, sample in enumerate(samples):
+      self.table[index, 0:len(sample)] = sample
+    self.zoneEdges = np.asarray(zoneEdges, dtype=float)
+    self.amplitude = amplitude
+    self.loop = loop
+    self.reset()
+
+  @classmethod
+  def fromWaveFiles(cls, paths, zoneEdges=(), sampleRate=DEFAULT_SAMPLE_RATE, **kwargs):
+    samples = []
+    for path in paths:
+      sample, fileSampleRate = readWaveFile(path)
+      if fileSampleRate != sampleRate:
+        # Linear resampling is enough for cue sounds
+        sampleTimes = np.arange(int(len(sample) * float(sampleRate) / fileSampleRate)) / float(sampleRate)
+        sample = np.interp(sampleTimes, np.arange(len(sample)) / float(fileSampleRate), sample)
+      samples.append(sample)
+    return cls(samples, zoneEdges, **kwargs)
+
+  def reset(self):
+    self.zone = -1
+    self.position = 0
+
+  def render(self, normalizedDistances, sampleRate):
+    zones = np.searchsorted(self.zoneEdges, normalizedDistances, side='right')
+    count = len(zones)
+    # Samples since the last zone change, continuing the position of the previous block
+    changes = np.flatnonzero(np.diff(np.concatenate(([self.zone], zones))))
+    starts = np.zeros(count, dtype=np.int64)
+    starts[changes] = changes
+    sampleIndices = np.arange(count)
+    positions = sampleIndices - np.maximum.accumulate(starts)
+    if not len(changes) or changes[0]:
+      positions[0:changes[0] if len(changes) else count] += self.position
+    lengths = self.lengths[zones]
+    if self.loop:
+      block = self.table[zones, positions % lengths]
+    else:
+      block = np.where(positions < lengths, self.table[zones, np.minimum(positions, lengths - 1)], 0.0)
+    if count:
+      self.zone = zones[-1]
+      self.position = positions[-1] + 1
+    return self.amplitude * block
+
+
+def _accumulatePhase(startPhase, increments):
+  """Phases in [0, 1) before each sample and the phase after the block."""
+  phases = np.cumsum(increments)
+  endPhase = (startPhase + phases[-1]) % 1.0 if len(phases) else startPhase
+  phases -= increments
+  phases += startPhase
+  return phases % 1.0, endPhase
+
+
+class OfflineRenderer(object):
+  """Renders distance streams to WAV with a list of voices mixed together.
+
+  Control points are linearly interpolated to the sample rate (the patch
+  receives them as messages, interpolate=False holds each value until the
+  next one like Pd does). The output covers the stream from its first to its
+  last timestamp.
+  """
+
+  def __init__(self, voices, sampleRate=DEFAULT_SAMPLE_RATE, blockSize=DEFAULT_BLOCK_SIZE,
+      maxDistance=NORMALIZATION_DISTANCE, gain=1.0, interpolate=True):
+    self.voices = list(voices)
+    self.sampleRate = sampleRate
+    self.blockSize = blockSize
+    self.maxDistance = maxDistance
+    self.gain = gain
+    self.interpolate = interpolate
+
+  def renderBlocks(self, distanceChunks):
+    """Generator of float sample blocks for an iterable of (timestamps, distances) chunks."""
+    for voice in self.voices:
+      voice.reset()
+    times = np.zeros(0)
+    values = np.zeros(0)
+    startTime = None
+    sampleIndex = 0
+    for chunkTimes, chunkDistances in distanceChunks:
+      if not len(chunkTimes):
+        continue
+      if startTime is None:
+        startTime = float(chunkTimes[0])
+      times = np.concatenate((times, np.asarray(chunkTimes, dtype=float) - startTime))
+      values = np.concatenate((values, normalizeDistance(chunkDistances, self.maxDistance)))
+      endSample = int(times[-1] * self.sampleRate) + 1
+      while sampleIndex < endSample:
+        count = min(self.blockSize, endSample - sampleIndex)
+        sampleTimes = (sampleIndex + np.arange(count)) / float(self.sampleRate)
+        yield self._mix(self._controlValues(sampleTimes, times, values))
+        sampleIndex += count
+      # Keep the last control point before the next sample for interpolation
+      keep = max(np.searchsorted(times, sampleIndex / float(self.sampleRate), side='right') - 1, 0)
+      times = times[keep:]
+      values = values[keep:]
+
+  def render(self, distanceChunks, path):
+    """Write the rendered stream to a WAV file. Returns the number of samples."""
+    writer = WaveWriter(path, self.sampleRate)
+    try:
+      for block in self.renderBlocks(distanceChunks):
+        writer.write(block)
+    finally:
+      writer.close()
+    return writer.sampleCount
+
+  def _controlValues(self, sampleTimes, times, values):
+    if self.interpolate:
+      return np.interp(sampleTimes, times, values)
+    return values[np.maximum(np.searchsorted(times, sampleTimes, side='right') - 1, 0)]
+
+  def _mix(self, normalizedDistances):
+    block = np.zeros(len(normalizedDistances))
+    for voice in self.voices:
+      block += voice.render(normalizedDistances, self.sampleRate)
+    block *= self.gain
+    return block
+
+
+def arrayDistanceChunks(timestamps, distances, chunkSize=65536):
+  """(timestamps, distances) chunks of in-memory or memory mapped arrays."""
+  for start in range(0, len(timestamps), chunkSize):
+    yield timestamps[start:start + chunkSize], distances[start:start + chunkSize]
+
+
+def sessionDistanceChunks(reader, targetPoint=None, tipNodeName='PointerToTracker', tipOffset=None,
+    referenceNodeName=None, chunkSize=65536, tipMatrixKey='pointerTipMatrix'):
+  """(timestamps, distances) chunks of the tip to target distance of a session log.
+
+  The tip is tipOffset (the translation of PointerTipToPointer) in the
+  coordinates of tipNodeName, by default the calibration stored under
+  tipMatrixKey in the session metadata. With referenceNodeName (e.g.
+  ReferenceToTracker) the tip is expressed relative to the latest pose of that
+  node, as the fiducials are when they move with the reference; it defaults to
+  the referenceNode the metadata fiducials are stored in. targetPoint defaults
+  to the target stored in the session metadata. Records are read chunkSize at
+  a time from the memory map.
+  """
+  if targetPoint is None:
+    if 'target' not in reader.metadata:
+      raise ValueError('%s has no target point, pass targetPoint' % reader.path)
+    targetPoint = reader.metadata['target']
+  tipNode = reader.nodeNames.index(tipNodeName)
+  referenceNodeName = referenceNodeName or reader.metadata.get('referenceNode')
+  if referenceNodeName and referenceNodeName not in reader.nodeNames:
+    raise ValueError('%s has no %s poses to relate the target to' % (reader.path, referenceNodeName))
+  referenceNode = reader.nodeNames.index(referenceNodeName) if referenceNodeName else None
+  if tipOffset is None:
+    # Sessions recorded before the calibration was stored use the tracked pose itself
+    tipMatrix = reader.metadataMatrix(tipMatrixKey)
+  else:
+    tipMatrix = np.identity(4)
+    tipMatrix[0:3, 3] = tipOffset
+  referenceInverse = None
+  for start in range(0, len(reader.records), chunkSize):
+    timestamps, poses, referenceInverse = nodePoses(reader.records[start:start + chunkSize], tipNode, tipMatrix,
+      referenceNode, referenceInverse)
+    if len(timestamps):
+      yield timestamps, distanceToTarget(tipPositions(poses), targetPoint)
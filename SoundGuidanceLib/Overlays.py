@@ -0,0 +1,163 @@
+import numpy as np
+import slicer
+import vtk
+from vtk.util import numpy_support
+
+
+class OverlayRegistry(object):
+  """Owns the guidance overlay model nodes and the observers of the module.
+
+  Each overlay and observer is created once under a name and reused on later
+  requests, so re-running the guidance setup does not add scene nodes or
+  duplicate callbacks. A model node already in the scene under that name (left
+  by another logic instance or a module reload) is reused too. cleanup()
+  removes every model node it handed out.
+  """
+
+  def __init__(self):
+    self.modelNodes = {}
+    self.observations = {}
+
+  def getModelNode(self, name, color, sliceIntersectionVisibility=True, backfaceCulling=True):
+    """Model node with a polydata and a display node, found in the scene by name or created on first use."""
+    modelNode = self.modelNodes.get(name)
+    if modelNode:
+      return modelNode
+    modelNode = slicer.mrmlScene.GetFirstNodeByName(name)
+    if modelNode and modelNode.IsA('vtkMRMLModelNode') and modelNode.GetDisplayNode():
+      if not modelNode.GetPolyData():
+        modelNode.SetAndObservePolyData(vtk.vtkPolyData())
+      self.modelNodes[name] = modelNode
+      return modelNode
+    modelNode = slicer.vtkMRMLModelNode()
+    modelNode.SetName(name)
+    modelNode.SetAndObservePolyData(vtk.vtkPolyData())
+    modelDisplay = slicer.vtkMRMLModelDisplayNode()
+    modelDisplay.SetSliceIntersectionVisibility(sliceIntersectionVisibility)
+    modelDisplay.SetBackfaceCulling(backfaceCulling)
+    modelDisplay.SetColor(*color)
+    slicer.mrmlScene.AddNode(modelDisplay)
+    modelNode.SetAndObserveDisplayNodeID(modelDisplay.GetID())
+    slicer.mrmlScene.AddNode(modelNode)
+    self.modelNodes[name] = modelNode
+    return modelNode
+
+  def observe(self, key, node, event, callback):
+    """Add an observer unless the same node is already observed under key."""
+    observation = self.observations.get(key)
+    if observation and observation[0] == node:
+      return
+    self.removeObserver(key)
+    self.observations[key] = (node, node.AddObserver(event, callback))
+
+  def removeObserver(self, key):
+    observation = self.observations.pop(key, None)
+    if observation:
+      observation[0].RemoveObserver(observation[1])
+
+  def cleanup(self):
+    for key in list(self.observations):
+      self.removeObserver(key)
+    for modelNode in self.modelNodes.values():
+      displayNode = modelNode.GetDisplayNode()
+      if displayNode:
+        slicer.mrmlScene.RemoveNode(displayNode)
+      slicer.mrmlScene.RemoveNode(modelNode)
+    self.modelNodes = {}
+
+
+class PlaneOverlay(object):
+  """Square plane model computed in closed form from a point and a normal.
+
+  The polydata comes from one vtkPlaneSource that is updated in place, so
+  the cost does not depend on the scene and repeated updates reuse the node.
+  """
+
+  def __init__(self, registry, name, color):
+    self.registry = registry
+    self.name = name
+    self.color = color
+    self.planeSource = vtk.vtkPlaneSource()
+    self.modelNode = None
+
+  def update(self, corners):
+    """Set the plane from (origin, point1, point2) as returned by planeQuadCorners."""
+    origin, point1, point2 = corners
+    self.planeSource.SetOrigin(*origin)
+    self.planeSource.SetPoint1(*point1)
+    self.planeSource.SetPoint2(*point2)
+    if not self.modelNode:
+      self.modelNode = self.registry.getModelNode(self.name, self.color, sliceIntersectionVisibility=False, backfaceCulling=False)
+      self.modelNode.SetPolyDataConnection(self.planeSource.GetOutputPort())
+    self.planeSource.Update()
+
+
+class PolylineOverlay(object):
+  """Polyline model with a fixed number of points backed by a NumPy array.
+
+  The vtkPoints share the memory of pointArray and the connectivity is built
+  once, so an update only writes coordinates and marks the data modified.
+  """
+
+  def __init__(self, registry, name, color, numberOfPoints):
+    self.modelNode = registry.getModelNode(name, color)
+    self.pointArray = np.zeros((numberOfPoints, 3))
+    # pointArray must outlive the VTK array that wraps it, it is kept on self
+    self.points = vtk.vtkPoints()
+    self.points.SetData(numpy_support.numpy_to_vtk(self.pointArray, deep=False))
+    lines = vtk.vtkCellArray()
+    lines.InsertNextCell(numberOfPoints)
+    for pointIndex in range(numberOfPoints):
+      lines.InsertCellPoint(pointIndex)
+    polyData = self.modelNode.GetPolyData()
+    polyData.SetPoints(self.points)
+    polyData.SetLines(lines)
+
+  def modified(self):
+    self.points.Modified()
+    self.modelNode.GetPolyData().Modified()
+
+  def setVisible(self, visible):
+    self.modelNode.GetDisplayNode().SetVisibility(visible)
+
+
+class LineOverlay(PolylineOverlay):
+  """Two point line, e.g. from the tool tip to the target."""
+
+  def __init__(self, registry, name, color):
+    PolylineOverlay.__init__(self, registry, name, color, 2)
+
+  def setEndpoints(self, point1, point2):
+    self.pointArray[0] = point1[0:3]
+    self.pointArray[1] = point2[0:3]
+    self.modified()
+
+
+class TrailOverlay(PolylineOverlay):
+  """Polyline through the most recent positions of the tool tip.
+
+  Positions go into a fixed size ring buffer and are copied in chronological
+  order into the point array, two slice copies per update.
+  """
+
+  def __init__(self, registry, name, color, length):
+    PolylineOverlay.__init__(self, registry, name, color, length)
+    self.history = np.zeros((length, 3))
+    self.nextIndex = 0
+    self.empty = True
+
+  def addPosition(self, position):
+    if self.empty:
+      # Start as a degenerate polyline at the first position
+      self.history[:] = position[0:3]
+      self.empty = False
+    self.history[self.nextIndex] = position[0:3]
+    self.nextIndex = (self.nextIndex + 1) % len(self.history)
+    oldestCount = len(self.history) - self.nextIndex
+    self.pointArray[0:oldestCount] = self.history[self.nextIndex:]
+    self.pointArray[oldestCount:] = self.history[0:self.nextIndex]
+    self.modified()
+
+  def clear(self):
+    self.empty = True
+    self.nextIndex = 0
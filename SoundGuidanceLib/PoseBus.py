@@ -0,0 +1,164 @@
+"""Shared memory ring buffer with the guidance frames for local processes.
+
+The logic publishes every frame (tip and target positions, distance and
+normalized distance) into a named shared memory block, so loggers, a second
+visualization or a local audio engine on the same workstation read them
+without sockets. The block starts with a small header followed by a ring of
+FRAME_DTYPE records:
+
+  header: magic, capacity, last published sequence number
+  frames: capacity records, frame n is stored at index n % capacity
+
+Each record is a sequence lock: its sequence field is 2n - 1 (odd) while
+frame n is written and 2n once it is complete. Readers read the field before
+and after copying the record and only keep the copy when both are 2n, so a
+frame overwritten under them is retried (latest) or counted as missed
+(readNew), never returned torn. Frames returned to readers carry n.
+Publishing costs the same whatever the number of readers.
+Requires Python 3.8 (multiprocessing.shared_memory).
+"""
+
+import sys
+
+import numpy as np
+from multiprocessing import shared_memory
+
+MAGIC = b'SGBUS002'
+DEFAULT_NAME = 'SoundGuidancePoseBus'
+
+HEADER_DTYPE = np.dtype([('magic', 'S8'), ('capacity', '<u8'), ('sequence', '<u8')])
+
+FRAME_DTYPE = np.dtype([
+  ('sequence', '<u8'),
+  ('timestamp', '<f8'),
+  ('tip', '<f8', (3,)),
+  ('target', '<f8', (3,)),
+  ('distance', '<f8'),
+  ('normalizedDistance', '<f8'),
+  ])
+
+# Every field is 8 bytes wide, so the values after the sequence number can be
+# written as one slice of a float64 view of the record
+FRAME_VALUES = FRAME_DTYPE.itemsize // 8 - 1
+
+
+def _mapBlock(buffer, capacity):
+  header = np.ndarray((), dtype=HEADER_DTYPE, buffer=buffer)
+  frames = np.ndarray((capacity,), dtype=FRAME_DTYPE, buffer=buffer, offset=HEADER_DTYPE.itemsize)
+  return header, frames
+
+
+class PoseBusWriter(object):
+  """Creates the shared memory block and publishes frames into it."""
+
+  def __init__(self, name=DEFAULT_NAME, capacity=1024):
+    size = HEADER_DTYPE.itemsize + capacity * FRAME_DTYPE.itemsize
+    try:
+      self.memory = shared_memory.SharedMemory(name=name, create=True, size=size)
+    except FileExistsError:
+      # Left over by a session that was not closed, e.g. after a crash
+      stale = shared_memory.SharedMemory(name=name)
+      stale.close()
+      stale.unlink()
+      self.memory = shared_memory.SharedMemory(name=name, create=True, size=size)
+    self.name = name
+    self.capacity = capacity
+    self.header, self.frames = _mapBlock(self.memory.buf, capacity)
+    self.header['capacity'] = capacity
+    self.header['sequence'] = 0
+    self.frames[:] = np.zeros(1, dtype=FRAME_DTYPE)
+    self.header['magic'] = MAGIC
+    self.frameSequences = self.frames['sequence']
+    self.frameValues = np.ndarray((capacity, FRAME_VALUES), dtype='<f8', buffer=self.memory.buf,
+      offset=HEADER_DTYPE.itemsize + 8, strides=(FRAME_DTYPE.itemsize, 8))
+    self.headerSequence = self.header['sequence'].reshape(1)
+    self.values = np.zeros(FRAME_VALUES)
+    self.sequence = 0
+
+  def publish(self, timestamp, tipPosition, targetPosition, distance, normalizedDistance):
+    values = self.values
+    values[0] = timestamp
+    values[1:4] = tipPosition[0:3]
+    values[4:7] = targetPosition[0:3]
+    values[7] = distance
+    values[8] = normalizedDistance
+    self.sequence += 1
+    index = self.sequence % self.capacity
+    self.frameSequences[index] = 2 * self.sequence - 1
+    self.frameValues[index] = values
+    self.frameSequences[index] = 2 * self.sequence
+    self.headerSequence[0] = self.sequence
+    return self.sequence
+
+  def close(self):
+    self.header = self.frames = self.frameSequences = self.frameValues = self.headerSequence = None
+    self.memory.close()
+    self.memory.unlink()
+
+
+class PoseBusReader(object):
+  """Attaches to a published bus. frames is a zero-copy view of the ring."""
+
+  def __init__(self, name=DEFAULT_NAME):
+    if sys.version_info >= (3, 13):
+      self.memory = shared_memory.SharedMemory(name=name, track=False)
+    else:
+      self.memory = shared_memory.SharedMemory(name=name)
+      # Otherwise the resource tracker unlinks the writer's block when this process exits
+      from multiprocessing import resource_tracker
+      resource_tracker.unregister(self.memory._name, 'shared_memory')
+    header = np.ndarray((), dtype=HEADER_DTYPE, buffer=self.memory.buf)
+    if bytes(header['magic']) != MAGIC:
+      self.memory.close()
+      raise ValueError('Shared memory block %s is not a SoundGuidance pose bus' % name)
+    self.capacity = int(header['capacity'])
+    self.header, self.frames = _mapBlock(self.memory.buf, self.capacity)
+    self.frameSequences = self.frames['sequence']
+    self.lastSequence = int(self.header['sequence'])
+    self.missedFrames = 0
+
+  def latestSequence(self):
+    return int(self.header['sequence'])
+
+  def latest(self):
+    """Copy of the most recent complete frame, None before the first one."""
+    while True:
+      sequence = int(self.header['sequence'])
+      if not sequence:
+        return None
+      index = sequence % self.capacity
+      before = int(self.frameSequences[index])
+      frame = self.frames[index].copy()
+      after = int(self.frameSequences[index])
+      if before == after == 2 * sequence:
+        frame['sequence'] = sequence
+        return frame
+      # Being written or overwritten while copying, the header already points to a newer frame
+
+  def readNew(self):
+    """Frames published since the previous call, oldest first (copies).
+
+    When a reader falls more than capacity frames behind, the oldest ones are
+    lost; their number is added to missedFrames.
+    """
+    sequence = int(self.header['sequence'])
+    firstSequence = max(self.lastSequence + 1, sequence - self.capacity + 1)
+    self.missedFrames += firstSequence - self.lastSequence - 1
+    self.lastSequence = sequence
+    if firstSequence > sequence:
+      return np.zeros(0, dtype=FRAME_DTYPE)
+    sequences = np.arange(firstSequence, sequence + 1)
+    indices = sequences % self.capacity
+    before = self.frameSequences[indices]
+    frames = self.frames[indices]
+    after = self.frameSequences[indices]
+    # A record changed during the copy now holds a newer frame, the one asked for is lost
+    complete = (before == 2 * sequences) & (after == 2 * sequences)
+    self.missedFrames += int(len(frames) - np.count_nonzero(complete))
+    frames = frames[complete]
+    frames['sequence'] //= 2
+    return frames
+
+  def close(self):
+    self.header = self.frames = self.frameSequences = None
+    self.memory.close()
@@ -0,0 +1,86 @@
+"""Smoothing and latency compensation of the tool tip position.
+
+A One Euro filter (Casiez et al., CHI 2012) removes tracker jitter at low
+speed while following fast movements without lag. The velocity is fitted over
+a short ring buffer of filtered positions and used to predict the position a
+configurable time ahead, compensating the tracker, network and sound engine
+latency.
+"""
+
+import math
+
+import numpy as np
+
+
+def smoothingFactor(cutoff, timeStep):
+  tau = 1.0 / (2.0 * math.pi * cutoff)
+  return 1.0 / (1.0 + tau / timeStep)
+
+
+class PoseFilter(object):
+
+  def __init__(self, minCutoff=1.0, beta=0.05, derivativeCutoff=1.0, predictionTime=0.0, historyLength=8):
+    self.minCutoff = minCutoff
+    self.beta = beta
+    self.derivativeCutoff = derivativeCutoff
+    self.predictionTime = predictionTime
+    self.historyTimes = np.zeros(historyLength)
+    self.historyPositions = np.zeros((historyLength, 3))
+    self.position = np.zeros(3)
+    self.derivative = np.zeros(3)
+    self.velocity = np.zeros(3)
+    self.predictedPosition = np.zeros(3)
+    self.reset()
+
+  def reset(self):
+    self.lastTime = None
+    self.historyCount = 0
+    self.historyIndex = 0
+    self.derivative[:] = 0.0
+    self.velocity[:] = 0.0
+
+  def filter(self, position, timestamp):
+    """Add a raw tip position. Returns (predictedPosition, velocity in mm/s)."""
+    position = np.asarray(position, dtype=float)[0:3]
+    if self.lastTime is None:
+      self.position[:] = position
+      self.lastTime = timestamp
+    elif timestamp > self.lastTime:
+      timeStep = timestamp - self.lastTime
+      self.lastTime = timestamp
+      derivativeAlpha = smoothingFactor(self.derivativeCutoff, timeStep)
+      self.derivative += derivativeAlpha * ((position - self.position) / timeStep - self.derivative)
+      cutoff = self.minCutoff + self.beta * np.linalg.norm(self.derivative)
+      self.position += smoothingFactor(cutoff, timeStep) * (position - self.position)
+
+    self.historyTimes[self.historyIndex] = timestamp
+    self.historyPositions[self.historyIndex] = self.position
+    self.historyIndex = (self.historyIndex + 1) % len(self.historyTimes)
+    self.historyCount = min(self.historyCount + 1, len(self.historyTimes))
+    self._fitVelocity()
+
+    self.predictedPosition[:] = self.position + self.velocity * self.predictionTime
+    return self.predictedPosition, self.velocity
+
+  def _fitVelocity(self):
+    # Least squares slope of the filtered positions in the ring buffer
+    if self.historyCount < 2:
+      self.velocity[:] = 0.0
+      return
+    times = self.historyTimes[0:self.historyCount]
+    positions = self.historyPositions[0:self.historyCount]
+    centeredTimes = times - np.mean(times)
+    denominator = np.dot(centeredTimes, centeredTimes)
+    if denominator <= 0.0:
+      self.velocity[:] = 0.0
+      return
+    self.velocity[:] = np.dot(centeredTimes, positions - np.mean(positions, axis=0)) / denominator
+
+
+def distanceRate(position, velocity, targetPoint):
+  """Rate of change of the distance to the target (mm/s, negative when approaching)."""
+  offset = np.asarray(position, dtype=float) - targetPoint
+  distance = np.linalg.norm(offset)
+  if distance == 0.0:
+    return 0.0
+  return float(np.dot(velocity, offset) / distance)
@@ -0,0 +1,204 @@
+"""Batch analysis of recorded guidance sessions.
+
+Every session log is analyzed as whole arrays with the geometry of the module
+(GuidanceCore: the tip to target distance of calculateDistance and the entry
+plane z axis of definePlaneAxis), giving one row of the results table:
+
+  timeToTarget  seconds from the first pointer pose until the tip is within
+                targetRadius of the target (empty if it never is)
+  pathLength    length of the tip path (mm)
+  finalError    tip to target distance of the last pose (mm)
+  zone<i>       seconds spent in each distance zone, zones split at zoneEdges
+  finalAngleError, meanAngleError
+                needle angle to zVector at the last needle pose and its mean
+                over the session (degrees), empty without needle poses
+
+The fiducials, the reference node they are expressed in and the tip
+calibrations (pointerTipMatrix, needleTipMatrix) are taken from the session
+metadata stored by SoundGuidanceLogic.startRecording unless given, so the
+tool tips are compared with the fiducials in the same reference coordinates.
+
+analyzeSessions spreads the sessions over a process pool and appends each row
+to the CSV table as soon as its session is finished. Sessions already in the
+table with the same file size and modification time are skipped, so an
+interrupted batch resumes where it stopped. Requires Python 3.
+"""
+
+import csv
+import logging
+import multiprocessing
+import os
+
+import numpy as np
+
+from .GuidanceCore import NEEDLE_AXIS, GuidanceCore
+from .SessionLog import SessionReader, nodePoses
+
+DEFAULT_ZONE_EDGES = (5.0, 20.0, 50.0)
+
+# None for referenceNode, the tip matrices and the fiducials: from the session metadata
+DEFAULT_OPTIONS = {
+  'pointerNode': 'PointerToTracker',
+  'needleNode': 'NeedleToTracker',
+  'referenceNode': None,
+  'pointerTipMatrix': None,
+  'needleTipMatrix': None,
+  'needleAxis': NEEDLE_AXIS,
+  'fiducials': None,
+  'targetRadius': 5.0,
+  'zoneEdges': DEFAULT_ZONE_EDGES,
+  }
+
+
+def resultColumns(zoneEdges=DEFAULT_ZONE_EDGES):
+  return (['session', 'size', 'mtime', 'frames', 'duration', 'timeToTarget', 'pathLength', 'finalError']
+    + ['zone%d' % index for index in range(len(zoneEdges) + 1)]
+    + ['finalAngleError', 'meanAngleError'])
+
+
+def zoneTimes(timestamps, distances, zoneEdges=DEFAULT_ZONE_EDGES):
+  """Seconds spent in each distance zone, each pose holding until the next one."""
+  zones = np.searchsorted(zoneEdges, distances[0:-1], side='right')
+  return np.bincount(zones, weights=np.diff(timestamps), minlength=len(zoneEdges) + 1)
+
+
+def pathLength(points):
+  steps = np.diff(points, axis=0)
+  return float(np.sum(np.sqrt(np.sum(steps * steps, axis=1))))
+
+
+def timeToTarget(timestamps, distances, targetRadius):
+  """Seconds until the distance first drops to targetRadius, None if it never does."""
+  reached = np.flatnonzero(distances <= targetRadius)
+  return float(timestamps[reached[0]] - timestamps[0]) if len(reached) else None
+
+
+def sessionFrames(reader, options):
+  """Fiducials, reference node index and tip matrices of a session, from options or the metadata.
+
+  Returns (fiducials, referenceIndex, pointerTipMatrix, needleTipMatrix); the
+  fiducials are in the coordinates of the reference node (world without one).
+  """
+  fiducials = options['fiducials'] or [reader.metadata.get(name) for name in ('target', 'surface', 'xAxis')]
+  if any(point is None for point in fiducials):
+    raise ValueError('%s has no fiducials in its metadata' % reader.path)
+  referenceNode = options['referenceNode'] or reader.metadata.get('referenceNode')
+  if referenceNode and referenceNode not in reader.nodeNames:
+    raise ValueError('%s has no %s poses to relate the fiducials to' % (reader.path, referenceNode))
+  referenceIndex = reader.nodeNames.index(referenceNode) if referenceNode else None
+  pointerTipMatrix, needleTipMatrix = [options[key] if options[key] is not None else reader.metadataMatrix(key)
+    for key in ('pointerTipMatrix', 'needleTipMatrix')]
+  return fiducials, referenceIndex, pointerTipMatrix, needleTipMatrix
+
+
+def analyzeSession(path, **options):
+  """One row of the results table (a dict keyed by resultColumns) for a session log."""
+  options = dict(DEFAULT_OPTIONS, **options)
+  reader = SessionReader(path)
+  fiducials, referenceIndex, pointerTipMatrix, needleTipMatrix = sessionFrames(reader, options)
+  core = GuidanceCore()
+  core.setFiducials(*fiducials)
+  records = reader.records[:]
+
+  timestamps, poses = nodePoses(records, reader.nodeNames.index(options['pointerNode']),
+    pointerTipMatrix, referenceIndex)[0:2]
+  if not len(timestamps):
+    raise ValueError('%s has no %s poses' % (path, options['pointerNode']))
+  result = core.evaluate(poses)
+  status = os.stat(path)
+  row = {
+    'session': os.path.abspath(path),
+    'size': status.st_size,
+    'mtime': int(status.st_mtime),
+    'frames': len(timestamps),
+    'duration': float(timestamps[-1] - timestamps[0]),
+    'timeToTarget': timeToTarget(timestamps, result.distance, options['targetRadius']),
+    'pathLength': pathLength(result.tipPosition),
+    'finalError': float(result.distance[-1]),
+    'finalAngleError': None,
+    'meanAngleError': None,
+    }
+  for index, seconds in enumerate(zoneTimes(timestamps, result.distance, options['zoneEdges'])):
+    row['zone%d' % index] = float(seconds)
+
+  if options['needleNode'] in reader.nodeNames:
+    needleTimestamps, needlePoses = nodePoses(records, reader.nodeNames.index(options['needleNode']),
+      needleTipMatrix, referenceIndex)[0:2]
+    if len(needleTimestamps):
+      angles = core.evaluateTrajectory(needlePoses, options['needleAxis']).angle
+      row['finalAngleError'] = float(angles[-1])
+      row['meanAngleError'] = float(np.mean(angles))
+  return row
+
+
+def _analyzeSessionTask(task):
+  path, options = task
+  try:
+    return path, analyzeSession(path, **options), None
+  except (OSError, ValueError, KeyError) as e:
+    return path, None, str(e)
+
+
+def readResults(resultsPath, columns):
+  """Complete rows of an existing results table; a row cut by an interruption is dropped."""
+  if not os.path.exists(resultsPath):
+    return []
+  with open(resultsPath, newline='') as f:
+    lines = f.read().splitlines(True)
+  if lines and not lines[-1].endswith('\n'):
+    # Interrupted while the last row was written, even a row with all its columns may be cut
+    lines.pop()
+  rows = list(csv.reader(lines))
+  if not rows or rows[0] != columns:
+    raise ValueError('%s is not a results table with the columns %s' % (resultsPath, ', '.join(columns)))
+  return [dict(zip(columns, row)) for row in rows[1:] if len(row) == len(columns) and all(row[0:3])]
+
+
+def _isAnalyzed(path, rowsBySession):
+  row = rowsBySession.get(os.path.abspath(path))
+  if row is None:
+    return False
+  status = os.stat(path)
+  return row['size'] == str(status.st_size) and row['mtime'] == str(int(status.st_mtime))
+
+
+def analyzeSessions(paths, resultsPath, processes=None, **options):
+  """Analyze session logs in a process pool and append the rows to the resultsPath CSV table.
+
+  Returns the number of sessions analyzed by this call and a dict of the
+  sessions that failed with their error; failed sessions are not written and
+  are tried again by the next call.
+  """
+  columns = resultColumns(options.get('zoneEdges', DEFAULT_ZONE_EDGES))
+  rows = readResults(resultsPath, columns)
+  # Rewritten without a partial last row so that new rows can be appended
+  rowsBySession = dict((row['session'], row) for row in rows)
+  with open(resultsPath + '.tmp', 'w', newline='') as f:
+    writer = csv.DictWriter(f, columns)
+    writer.writeheader()
+    writer.writerows(rowsBySession.values())
+  os.replace(resultsPath + '.tmp', resultsPath)
+
+  pending = [path for path in paths if not _isAnalyzed(path, rowsBySession)]
+  logging.info('%d of %d sessions already analyzed' % (len(paths) - len(pending), len(paths)))
+  analyzed = 0
+  failures = {}
+  if not pending:
+    return analyzed, failures
+  pool = multiprocessing.Pool(min(processes or os.cpu_count(), len(pending)))
+  try:
+    with open(resultsPath, 'a', newline='') as f:
+      writer = csv.DictWriter(f, columns)
+      for path, row, error in pool.imap_unordered(_analyzeSessionTask, [(path, options) for path in pending]):
+        if error:
+          logging.error('Session %s not analyzed: %s' % (path, error))
+          failures[path] = error
+          continue
+        # A new version of a session replaces its previous row when the table is read again
+        writer.writerow(dict((key, '' if value is None else value) for key, value in row.items()))
+        f.flush()
+        analyzed += 1
+  finally:
+    pool.terminate()
+    pool.join()
+  return analyzed, failures
@@ -0,0 +1,205 @@
+"""Binary log of tracker transform updates for recording and replaying sessions.
+
+File layout: an 8 byte magic, a little endian uint32 with the length of a JSON
+header (node names and free form metadata, padded to 8 bytes), followed by
+fixed size records. Each record holds a monotonic timestamp, the index of the
+transform node in the header and the top 3x4 part of its matrix to parent.
+"""
+
+import json
+import logging
+import struct
+
+import numpy as np
+
+from .UpdateScheduler import monotonicClock
+
+MAGIC = b'SGLOG001'
+
+RECORD_DTYPE = np.dtype([
+  ('timestamp', '<f8'),
+  ('node', '<u2'),
+  ('matrix', '<f4', (3, 4)),
+  ])
+
+
+def recordsToMatrices(records):
+  """Expand the 3x4 matrices of a record array to (N,4,4) homogeneous matrices."""
+  matrices = np.zeros((len(records), 4, 4))
+  matrices[:, 0:3, :] = records['matrix']
+  matrices[:, 3, 3] = 1.0
+  return matrices
+
+
+def nodePoses(records, nodeIndex, tipMatrix=None, referenceIndex=None, referenceInverse=None):
+  """Timestamps and (N,4,4) poses of one node in a block of records.
+
+  tipMatrix (e.g. PointerTipToPointer) is applied on the right of every pose.
+  With referenceIndex, each pose is made relative to the reference node pose
+  recorded last before it; referenceInverse is the inverse of the last
+  reference pose of the previous block, and poses before any reference pose
+  are dropped. Returns (timestamps, poses, referenceInverse) so that a long
+  log is processed block by block with the referenceInverse carried over.
+  """
+  nodeIndices = np.flatnonzero(records['node'] == nodeIndex)
+  timestamps = records['timestamp'][nodeIndices]
+  poses = recordsToMatrices(records[nodeIndices])
+  if tipMatrix is not None:
+    poses = np.matmul(poses, tipMatrix)
+  if referenceIndex is None:
+    return timestamps, poses, referenceInverse
+
+  referenceIndices = np.flatnonzero(records['node'] == referenceIndex)
+  inverses = np.linalg.inv(recordsToMatrices(records[referenceIndices]))
+  # Index 0 is the reference pose carried over from the previous block
+  carried = np.full((4, 4), np.nan) if referenceInverse is None else referenceInverse
+  inverses = np.concatenate((carried[np.newaxis], inverses))
+  latest = np.searchsorted(referenceIndices, nodeIndices, side='right')
+  valid = (latest > 0) if referenceInverse is None else np.ones(len(latest), dtype=bool)
+  poses = np.matmul(inverses[latest[valid]], poses[valid])
+  return timestamps[valid], poses, inverses[-1] if len(referenceIndices) else referenceInverse
+
+
+class SessionRecorder(object):
+  """Appends transform updates to a session log.
+
+  Records are collected in a preallocated block and written when it is full,
+  so recording an update is a few array assignments.
+  """
+
+  def __init__(self, path, nodeNames, metadata=None, blockSize=256, clock=monotonicClock):
+    self.path = path
+    self.nodeNames = list(nodeNames)
+    self.clock = clock
+    self.block = np.zeros(blockSize, dtype=RECORD_DTYPE)
+    self.blockCount = 0
+    self.recordCount = 0
+    self.file = open(path, 'wb')
+    header = json.dumps({'nodes': self.nodeNames, 'metadata': metadata or {}}).encode('utf-8')
+    header += b' ' * (-(len(MAGIC) + 4 + len(header)) % 8)
+    self.file.write(MAGIC + struct.pack('<I', len(header)) + header)
+
+  def recordMatrix(self, nodeIndex, matrix, timestamp=None):
+    """Add the matrix (4x4 or 3x4, any nested sequence) of node nodeIndex."""
+    record = self.block[self.blockCount]
+    record['timestamp'] = self.clock() if timestamp is None else timestamp
+    record['node'] = nodeIndex
+    record['matrix'] = np.asarray(matrix)[0:3]
+    self.blockCount += 1
+    self.recordCount += 1
+    if self.blockCount == len(self.block):
+      self.flush()
+
+  def flush(self):
+    if self.blockCount:
+      self.file.write(self.block[0:self.blockCount].tobytes())
+      self.blockCount = 0
+    self.file.flush()
+
+  def close(self):
+    if self.file:
+      self.flush()
+      self.file.close()
+      self.file = None
+
+
+class SessionReader(object):
+  """Memory maps a session log; records are only read when accessed.
+
+  A log whose recording was interrupted (e.g. Slicer crashed during a write)
+  can end with part of a record, which is ignored with a warning.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'rb') as f:
+      if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('%s is not a SoundGuidance session log' % path)
+      headerLength = struct.unpack('<I', f.read(4))[0]
+      header = json.loads(f.read(headerLength).decode('utf-8'))
+    self.nodeNames = header['nodes']
+    self.metadata = header['metadata']
+    offset = len(MAGIC) + 4 + headerLength
+    recordCount, partialBytes = divmod(max(self._fileSize() - offset, 0), RECORD_DTYPE.itemsize)
+    if partialBytes:
+      logging.warning('%s ends with a partial record, its last %d bytes are ignored' % (path, partialBytes))
+    if recordCount:
+      self.records = np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=offset, shape=(recordCount,))
+    else:
+      self.records = np.zeros(0, dtype=RECORD_DTYPE)
+
+  def metadataMatrix(self, key):
+    """(4,4) array stored under key in the metadata (e.g. pointerTipMatrix), None when not recorded."""
+    value = self.metadata.get(key)
+    return None if value is None else np.asarray(value, dtype=float)
+
+  def _fileSize(self):
+    with open(self.path, 'rb') as f:
+      f.seek(0, 2)
+      return f.tell()
+
+  def __len__(self):
+    return len(self.records)
+
+  def duration(self):
+    if not len(self.records):
+      return 0.0
+    return float(self.records[-1]['timestamp'] - self.records[0]['timestamp'])
+
+  def nodeRecords(self, nodeName):
+    """All records of one node (reads that node's records into memory)."""
+    return self.records[self.records['node'] == self.nodeNames.index(nodeName)]
+
+
+class SessionReplayer(object):
+  """Feeds the records of a session log to applyMatrix(nodeName, matrix4x4).
+
+  With speed > 0, step() applies the records that are due according to the
+  original timing scaled by speed and is meant to be called from a timer.
+  replayAll() applies every record as fast as possible.
+  """
+
+  def __init__(self, reader, applyMatrix, speed=1.0, chunkSize=1024, clock=monotonicClock):
+    self.reader = reader
+    self.applyMatrix = applyMatrix
+    self.speed = speed
+    self.chunkSize = chunkSize
+    self.clock = clock
+    self.position = 0
+    self.startTime = None
+
+  def start(self):
+    self.position = 0
+    self.startTime = self.clock()
+
+  def isFinished(self):
+    return self.position >= len(self.reader.records)
+
+  def step(self):
+    """Apply the records due by now. Returns the number of records applied."""
+    records = self.reader.records
+    if self.isFinished():
+      return 0
+    elapsed = (self.clock() - self.startTime) * self.speed
+    dueTime = records[0]['timestamp'] + elapsed
+    applied = 0
+    while not self.isFinished():
+      chunk = records[self.position:self.position + self.chunkSize]
+      dueCount = int(np.searchsorted(chunk['timestamp'], dueTime, side='right'))
+      self._apply(chunk[0:dueCount])
+      applied += dueCount
+      if dueCount < len(chunk):
+        break
+    return applied
+
+  def replayAll(self):
+    records = self.reader.records
+    self.position = 0
+    while not self.isFinished():
+      self._apply(records[self.position:self.position + self.chunkSize])
+
+  def _apply(self, chunk):
+    nodeNames = self.reader.nodeNames
+    for nodeIndex, matrix in zip(chunk['node'], recordsToMatrices(chunk)):
+      self.applyMatrix(nodeNames[nodeIndex], matrix)
+    self.position += len(chunk)
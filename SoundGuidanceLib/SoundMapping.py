@@ -0,0 +1,147 @@
+"""Distance to sound parameter mappings compiled into lookup tables.
+
+A mapping file (JSON) declares the sound parameters derived from the tip to
+target distance, e.g.
+
+  {
+    "maxDistance": 200,
+    "tableSize": 2048,
+    "parameters": [
+      {"name": "distance", "type": "linear"},
+      {"name": "pitch", "type": "log", "scale": 10, "range": [1, 0]},
+      {"name": "zone", "type": "zones", "points": [[0, 3], [5, 2], [20, 1], [50, 0]]},
+      {"name": "beepRate", "type": "beepRate", "nearRate": 12, "farRate": 1, "exponent": 2}
+    ]
+  }
+
+Parameter types, for a distance d clamped to [0, maxDistance]:
+  linear     d / maxDistance
+  log        log(1 + d / scale) / log(1 + maxDistance / scale)
+  zones      value of the last zone starting at or below d (points are [start, value])
+  curve      piecewise linear through the [distance, value] points
+  beepRate   farRate + (nearRate - farRate) * (1 - d / maxDistance) ** exponent
+
+linear and log give 0 to 1 and are scaled to "range" [atZero, atMax] when
+given. Each parameter is sent as one message of a bundle, to its "address" or
+/dumpOSC/map/<name>.
+
+All parameters are sampled once into a (parameters, tableSize) table, so a
+frame evaluates the whole parameter vector with one interpolation in the table
+however complex the mappings are. Zone edges are therefore resolved to one
+table step (maxDistance / (tableSize - 1)).
+"""
+
+import json
+import logging
+import os
+
+import numpy as np
+
+from .OSCEncoder import OSCBundleEncoder, OSCMessageEncoder
+
+DEFAULT_TABLE_SIZE = 2048
+
+
+def _normalizedCurve(parameter, distances, maxDistance):
+  mappingType = parameter.get('type', 'linear')
+  if mappingType == 'linear':
+    return distances / maxDistance
+  if mappingType == 'log':
+    scale = float(parameter.get('scale', 10.0))
+    return np.log1p(distances / scale) / np.log1p(maxDistance / scale)
+  return None
+
+
+def sampleParameter(parameter, distances, maxDistance):
+  """Values of one declared parameter at the given distances."""
+  mappingType = parameter.get('type', 'linear')
+  values = _normalizedCurve(parameter, distances, maxDistance)
+  if values is not None:
+    atZero, atMax = parameter.get('range', (0.0, 1.0))
+    return atZero + (atMax - atZero) * values
+  if mappingType in ('zones', 'curve'):
+    points = np.asarray(parameter['points'], dtype=float)
+    if points.ndim != 2 or points.shape[1] != 2 or not len(points):
+      raise ValueError('Parameter %s needs [distance, value] points' % parameter.get('name'))
+    points = points[np.argsort(points[:, 0], kind='stable')]
+    if mappingType == 'curve':
+      return np.interp(distances, points[:, 0], points[:, 1])
+    zoneIndices = np.searchsorted(points[:, 0], distances, side='right') - 1
+    return points[np.maximum(zoneIndices, 0), 1]
+  if mappingType == 'beepRate':
+    nearRate = float(parameter.get('nearRate', 10.0))
+    farRate = float(parameter.get('farRate', 1.0))
+    exponent = float(parameter.get('exponent', 2.0))
+    return farRate + (nearRate - farRate) * (1.0 - distances / maxDistance) ** exponent
+  raise ValueError('Unknown mapping type %s' % mappingType)
+
+
+class SoundMapping(object):
+  """Parameter lookup tables compiled from a mapping declaration."""
+
+  def __init__(self, configuration):
+    self.maxDistance = float(configuration.get('maxDistance', 200.0))
+    self.tableSize = int(configuration.get('tableSize', DEFAULT_TABLE_SIZE))
+    parameters = configuration.get('parameters', [])
+    if not parameters or self.maxDistance <= 0 or self.tableSize < 2:
+      raise ValueError('A mapping needs parameters, a positive maxDistance and tableSize >= 2')
+    self.names = [parameter['name'] for parameter in parameters]
+    self.addresses = [parameter.get('address', '/dumpOSC/map/' + parameter['name']) for parameter in parameters]
+    distances = np.linspace(0.0, self.maxDistance, self.tableSize)
+    # One extra column so that the interpolation at maxDistance stays in the table
+    self.table = np.empty((len(parameters), self.tableSize + 1))
+    for index, parameter in enumerate(parameters):
+      self.table[index, 0:self.tableSize] = sampleParameter(parameter, distances, self.maxDistance)
+    self.table[:, self.tableSize] = self.table[:, self.tableSize - 1]
+    self.samplesPerMillimeter = (self.tableSize - 1) / self.maxDistance
+    self.bundleEncoder = OSCBundleEncoder([OSCMessageEncoder(address, 'f') for address in self.addresses])
+
+  def evaluate(self, distance):
+    """Parameter vector for one distance (mm), clamped to [0, maxDistance]."""
+    position = min(max(float(distance), 0.0), self.maxDistance) * self.samplesPerMillimeter
+    index = int(position)
+    fraction = position - index
+    return self.table[:, index] * (1.0 - fraction) + self.table[:, index + 1] * fraction
+
+  def evaluateMany(self, distances):
+    """(parameters, N) values for an array of distances, e.g. a recorded session."""
+    positions = np.clip(np.asarray(distances, dtype=float), 0.0, self.maxDistance) * self.samplesPerMillimeter
+    indices = positions.astype(int)
+    fractions = positions - indices
+    return self.table[:, indices] * (1.0 - fractions) + self.table[:, indices + 1] * fractions
+
+  def bundleValues(self, values):
+    return [[value] for value in values.tolist()]
+
+
+class MappingFile(object):
+  """SoundMapping loaded from a JSON file and compiled again when the file changes."""
+
+  def __init__(self, path):
+    self.path = path
+    self.modifiedTime = None
+    self.mapping = None
+    self.reloadIfChanged()
+
+  def reloadIfChanged(self):
+    """Recompile after the file was saved. Returns True when a new mapping is in use.
+
+    A file that cannot be parsed is reported and the previous mapping is kept,
+    so a typo made while editing during a session does not silence the sound.
+    """
+    try:
+      modifiedTime = os.path.getmtime(self.path)
+    except OSError:
+      return False
+    if modifiedTime == self.modifiedTime:
+      return False
+    self.modifiedTime = modifiedTime
+    try:
+      with open(self.path) as mappingFile:
+        mapping = SoundMapping(json.load(mappingFile))
+    except (ValueError, KeyError, TypeError) as e:
+      logging.error('Sound mapping %s not loaded: %s' % (self.path, e))
+      return False
+    self.mapping = mapping
+    logging.info('Sound mapping %s loaded: %s' % (self.path, ', '.join(mapping.names)))
+    return True
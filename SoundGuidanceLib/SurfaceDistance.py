@@ -0,0 +1,377 @@
+"""Distance from the tool tip to a triangle mesh such as the aro.stl phantom.
+
+SurfaceLocator buckets the triangles in a uniform grid (each triangle is
+listed in every cell its bounding box overlaps), like TargetIndex, and stores
+for each cell the distance from its center to the nearest vertex. That bounds
+the distance to the surface from any point of the cell, so a query gathers
+the triangles of one box of cells and tests them in a single vectorized pass
+instead of growing the search ring by ring. The grid is plain NumPy arrays,
+so it is saved to an .npz cache keyed by a hash of the mesh and loaded on
+later startups instead of being rebuilt.
+
+The sign of the distance comes from the angle weighted pseudo-normal of the
+closest feature (face, edge or vertex), Baerentzen and Aanaes, Signed
+distance computation using the angle weighted pseudonormal, 2005. The face
+normal alone gives the wrong side near convex edges and vertices.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+CACHE_VERSION = 1
+
+
+def meshHash(vertices, triangles):
+  digest = hashlib.sha1()
+  digest.update(np.ascontiguousarray(vertices, dtype=float).tobytes())
+  digest.update(np.ascontiguousarray(triangles, dtype=np.int64).tobytes())
+  return digest.hexdigest()
+
+
+# Closest feature codes of closestPointsOnTriangles, index into SurfaceLocator.featureNormals
+FACE, VERTEX_A, VERTEX_B, VERTEX_C, EDGE_AB, EDGE_BC, EDGE_CA = range(7)
+
+
+def closestPointsOnTriangles(point, a, b, c, returnFeatures=False):
+  """Closest point to point on each triangle (a[i], b[i], c[i]), (M,3) arrays.
+
+  Vectorized version of the Voronoi region test from Ericson, Real-Time
+  Collision Detection, 5.1.5. With returnFeatures the code of the closest
+  feature (FACE, VERTEX_A, ..., EDGE_CA) of each triangle is returned too.
+  """
+  ab = b - a
+  ac = c - a
+  ap = point - a
+  bp = point - b
+  cp = point - c
+  d1 = np.sum(ab * ap, axis=1)
+  d2 = np.sum(ac * ap, axis=1)
+  d3 = np.sum(ab * bp, axis=1)
+  d4 = np.sum(ac * bp, axis=1)
+  d5 = np.sum(ab * cp, axis=1)
+  d6 = np.sum(ac * cp, axis=1)
+  va = d3 * d6 - d5 * d4
+  vb = d5 * d2 - d1 * d6
+  vc = d1 * d4 - d3 * d2
+
+  with np.errstate(divide='ignore', invalid='ignore'):
+    denominator = va + vb + vc
+    result = a + ab * (vb / denominator)[:, np.newaxis] + ac * (vc / denominator)[:, np.newaxis]
+    features = np.full(len(result), FACE)
+    # Regions are applied from the lowest to the highest priority
+    mask = (va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0)
+    w = (d4 - d3) / ((d4 - d3) + (d5 - d6))
+    result[mask] = (b + (c - b) * w[:, np.newaxis])[mask]
+    features[mask] = EDGE_BC
+    mask = (vb <= 0) & (d2 >= 0) & (d6 <= 0)
+    w = d2 / (d2 - d6)
+    result[mask] = (a + ac * w[:, np.newaxis])[mask]
+    features[mask] = EDGE_CA
+    mask = (d6 >= 0) & (d5 <= d6)
+    result[mask] = c[mask]
+    features[mask] = VERTEX_C
+    mask = (vc <= 0) & (d1 >= 0) & (d3 <= 0)
+    v = d1 / (d1 - d3)
+    result[mask] = (a + ab * v[:, np.newaxis])[mask]
+    features[mask] = EDGE_AB
+    mask = (d3 >= 0) & (d4 <= d3)
+    result[mask] = b[mask]
+    features[mask] = VERTEX_B
+    mask = (d1 <= 0) & (d2 <= 0)
+    result[mask] = a[mask]
+    features[mask] = VERTEX_A
+  if returnFeatures:
+    return result, features
+  return result
+
+
+class SurfaceLocator(object):
+  """Closest point and signed distance queries on a triangle mesh.
+
+  The sign comes from the pseudo-normal of the closest feature: positive on
+  the side the surface faces (outside for outward oriented meshes such as STL
+  files).
+  """
+
+  def __init__(self, vertices, triangles, trianglesPerCell=4.0, build=True):
+    self.vertices = np.asarray(vertices, dtype=float)
+    triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+    corners = self.vertices[triangles]
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    areas = np.sqrt(np.sum(normals * normals, axis=1))
+    # Degenerate triangles have no normal and are covered by their neighbours
+    valid = areas > 1e-12
+    self.triangles = triangles[valid]
+    self.normals = normals[valid] / areas[valid][:, np.newaxis]
+    self.trianglesPerCell = trianglesPerCell
+    self._computeFeatureNormals()
+    if build:
+      self.build()
+
+  def build(self):
+    corners = self.vertices[self.triangles]
+    self._computeTriangleBounds()
+    self.lowerBound = corners.reshape(-1, 3).min(axis=0)
+    extent = np.maximum(corners.reshape(-1, 3).max(axis=0) - self.lowerBound, 1e-6)
+    volume = np.prod(np.maximum(extent, extent.max() * 1e-2))
+    self.cellSize = float(np.cbrt(volume * self.trianglesPerCell / max(len(self.triangles), 1)))
+    self.gridSize = np.floor(extent / self.cellSize).astype(np.int64) + 1
+
+    # Every cell overlapped by the bounding box of a triangle lists the triangle
+    lowerCells = self._cellCoordinates(self.triangleLower)
+    upperCells = self._cellCoordinates(self.triangleUpper)
+    spans = upperCells - lowerCells + 1
+    counts = np.prod(spans, axis=1)
+    triangleIds = np.repeat(np.arange(len(self.triangles)), counts)
+    local = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+    spansRepeated = spans[triangleIds]
+    cells = lowerCells[triangleIds].copy()
+    cells[:, 0] += local % spansRepeated[:, 0]
+    cells[:, 1] += (local // spansRepeated[:, 0]) % spansRepeated[:, 1]
+    cells[:, 2] += local // (spansRepeated[:, 0] * spansRepeated[:, 1])
+    keys = self._cellKeys(cells)
+    order = np.argsort(keys, kind='stable')
+    self.sortedKeys = keys[order]
+    self.cellTriangles = triangleIds[order]
+    self._computeCellVertexDistances()
+
+  def _computeCellVertexDistances(self, chunkSize=256):
+    """Distance from each cell center to the nearest mesh vertex."""
+    cells = np.indices(self.gridSize).reshape(3, -1).T
+    centers = self.lowerBound + (cells + 0.5) * self.cellSize
+    self.cellVertexDistances = self.nearestVertexDistances(centers, chunkSize).reshape(self.gridSize)
+
+  def nearestVertexDistances(self, points, chunkSize=256):
+    """Distance from each point (N,3) to the nearest mesh vertex."""
+    vertices = self.vertices[np.unique(self.triangles)]
+    vertexNorms = np.sum(vertices * vertices, axis=1)
+    distances = np.empty(len(points))
+    for start in range(0, len(points), chunkSize):
+      chunk = points[start:start + chunkSize]
+      squared = np.sum(chunk * chunk, axis=1)[:, np.newaxis] - 2.0 * np.dot(chunk, vertices.T) + vertexNorms
+      distances[start:start + chunkSize] = np.sqrt(np.maximum(squared.min(axis=1), 0.0))
+    return distances
+
+  def _computeFeatureNormals(self):
+    """Pseudo-normal of the face, vertices (A, B, C) and edges (AB, BC, CA) of each triangle.
+
+    Vertex normals are the face normals weighted by the angle of each face at
+    the vertex, edge normals the sum of the normals of the faces sharing the
+    edge. Only their direction is used, so they are not normalized. Vertices
+    at the same position are merged, STL files list them once per triangle.
+    """
+    corners = self.vertices[self.triangles]
+    positions, mergedIds = np.unique(self.vertices, axis=0, return_inverse=True)
+    triangleVertices = mergedIds.reshape(-1)[self.triangles]
+    nextCorners = np.roll(corners, -1, axis=1)
+    previousCorners = np.roll(corners, 1, axis=1)
+    sides = nextCorners - corners
+    otherSides = previousCorners - corners
+    crossNorms = np.sqrt(np.sum(np.cross(sides, otherSides) ** 2, axis=2))
+    angles = np.arctan2(crossNorms, np.sum(sides * otherSides, axis=2))
+    vertexNormals = np.zeros((len(positions), 3))
+    np.add.at(vertexNormals, triangleVertices.ravel(), (angles[:, :, np.newaxis] * self.normals[:, np.newaxis, :]).reshape(-1, 3))
+
+    # Edges AB, BC and CA of every triangle, keyed by their sorted merged vertex ids
+    edgeVertices = np.sort(np.stack([triangleVertices, np.roll(triangleVertices, -1, axis=1)], axis=2), axis=2)
+    edgeKeys = edgeVertices[:, :, 0] * len(positions) + edgeVertices[:, :, 1]
+    uniqueKeys, edgeIds = np.unique(edgeKeys.ravel(), return_inverse=True)
+    edgeNormals = np.zeros((len(uniqueKeys), 3))
+    np.add.at(edgeNormals, edgeIds, np.repeat(self.normals, 3, axis=0))
+
+    self.featureNormals = np.concatenate([self.normals[:, np.newaxis, :],
+      vertexNormals[triangleVertices], edgeNormals[edgeIds.reshape(-1, 3)]], axis=1)
+
+  def _computeTriangleBounds(self):
+    corners = self.vertices[self.triangles]
+    self.triangleLower = corners.min(axis=1)
+    self.triangleUpper = corners.max(axis=1)
+
+  def _cellCoordinates(self, points):
+    coordinates = np.floor((points - self.lowerBound) / self.cellSize).astype(np.int64)
+    return np.clip(coordinates, 0, self.gridSize - 1)
+
+  def _cellKeys(self, coordinates):
+    return coordinates[..., 0] + self.gridSize[0] * (coordinates[..., 1] + self.gridSize[1] * coordinates[..., 2])
+
+  def _trianglesNear(self, point, radius):
+    """Triangles listed in the cells within radius of point."""
+    lower = self._cellCoordinates(point - radius)
+    upper = self._cellCoordinates(point + radius)
+    cells = np.indices(upper - lower + 1).reshape(3, -1).T + lower
+    # Only the cells the search sphere reaches, for far points a cap of the box of cells
+    cellLower = self.lowerBound + cells * self.cellSize
+    offsets = np.maximum(np.maximum(cellLower - point, point - (cellLower + self.cellSize)), 0)
+    cellKeys = self._cellKeys(cells[np.sum(offsets * offsets, axis=1) <= radius * radius])
+    starts = np.searchsorted(self.sortedKeys, cellKeys, side='left')
+    ends = np.searchsorted(self.sortedKeys, cellKeys, side='right')
+    counts = ends - starts
+    entries = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(int(counts.sum()))
+    # Triangles spanning several cells are listed once per cell, a mask is cheaper than sorting them
+    listed = np.zeros(len(self.triangles), dtype=bool)
+    listed[self.cellTriangles[entries]] = True
+    return np.flatnonzero(listed)
+
+  def closestPoint(self, point, maxDistance=np.inf, chunkSize=64):
+    """Closest surface point, signed distance and triangle index.
+
+    Returns (None, maxDistance, -1) when the surface is further than
+    maxDistance, which bounds the search for tips far from the phantom.
+    Candidates are tested in chunks of increasing bounding box distance until
+    the next box is further than the closest point found, so far tips whose
+    search box covers most of the mesh only test the triangles facing them.
+    """
+    point = np.asarray(point, dtype=float)[0:3]
+    upperBound = self.lowerBound + self.gridSize * self.cellSize
+    if np.linalg.norm(np.maximum(np.maximum(self.lowerBound - point, point - upperBound), 0)) > maxDistance:
+      return None, maxDistance, -1
+    cell = self._cellCoordinates(point)
+    cellCenter = self.lowerBound + (cell + 0.5) * self.cellSize
+    # A vertex is at most this far, so the closest triangle is inside this box
+    searchDistance = self.cellVertexDistances[tuple(cell)] + np.linalg.norm(point - cellCenter)
+    searchDistance = min(searchDistance, maxDistance)
+    candidates = self._trianglesNear(point, searchDistance)
+    boxOffsets = np.maximum(np.maximum(self.triangleLower[candidates] - point, point - self.triangleUpper[candidates]), 0)
+    boxDistances = np.sum(boxOffsets * boxOffsets, axis=1)
+    nearby = boxDistances <= searchDistance * searchDistance
+    candidates = candidates[nearby]
+    if not len(candidates):
+      return None, maxDistance, -1
+    # The nearest first corner tightens the bound before the exact test
+    boxDistances = boxDistances[nearby]
+    firstCorners = self.vertices[self.triangles[candidates, 0]] - point
+    inReach = boxDistances <= np.min(np.sum(firstCorners * firstCorners, axis=1))
+    order = np.argsort(boxDistances[inReach])
+    candidates = candidates[inReach][order]
+    boxDistances = boxDistances[inReach][order]
+
+    best = None
+    bestDistance = np.inf
+    for start in range(0, len(candidates), chunkSize):
+      if boxDistances[start] > bestDistance * bestDistance:
+        break
+      chunk = candidates[start:start + chunkSize]
+      corners = self.vertices[self.triangles[chunk]]
+      closestPoints, features = closestPointsOnTriangles(point, corners[:, 0], corners[:, 1], corners[:, 2], True)
+      distances = np.sqrt(np.sum((closestPoints - point) ** 2, axis=1))
+      closest = int(np.argmin(distances))
+      if distances[closest] < bestDistance:
+        bestDistance = float(distances[closest])
+        best = (closestPoints[closest], int(chunk[closest]), features[closest])
+    if bestDistance > maxDistance:
+      return None, maxDistance, -1
+    closestPoint, triangle, feature = best
+    side = np.dot(point - closestPoint, self.featureNormals[triangle, feature])
+    return closestPoint, bestDistance if side >= 0 else -bestDistance, triangle
+
+  def signedDistances(self, points, maxDistance=np.inf, chunkSize=256):
+    """Signed distances of many points (N,3), maxDistance where the surface is further.
+
+    Same result as closestPoint for every point, without the cell search: the
+    closest triangle has a vertex within the distance to the nearest vertex
+    plus its reach (longest edge / sqrt(3)), so the vertex distances of a
+    chunk of points (one matrix product) give every candidate point and
+    triangle pair at once. Much faster for dense point sets such as the voxels
+    of a grid.
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    distances = np.full(len(points), float(maxDistance))
+    if not len(self.triangles):
+      return distances
+    self._computeVertexTriangles()
+    vertexNorms = np.sum(self.meshVertices * self.meshVertices, axis=1)
+    for start in range(0, len(points), chunkSize):
+      chunk = points[start:start + chunkSize]
+      squared = np.maximum(np.sum(chunk * chunk, axis=1)[:, np.newaxis] - 2.0 * np.dot(chunk, self.meshVertices.T) + vertexNorms, 0.0)
+      nearest = np.sqrt(squared.min(axis=1))
+      # Points whose nearest vertex is further than maxDistance plus any reach are not searched (nan matches nothing)
+      nearest[nearest - self.vertexReach.max() > maxDistance] = np.nan
+      pointIds, vertexIds = np.nonzero(squared <= (nearest[:, np.newaxis] + self.vertexReach) ** 2)
+      if not len(pointIds):
+        continue
+
+      # Triangles of the matched vertices whose bounding box is not further than the nearest vertex
+      counts = self.vertexTriangleStarts[vertexIds + 1] - self.vertexTriangleStarts[vertexIds]
+      entries = np.repeat(self.vertexTriangleStarts[vertexIds] - np.cumsum(counts) + counts, counts) + np.arange(int(counts.sum()))
+      pairIds = np.repeat(pointIds, counts)
+      pairTriangles = self.vertexTriangles[entries]
+      boxOffsets = np.maximum(np.maximum(self.triangleLower[pairTriangles] - chunk[pairIds], chunk[pairIds] - self.triangleUpper[pairTriangles]), 0)
+      # Rounding of the matrix product must not cut off the triangles of the nearest vertex itself
+      inReach = np.sum(boxOffsets * boxOffsets, axis=1) <= (nearest[pairIds] * (1.0 + 1e-7) + 1e-9) ** 2
+      # A triangle is listed once for each of its matched vertices
+      pairKeys = np.unique(pairIds[inReach] * len(self.triangles) + pairTriangles[inReach])
+      pairPoints = chunk[pairKeys // len(self.triangles)]
+      pairTriangles = pairKeys % len(self.triangles)
+
+      corners = self.vertices[self.triangles[pairTriangles]]
+      closestPoints, features = closestPointsOnTriangles(pairPoints, corners[:, 0], corners[:, 1], corners[:, 2], True)
+      pairDistances = np.sqrt(np.sum((closestPoints - pairPoints) ** 2, axis=1))
+      # Pairs sorted by point then distance, the first pair of each point is its closest triangle
+      pairIds = pairKeys // len(self.triangles)
+      pairOrder = np.lexsort((pairDistances, pairIds))
+      closest = pairOrder[np.concatenate(([True], np.diff(pairIds[pairOrder]) != 0))]
+      closest = closest[pairDistances[closest] <= maxDistance]
+      closestNormals = self.featureNormals[pairTriangles[closest], features[closest]]
+      sides = np.sum((pairPoints[closest] - closestPoints[closest]) * closestNormals, axis=1)
+      distances[start + pairIds[closest]] = np.where(sides >= 0, pairDistances[closest], -pairDistances[closest])
+    return distances
+
+  def _computeVertexTriangles(self):
+    """Triangles of each vertex (CSR arrays) and the longest edge of its triangles."""
+    if getattr(self, 'vertexTriangles', None) is not None:
+      return
+    if getattr(self, 'triangleLower', None) is None:
+      # Locators made with build=False are only used for signedDistances
+      self._computeTriangleBounds()
+    vertexIds, triangleVertices = np.unique(self.triangles, return_inverse=True)
+    self.meshVertices = self.vertices[vertexIds]
+    triangleVertices = triangleVertices.reshape(-1, 3)
+    corners = self.vertices[self.triangles]
+    longestEdges = np.sqrt(np.max(np.sum((corners - np.roll(corners, 1, axis=1)) ** 2, axis=2), axis=1))
+    # Every point of a triangle is within longestEdge / sqrt(3) of one of its vertices
+    self.vertexReach = np.zeros(len(vertexIds))
+    np.maximum.at(self.vertexReach, triangleVertices.ravel(), np.repeat(longestEdges / np.sqrt(3.0), 3))
+    order = np.argsort(triangleVertices.ravel(), kind='stable')
+    self.vertexTriangles = (order // 3)
+    self.vertexTriangleStarts = np.searchsorted(triangleVertices.ravel()[order], np.arange(len(vertexIds) + 1))
+
+  def save(self, path):
+    np.savez(path, version=CACHE_VERSION, vertices=self.vertices, triangles=self.triangles, normals=self.normals,
+      lowerBound=self.lowerBound, cellSize=self.cellSize, gridSize=self.gridSize,
+      sortedKeys=self.sortedKeys, cellTriangles=self.cellTriangles, cellVertexDistances=self.cellVertexDistances)
+
+  @classmethod
+  def load(cls, path):
+    data = np.load(path)
+    if int(data['version']) != CACHE_VERSION:
+      raise ValueError('Surface locator cache %s has an old version' % path)
+    locator = cls.__new__(cls)
+    locator.vertices = data['vertices']
+    locator.triangles = data['triangles']
+    locator.normals = data['normals']
+    locator.lowerBound = data['lowerBound']
+    locator.cellSize = float(data['cellSize'])
+    locator.gridSize = data['gridSize']
+    locator.sortedKeys = data['sortedKeys']
+    locator.cellTriangles = data['cellTriangles']
+    locator.cellVertexDistances = data['cellVertexDistances']
+    locator._computeTriangleBounds()
+    locator._computeFeatureNormals()
+    return locator
+
+
+def loadOrBuildLocator(vertices, triangles, cacheDirectory):
+  """SurfaceLocator for the mesh, read from cacheDirectory when built before."""
+  path = os.path.join(cacheDirectory, 'SurfaceLocator-%s.npz' % meshHash(vertices, triangles))
+  if os.path.exists(path):
+    try:
+      return SurfaceLocator.load(path)
+    except (IOError, ValueError, KeyError):
+      pass
+  locator = SurfaceLocator(vertices, triangles)
+  if not os.path.isdir(cacheDirectory):
+    os.makedirs(cacheDirectory)
+  locator.save(path)
+  return locator
@@ -0,0 +1,124 @@
+"""Nearest target lookup for plans with many targets (e.g. biopsy grids).
+
+Targets are bucketed in a uniform grid: points are sorted by the linear index
+of their cell so the points of a cell are one contiguous slice found with a
+binary search. A query starts from the cell of the query point (clamped to
+the grid) and visits the shells of cells around it ring by ring until no
+unvisited cell can hold a closer target.
+"""
+
+import numpy as np
+
+# Below this number of targets a vectorized brute force search is faster
+BRUTE_FORCE_LIMIT = 4096
+
+
+class TargetIndex(object):
+
+  def __init__(self, points=None, pointsPerCell=2.0):
+    self.pointsPerCell = pointsPerCell
+    self.build(np.zeros((0, 3)) if points is None else points)
+
+  def build(self, points):
+    self.points = np.asarray(points, dtype=float).reshape(-1, 3)
+    if len(self.points) <= BRUTE_FORCE_LIMIT:
+      self.cellSize = None
+      return
+    self.lowerBound = self.points.min(axis=0)
+    extent = np.maximum(self.points.max(axis=0) - self.lowerBound, 1e-6)
+    self.cellSize = self._computeCellSize(extent)
+    self.gridSize = np.floor(extent / self.cellSize).astype(int) + 1
+    cellKeys = self._cellKeys(self._cellCoordinates(self.points))
+    self.order = np.argsort(cellKeys, kind='stable')
+    self.sortedKeys = cellKeys[self.order]
+    self.sortedPoints = self.points[self.order]
+
+  def _computeCellSize(self, extent):
+    """Cells sized so that a cell holds about pointsPerCell targets on average.
+
+    Axes thinner than a cell (planar or linear target sets) do not count in
+    the volume, otherwise the cells of a plane of targets are mostly empty.
+    """
+    spread = np.ones(3, dtype=bool)
+    while True:
+      dimensions = int(np.count_nonzero(spread))
+      cellSize = float((np.prod(extent[spread]) * self.pointsPerCell / len(self.points)) ** (1.0 / dimensions))
+      thin = spread & (extent < cellSize)
+      if not thin.any() or dimensions == 1:
+        return cellSize
+      spread &= ~thin
+
+  def __len__(self):
+    return len(self.points)
+
+  def _cellCoordinates(self, points):
+    coordinates = np.floor((points - self.lowerBound) / self.cellSize).astype(int)
+    return np.clip(coordinates, 0, self.gridSize - 1)
+
+  def _cellKeys(self, coordinates):
+    return coordinates[..., 0] + self.gridSize[0] * (coordinates[..., 1] + self.gridSize[1] * coordinates[..., 2])
+
+  def nearest(self, point):
+    """Index and distance of the target closest to point, (-1, inf) if empty."""
+    point = np.asarray(point, dtype=float)[0:3]
+    if not len(self.points):
+      return -1, float('inf')
+    if self.cellSize is None:
+      distances = np.sqrt(np.sum((self.points - point) ** 2, axis=1))
+      index = int(np.argmin(distances))
+      return index, float(distances[index])
+
+    # Points outside the grid start from the nearest cell of the grid
+    center = self._cellCoordinates(point)
+    candidates = self._pointsInCells(center, center)
+    radius = 0
+    while not len(candidates):
+      radius += 1
+      candidates = self._pointsInCells(np.maximum(center - radius, 0), np.minimum(center + radius, self.gridSize - 1))
+    # A closer target is inside the ball through the nearest target found so far
+    bestDistance = np.sqrt(np.min(np.sum((self.sortedPoints[candidates] - point) ** 2, axis=1)))
+    candidates = self._pointsInBall(point, bestDistance)
+    distances = np.sqrt(np.sum((self.sortedPoints[candidates] - point) ** 2, axis=1))
+    closest = int(np.argmin(distances))
+    return int(self.order[candidates[closest]]), float(distances[closest])
+
+  def _pointsInCells(self, lower, upper):
+    """Indices into sortedPoints of the targets in the cells lower..upper (inclusive)."""
+    ys, zs = np.meshgrid(np.arange(lower[1], upper[1] + 1), np.arange(lower[2], upper[2] + 1), indexing='ij')
+    rowStartKeys = (lower[0] + self.gridSize[0] * (ys + self.gridSize[1] * zs)).ravel()
+    return self._pointsInRows(rowStartKeys, np.full(len(rowStartKeys), upper[0] - lower[0]))
+
+  def _pointsInBall(self, point, radius):
+    """Indices into sortedPoints of the targets in the cells that intersect the ball, and a few more."""
+    # Rounding must not cut off the target that defined the radius
+    radius = radius * (1.0 + 1e-7) + 1e-9
+    # Along each axis the ball reaches into the grid only as far as its distance to the grid on the other axes allows
+    outside = np.maximum(np.maximum(self.lowerBound - point, point - (self.lowerBound + self.gridSize * self.cellSize)), 0)
+    outsideSquared = outside * outside
+    halfWidths = np.sqrt(np.maximum(radius * radius - (np.sum(outsideSquared) - outsideSquared), 0))
+    lower = self._cellCoordinates(point - halfWidths)
+    upper = self._cellCoordinates(point + halfWidths)
+    ys, zs = np.meshgrid(np.arange(lower[1], upper[1] + 1), np.arange(lower[2], upper[2] + 1), indexing='ij')
+    ys = ys.ravel()
+    zs = zs.ravel()
+    # Each row of cells along x is cut to what its y,z distance from the point leaves of the radius
+    rowLower = self.lowerBound[1:3] + np.stack((ys, zs), axis=1) * self.cellSize
+    offsets = np.maximum(np.maximum(rowLower - point[1:3], point[1:3] - rowLower - self.cellSize), 0)
+    remaining = radius * radius - np.sum(offsets * offsets, axis=1)
+    reach = np.sqrt(np.maximum(remaining, 0))
+    firstCells = np.maximum(np.floor((point[0] - reach - self.lowerBound[0]) / self.cellSize).astype(int), lower[0])
+    lastCells = np.minimum(np.floor((point[0] + reach - self.lowerBound[0]) / self.cellSize).astype(int), upper[0])
+    inBall = (remaining >= 0) & (lastCells >= firstCells)
+    rowStartKeys = firstCells[inBall] + self.gridSize[0] * (ys[inBall] + self.gridSize[1] * zs[inBall])
+    return self._pointsInRows(rowStartKeys, (lastCells - firstCells)[inBall])
+
+  def _pointsInRows(self, rowStartKeys, lengths):
+    """Indices into sortedPoints of the targets in the rows of cells rowStartKeys..rowStartKeys + lengths."""
+    # Cells along x are consecutive keys, so each row of cells is one slice
+    starts = np.searchsorted(self.sortedKeys, rowStartKeys, side='left')
+    ends = np.searchsorted(self.sortedKeys, rowStartKeys + lengths, side='right')
+    counts = ends - starts
+    total = int(counts.sum())
+    # Concatenation of the ranges starts[i]..ends[i] without a Python loop
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return offsets + np.arange(total)
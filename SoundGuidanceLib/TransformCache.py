@@ -0,0 +1,137 @@
+import numpy as np
+import slicer
+import vtk
+
+from .NodeArrays import arrayFromMatrix
+
+
+class TransformChainCache(object):
+  """World position of a tool tip from the tracker pose and a cached static chain.
+
+  The transforms from the tip node up to the tracked (dynamic) node, such as the
+  pivot calibration PointerTipToPointer, do not change during a session. They
+  are multiplied once into a single matrix, so each frame only reads the
+  tracker pose and multiplies it with the cached tip point. Edits of any static
+  node (recalibration or reparenting) invalidate the cache through observers.
+  """
+
+  def __init__(self, tipNode, dynamicNode=None):
+    self.tipNode = tipNode
+    # Without an explicit dynamic node the tip node's parent is the tracked pose
+    self.requestedDynamicNode = dynamicNode
+    self.dynamicNode = None
+    self.staticNodes = []
+    self.staticMatrix = vtk.vtkMatrix4x4()
+    self.staticTipPoint = None
+    self.dynamicMatrix = vtk.vtkMatrix4x4()
+    self.observations = []
+
+  def invalidate(self, caller=None, event=None):
+    self.staticTipPoint = None
+
+  def isValid(self):
+    return self.staticTipPoint is not None
+
+  def update(self):
+    """Find the static part of the chain, multiply it and observe its nodes."""
+    self.removeObservers()
+    self.dynamicNode = self.requestedDynamicNode or self.tipNode.GetParentTransformNode()
+    self.staticNodes = []
+    node = self.tipNode
+    while node and node != self.dynamicNode:
+      self.staticNodes.append(node)
+      node = node.GetParentTransformNode()
+
+    self.staticMatrix.Identity()
+    nodeMatrix = vtk.vtkMatrix4x4()
+    for node in self.staticNodes:
+      node.GetMatrixTransformToParent(nodeMatrix)
+      vtk.vtkMatrix4x4.Multiply4x4(nodeMatrix, self.staticMatrix, self.staticMatrix)
+      self.observations.append((node, node.AddObserver('ModifiedEvent', self.invalidate)))
+    self.staticTipPoint = [self.staticMatrix.GetElement(i, 3) for i in range(3)] + [1.0]
+
+  def getTipPosition(self):
+    if self.staticTipPoint is None:
+      self.update()
+    if not self.dynamicNode:
+      return self.staticTipPoint[0:3]
+    self._readDynamicMatrix()
+    return self.dynamicMatrix.MultiplyPoint(self.staticTipPoint)[0:3]
+
+  def getTipToWorldMatrix(self, matrix):
+    """Full tip pose (orientation included) written into the vtkMatrix4x4 matrix."""
+    if self.staticTipPoint is None:
+      self.update()
+    if not self.dynamicNode:
+      matrix.DeepCopy(self.staticMatrix)
+      return matrix
+    self._readDynamicMatrix()
+    vtk.vtkMatrix4x4.Multiply4x4(self.dynamicMatrix, self.staticMatrix, matrix)
+    return matrix
+
+  def _readDynamicMatrix(self):
+    if self.dynamicNode.GetParentTransformNode():
+      self.dynamicNode.GetMatrixTransformToWorld(self.dynamicMatrix)
+    else:
+      self.dynamicNode.GetMatrixTransformToParent(self.dynamicMatrix)
+
+  def removeObservers(self):
+    for node, tag in self.observations:
+      node.RemoveObserver(tag)
+    self.observations = []
+
+
+class NodeToWorldCache(object):
+  """World transform of a node and its inverse, read from the scene only after they changed.
+
+  e.g. NodeToWorldCache(boxToReference) gives world to box and box to world as
+  (4,4) arrays. Walking the transform hierarchy for every point conversion of a
+  frame is replaced by one walk per change of the node or one of its parents,
+  which invoke TransformModifiedEvent; with a tracked parent that is once per
+  tracker update. Returned arrays are shared, callers copy them before
+  modifying them.
+  """
+
+  def __init__(self, node):
+    self.node = node
+    self.toWorldMatrix = vtk.vtkMatrix4x4()
+    self.fromWorldMatrix = vtk.vtkMatrix4x4()
+    self.toWorldArray = np.identity(4)
+    self.fromWorldArray = np.identity(4)
+    self.valid = False
+    self.observations = []
+
+  def invalidate(self, caller=None, event=None):
+    self.valid = False
+
+  def update(self):
+    """Read both matrices and observe the node and its current parents."""
+    self.removeObservers()
+    node = self.node
+    while node:
+      self.observations.append((node, node.AddObserver(slicer.vtkMRMLTransformableNode.TransformModifiedEvent, self.invalidate)))
+      node = node.GetParentTransformNode()
+    if self.node:
+      self.node.GetMatrixTransformToWorld(self.toWorldMatrix)
+      self.node.GetMatrixTransformFromWorld(self.fromWorldMatrix)
+    else:
+      self.toWorldMatrix.Identity()
+      self.fromWorldMatrix.Identity()
+    arrayFromMatrix(self.toWorldMatrix, self.toWorldArray)
+    arrayFromMatrix(self.fromWorldMatrix, self.fromWorldArray)
+    self.valid = True
+
+  def getToWorldArray(self):
+    if not self.valid:
+      self.update()
+    return self.toWorldArray
+
+  def getFromWorldArray(self):
+    if not self.valid:
+      self.update()
+    return self.fromWorldArray
+
+  def removeObservers(self):
+    for node, tag in self.observations:
+      node.RemoveObserver(tag)
+    self.observations = []
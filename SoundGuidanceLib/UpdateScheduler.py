@@ -0,0 +1,129 @@
+import time
+
+import numpy as np
+
+monotonicClock = getattr(time, 'perf_counter', time.time)
+
+
+class ScheduledConsumer(object):
+  """State of one consumer registered in an UpdateScheduler."""
+
+  def __init__(self, name, callback, rateHz, epsilon):
+    self.name = name
+    self.callback = callback
+    self.setRate(rateHz)
+    self.epsilon = epsilon
+    self.reset()
+
+  def setRate(self, rateHz):
+    # A rate of 0 (or None) means the consumer runs on every event
+    self.rateHz = rateHz
+    self.period = 1.0 / rateHz if rateHz else 0.0
+
+  def reset(self):
+    self.lastRunTime = None
+    self.lastPose = None
+    self.pendingPose = None
+    self.flushScheduled = False
+    self.events = 0
+    self.runs = 0
+    self.coalesced = 0
+    self.skipped = 0
+
+  def forgetLastPose(self):
+    self.lastPose = None
+
+
+class UpdateScheduler(object):
+  """Distributes tracker poses to consumers, each at its own maximum rate.
+
+  Poses arriving faster than a consumer's rate are coalesced: only the latest
+  one is kept and delivered when the consumer is due again. Poses that moved by
+  no more than the consumer's epsilon since the last delivered pose are skipped.
+
+  deferCall(delaySeconds, function) is used to deliver a coalesced pose when no
+  further event arrives; in Slicer this is a single shot QTimer. Without it the
+  pending pose is delivered on the next event.
+  """
+
+  def __init__(self, deferCall=None, clock=monotonicClock):
+    self.deferCall = deferCall
+    self.clock = clock
+    self.consumers = []
+
+  def addConsumer(self, name, callback, rateHz=0, epsilon=0.0):
+    self.removeConsumer(name)
+    consumer = ScheduledConsumer(name, callback, rateHz, epsilon)
+    self.consumers.append(consumer)
+    return consumer
+
+  def removeConsumer(self, name):
+    self.consumers = [consumer for consumer in self.consumers if consumer.name != name]
+
+  def getConsumer(self, name):
+    for consumer in self.consumers:
+      if consumer.name == name:
+        return consumer
+    return None
+
+  def setEpsilon(self, epsilon):
+    for consumer in self.consumers:
+      consumer.epsilon = epsilon
+
+  def reset(self):
+    """Forget the last delivered poses, e.g. after the target has changed."""
+    for consumer in self.consumers:
+      consumer.reset()
+
+  def forgetLastPoses(self):
+    """Deliver the next pose even if it did not move, e.g. after the target or the entry plane changed.
+
+    The values sent for a pose depend on the mapping, so a still tip would
+    otherwise keep the values of the old mapping. Statistics are kept.
+    """
+    for consumer in self.consumers:
+      consumer.forgetLastPose()
+
+  def update(self, pose):
+    now = self.clock()
+    pose = np.asarray(pose, dtype=float)
+    for consumer in self.consumers:
+      consumer.events += 1
+      if consumer.pendingPose is not None:
+        consumer.coalesced += 1
+      consumer.pendingPose = pose
+      waitTime = self._waitTime(consumer, now)
+      if waitTime <= 0.0:
+        self._run(consumer, now)
+      elif self.deferCall and not consumer.flushScheduled:
+        consumer.flushScheduled = True
+        self.deferCall(waitTime, lambda consumer=consumer: self._flush(consumer))
+
+  def getStatistics(self):
+    return dict((consumer.name, {
+      'events': consumer.events,
+      'runs': consumer.runs,
+      'coalesced': consumer.coalesced,
+      'skipped': consumer.skipped,
+      }) for consumer in self.consumers)
+
+  def _waitTime(self, consumer, now):
+    if consumer.lastRunTime is None:
+      return 0.0
+    return consumer.lastRunTime + consumer.period - now
+
+  def _flush(self, consumer):
+    consumer.flushScheduled = False
+    if consumer.pendingPose is not None:
+      self._run(consumer, self.clock())
+
+  def _run(self, consumer, now):
+    pose = consumer.pendingPose
+    consumer.pendingPose = None
+    if consumer.lastPose is not None and np.max(np.abs(pose - consumer.lastPose)) <= consumer.epsilon:
+      consumer.skipped += 1
+      return
+    consumer.lastRunTime = now
+    consumer.lastPose = pose
+    consumer.runs += 1
+    consumer.callback(pose)
@@ -0,0 +1,6 @@
+"""Helper classes used by the SoundGuidance scripted module.
+
+Modules in this package that do not need Slicer (transport, encoding, geometry)
+import only the standard library and NumPy so they can also be used from a
+plain Python process.
+"""
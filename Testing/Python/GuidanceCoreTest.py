@@ -0,0 +1,88 @@
+"""Headless tests of the guidance geometry, run with python -m unittest or ctest."""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from SoundGuidanceLib.GuidanceCore import (GuidanceCore, distanceToTarget, entryPlaneBasis, normalizeDistance,
+  planeQuadCorners, trajectoryMetrics)
+
+
+class GuidanceCoreTest(unittest.TestCase):
+
+  def setUp(self):
+    # Entry plane through the surface point, z towards the target, x along world y
+    self.core = GuidanceCore()
+    self.core.setFiducials([1.0, 2.0, 53.0], [1.0, 2.0, 3.0], [1.0, 12.0, 3.0])
+
+  def test_entryPlaneCoordinates(self):
+    np.testing.assert_allclose(self.core.entryPlaneCoordinates([1.0, 2.0, 3.0]), [0.0, 0.0, 0.0], atol=1e-12)
+    # y = z cross x is world -x
+    np.testing.assert_allclose(self.core.entryPlaneCoordinates([5.0, 9.0, 12.0]), [7.0, -4.0, 9.0], atol=1e-12)
+    np.testing.assert_allclose(self.core.entryPlaneCoordinates([[1.0, 2.0, 53.0], [0.0, 2.0, 3.0]]),
+      [[0.0, 0.0, 50.0], [0.0, 1.0, 0.0]], atol=1e-12)
+
+  def test_distanceMapping(self):
+    self.assertAlmostEqual(float(distanceToTarget([4.0, 6.0, 53.0], [1.0, 2.0, 53.0])), 5.0)
+    np.testing.assert_allclose(self.core.distance([[4.0, 6.0, 53.0], [1.0, 2.0, 53.0]]), [5.0, 0.0])
+    np.testing.assert_allclose(normalizeDistance([0.0, 50.0, 200.0, 400.0]), [0.0, 0.25, 1.0, 2.0])
+    np.testing.assert_allclose(normalizeDistance(30.0, maxDistance=60.0), 0.5)
+    result = self.core.evaluatePositions([4.0, 6.0, 53.0])
+    self.assertAlmostEqual(float(result.distance), 5.0)
+    self.assertAlmostEqual(float(result.normalizedDistance), 0.025)
+    np.testing.assert_allclose(result.entryPlaneCoordinates, [4.0, -3.0, 50.0], atol=1e-12)
+
+  def test_evaluatePoses(self):
+    poses = np.tile(np.identity(4), (2, 1, 1))
+    poses[:, 0:3, 3] = [[4.0, 6.0, 53.0], [1.0, 2.0, 3.0]]
+    result = self.core.evaluate(poses)
+    np.testing.assert_allclose(result.distance, [5.0, 50.0])
+    np.testing.assert_allclose(result.normalizedDistance, [0.025, 0.25])
+
+  def test_trajectoryMetrics(self):
+    basis = entryPlaneBasis([0.0, 0.0, 0.0], [0.0, 0.0, 100.0], [10.0, 0.0, 0.0])
+    alongZ = np.identity(4)
+    alongZ[0:3, 3] = [3.0, 0.0, 40.0]
+    # Needle rotated 90 degrees about y points along world x, parallel to the plane
+    alongX = np.identity(4)
+    alongX[0:3, 0:3] = [[0.0, 0.0, 1.0], [0.0, 1.0, 0.0], [-1.0, 0.0, 0.0]]
+    alongX[0:3, 3] = [0.0, 0.0, 50.0]
+    metrics = trajectoryMetrics(np.array([alongZ, alongX]), [0.0, 0.0, 100.0], basis)
+    np.testing.assert_allclose(metrics.axisDistance, [3.0, 50.0], atol=1e-12)
+    np.testing.assert_allclose(metrics.angle, [0.0, 90.0], atol=1e-6)
+    np.testing.assert_allclose(metrics.depth, [60.0, 0.0], atol=1e-12)
+    self.assertAlmostEqual(float(metrics.entryX[0]), 3.0)
+    self.assertAlmostEqual(float(metrics.entryY[0]), 0.0)
+    self.assertTrue(np.isnan(metrics.entryX[1]) and np.isnan(metrics.entryY[1]))
+
+    single = trajectoryMetrics(alongZ, [0.0, 0.0, 100.0], basis)
+    self.assertAlmostEqual(float(single.depth), 60.0)
+
+  def test_planeQuadCorners(self):
+    origin, point1, point2 = planeQuadCorners([0.0, 0.0, 0.0], [0.0, 0.0, 2.0], 10.0, inPlaneDirection=[1.0, 0.0, 1.0])
+    np.testing.assert_allclose(origin, [-5.0, -5.0, 0.0], atol=1e-12)
+    np.testing.assert_allclose(point1, [5.0, -5.0, 0.0], atol=1e-12)
+    np.testing.assert_allclose(point2, [-5.0, 5.0, 0.0], atol=1e-12)
+
+  def test_planeQuadCornersWithoutDirection(self):
+    center = np.array([1.0, 2.0, 3.0])
+    normal = np.array([1.0, 1.0, 1.0]) / np.sqrt(3.0)
+    # A direction along the normal is ignored like no direction at all
+    for direction in (None, [2.0, 2.0, 2.0]):
+      origin, point1, point2 = planeQuadCorners(center, normal, 4.0, inPlaneDirection=direction)
+      uEdge = point1 - origin
+      vEdge = point2 - origin
+      self.assertAlmostEqual(np.linalg.norm(uEdge), 4.0)
+      self.assertAlmostEqual(np.linalg.norm(vEdge), 4.0)
+      self.assertAlmostEqual(np.dot(uEdge, vEdge), 0.0)
+      self.assertAlmostEqual(np.dot(uEdge, normal), 0.0)
+      self.assertAlmostEqual(np.dot(vEdge, normal), 0.0)
+      np.testing.assert_allclose(origin + 0.5 * (uEdge + vEdge), center, atol=1e-12)
+
+
+if __name__ == '__main__':
+  unittest.main()
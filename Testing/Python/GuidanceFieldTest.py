@@ -0,0 +1,151 @@
+"""Headless tests of the precomputed guidance field, run with python -m unittest or ctest."""
+
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from SoundGuidanceLib import GuidanceField
+from SoundGuidanceLib.GuidanceCore import GuidanceCore
+from SoundGuidanceLib.SurfaceDistance import SurfaceLocator
+
+# Cube [-5,5]^3, outward oriented
+CUBE_VERTICES = 5.0 * np.array([(x, y, z) for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)], dtype=float)
+CUBE_TRIANGLES = np.array([
+  (0, 1, 3), (0, 3, 2), (4, 6, 7), (4, 7, 5),  # x = -5, x = 5
+  (0, 4, 5), (0, 5, 1), (2, 3, 7), (2, 7, 6),  # y = -5, y = 5
+  (0, 2, 6), (0, 6, 4), (1, 5, 7), (1, 7, 3),  # z = -5, z = 5
+  ])
+
+FIDUCIALS = np.array([[1.0, 2.0, -3.0], [0.0, 0.0, 12.0], [8.0, 0.0, 12.0]])
+SURFACE_MAX_DISTANCE = 6.0
+
+
+class GuidanceFieldTest(unittest.TestCase):
+
+  def setUp(self):
+    self.cacheDirectory = tempfile.mkdtemp()
+    self.geometry = GuidanceField.fieldGeometry([-5.0, -5.0, -5.0], [5.0, 5.0, 5.0], spacing=2.0, margin=8.0)
+    self.random = np.random.RandomState(5)
+
+  def tearDown(self):
+    shutil.rmtree(self.cacheDirectory)
+
+  def buildField(self):
+    return GuidanceField.buildGuidanceField(self.geometry, FIDUCIALS, self.cacheDirectory, CUBE_VERTICES,
+      CUBE_TRIANGLES, SURFACE_MAX_DISTANCE, dtype=np.float32, processes=1)
+
+  def directValues(self, points):
+    """Channel values computed at the points without the grid."""
+    core = GuidanceCore()
+    core.setFiducials(*FIDUCIALS)
+    planePoints = core.entryPlaneCoordinates(points)
+    surfaceDistances = SurfaceLocator(CUBE_VERTICES, CUBE_TRIANGLES).signedDistances(points, SURFACE_MAX_DISTANCE)
+    return np.stack((core.distance(points), planePoints[:, 2], np.hypot(planePoints[:, 0], planePoints[:, 1]),
+      surfaceDistances), axis=1)
+
+  def test_lookupAtVoxelsMatchesDirectSampling(self):
+    field = self.buildField()
+    points = GuidanceField.gridPoints(self.geometry)[::7]
+    expected = self.directValues(points)
+    np.testing.assert_allclose(field.lookup(points), expected, atol=1e-4)
+    for point, values in zip(points[::13], expected[::13]):
+      np.testing.assert_allclose(field.lookup(point), values, atol=1e-4)
+
+  def test_singleAndBatchLookupsAgree(self):
+    field = self.buildField()
+    lower = self.geometry.origin
+    upper = lower + (np.array(self.geometry.shape) - 1) * self.geometry.spacing
+    points = self.random.uniform(lower, upper, size=(200, 3))
+    self.assertTrue(np.all(field.contains(points)))
+    batch = field.lookup(points)
+    single = np.array([field.lookup(point) for point in points])
+    np.testing.assert_allclose(single, batch, atol=1e-9)
+    direct = self.directValues(points)
+    # Depth is linear in the position, so trilinear interpolation reproduces it
+    np.testing.assert_allclose(batch[:, 1], direct[:, 1], atol=1e-4)
+    # The other channels only change by less than the voxel diagonal between voxels
+    np.testing.assert_array_less(np.abs(batch - direct), np.sqrt(3.0) * self.geometry.spacing)
+    self.assertEqual(set(field.lookupDict(points[0])), set(GuidanceField.FIELD_CHANNELS))
+
+  def test_pointsOutsideGetTheNearestFace(self):
+    field = self.buildField()
+    outside = self.geometry.origin - [10.0, 0.0, 0.0]
+    self.assertFalse(field.contains(outside))
+    np.testing.assert_allclose(field.lookup(outside), field.lookup(self.geometry.origin), atol=1e-9)
+
+  def test_olderCacheVersionIsRebuilt(self):
+    version = GuidanceField.CACHE_VERSION
+    GuidanceField.CACHE_VERSION = 1
+    try:
+      oldSurfaceKey = GuidanceField.surfaceKey(self.geometry, CUBE_VERTICES, CUBE_TRIANGLES, SURFACE_MAX_DISTANCE)
+      oldFieldKey = GuidanceField.fieldKey(self.geometry, FIDUCIALS, CUBE_VERTICES, CUBE_TRIANGLES,
+        SURFACE_MAX_DISTANCE, np.float32)
+    finally:
+      GuidanceField.CACHE_VERSION = version
+    # Cache files of version 1 for the same grid, mesh and fiducials, with values a rebuild never gives
+    np.save(os.path.join(self.cacheDirectory, 'GuidanceSurface-%s.npy' % oldSurfaceKey),
+      np.full(self.geometry.shape, 1234.0, dtype=np.float32))
+    np.save(os.path.join(self.cacheDirectory, 'GuidanceField-%s.npy' % oldFieldKey),
+      np.full(tuple(self.geometry.shape) + (len(GuidanceField.FIELD_CHANNELS),), 1234.0, dtype=np.float32))
+
+    field = self.buildField()
+    self.assertNotEqual(field.key, oldFieldKey)
+    self.assertLess(np.max(np.abs(field.values)), 1234.0)
+    points = GuidanceField.gridPoints(self.geometry)[::11]
+    np.testing.assert_allclose(field.lookup(points), self.directValues(points), atol=1e-4)
+
+  def test_cachedFieldIsLoaded(self):
+    field = self.buildField()
+    fieldFiles = sorted(os.listdir(self.cacheDirectory))
+    self.assertEqual(len(fieldFiles), 2)
+    loaded = self.buildField()
+    self.assertEqual(loaded.key, field.key)
+    self.assertEqual(sorted(os.listdir(self.cacheDirectory)), fieldFiles)
+    np.testing.assert_array_equal(loaded.values, field.values)
+
+
+class WorkerExecutableTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def makeExecutable(self, *parts):
+    path = os.path.join(self.directory, *parts)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as executableFile:
+      executableFile.write('')
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    return path
+
+  def test_pythonInterpreterIsUsedAsIs(self):
+    python = self.makeExecutable('bin', 'python3')
+    self.assertEqual(GuidanceField.workerExecutable(python), python)
+
+  def test_pythonSlicerNextToTheApplication(self):
+    application = self.makeExecutable('bin', 'SlicerApp-real')
+    pythonSlicer = self.makeExecutable('bin', 'PythonSlicer')
+    self.assertEqual(GuidanceField.workerExecutable(application), os.path.normpath(pythonSlicer))
+
+  def test_pythonSlicerInTheMacOSBundle(self):
+    application = self.makeExecutable('Slicer.app', 'Contents', 'MacOS', 'Slicer')
+    pythonSlicer = self.makeExecutable('Slicer.app', 'Contents', 'bin', 'PythonSlicer')
+    self.assertEqual(GuidanceField.workerExecutable(application), os.path.normpath(pythonSlicer))
+
+  def test_noPythonSlicer(self):
+    application = self.makeExecutable('bin', 'SlicerApp-real')
+    self.assertIsNone(GuidanceField.workerExecutable(application))
+
+
+if __name__ == '__main__':
+  unittest.main()
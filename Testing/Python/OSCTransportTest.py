@@ -0,0 +1,52 @@
+"""Headless tests of the OSC transport worker, run with python -m unittest or ctest."""
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from SoundGuidanceLib.Benchmark import LoopbackOSCSink
+from SoundGuidanceLib.OSCTransport import OSCTransport
+
+
+class OSCTransportTest(unittest.TestCase):
+
+  def setUp(self):
+    self.sink = LoopbackOSCSink()
+    self.sink.start()
+    self.transport = OSCTransport('127.0.0.1', self.sink.port)
+    self.transport.start()
+
+  def tearDown(self):
+    self.transport.stop()
+    self.sink.stop()
+
+  def waitForMessages(self, count, timeout=2.0):
+    deadline = time.time() + timeout
+    while len(self.sink.receivedMessages()) < count and time.time() < deadline:
+      time.sleep(0.01)
+    return self.sink.receivedMessages()
+
+  def test_frameThatCannotBeEncodedIsSkipped(self):
+    # 2**40 overflows the 32 bit 'i' argument
+    self.transport.sendMessage('/dumpOSC/bad', [2 ** 40])
+    time.sleep(0.1)
+    self.transport.sendMessage('/dumpOSC/0/0', [0.5])
+    messages = self.waitForMessages(1)
+    self.assertEqual([(address, values) for receiveTime, address, values in messages], [('/dumpOSC/0/0', [0.5])])
+    self.assertTrue(self.transport.worker.is_alive())
+    counters = self.transport.getCounters()
+    self.assertEqual(counters['errors'], 1)
+    self.assertEqual(counters['sent'], 1)
+
+  def test_latestFrameOfEachAddressIsSent(self):
+    self.transport.sendMessage('/dumpOSC/0/0', [0.25])
+    self.transport.sendMessage('/dumpOSC/target', [1, 2.0])
+    messages = self.waitForMessages(2)
+    self.assertEqual(sorted(address for receiveTime, address, values in messages), ['/dumpOSC/0/0', '/dumpOSC/target'])
+
+
+if __name__ == '__main__':
+  unittest.main()
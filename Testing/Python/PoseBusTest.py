@@ -0,0 +1,62 @@
+"""Headless tests of the shared memory pose bus, run with python -m unittest or ctest."""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from SoundGuidanceLib.PoseBus import PoseBusReader, PoseBusWriter
+
+
+class PoseBusTest(unittest.TestCase):
+
+  def setUp(self):
+    self.writer = PoseBusWriter('SoundGuidancePoseBusTest%d' % os.getpid(), capacity=8)
+    self.reader = PoseBusReader(self.writer.name)
+
+  def tearDown(self):
+    self.reader.close()
+    self.writer.close()
+
+  def publish(self, count):
+    for frame in range(count):
+      self.writer.publish(float(frame), [frame, 0.0, 0.0], [0.0, 0.0, 100.0], 100.0 - frame, (100.0 - frame) / 200.0)
+
+  def test_latest(self):
+    self.assertIsNone(self.reader.latest())
+    self.publish(3)
+    frame = self.reader.latest()
+    self.assertEqual(frame['sequence'], 3)
+    np.testing.assert_array_equal(frame['tip'], [2.0, 0.0, 0.0])
+    self.assertEqual(frame['distance'], 98.0)
+
+  def test_readNew(self):
+    self.publish(3)
+    frames = self.reader.readNew()
+    self.assertEqual(list(frames['sequence']), [1, 2, 3])
+    self.assertEqual(list(frames['timestamp']), [0.0, 1.0, 2.0])
+    self.assertEqual(len(self.reader.readNew()), 0)
+    self.publish(2)
+    self.assertEqual(list(self.reader.readNew()['sequence']), [4, 5])
+    self.assertEqual(self.reader.missedFrames, 0)
+
+  def test_readerBehindByMoreThanTheRing(self):
+    self.publish(20)
+    frames = self.reader.readNew()
+    self.assertEqual(list(frames['sequence']), list(range(13, 21)))
+    self.assertEqual(self.reader.missedFrames, 12)
+
+  def test_frameBeingWrittenIsNotReturned(self):
+    self.publish(3)
+    # The writer is in the middle of overwriting frame 2 with frame 10
+    self.writer.frameSequences[2] = 2 * 10 - 1
+    frames = self.reader.readNew()
+    self.assertEqual(list(frames['sequence']), [1, 3])
+    self.assertEqual(self.reader.missedFrames, 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,61 @@
+"""Headless tests of the session log, run with python -m unittest or ctest."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from SoundGuidanceLib.SessionLog import RECORD_DTYPE, SessionReader, SessionRecorder
+
+
+class SessionLogTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'session.sglog')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def record(self, count):
+    recorder = SessionRecorder(self.path, ['PointerToTracker', 'ReferenceToTracker'], {'target': [1.0, 2.0, 3.0]},
+      blockSize=4)
+    for index in range(count):
+      matrix = np.identity(4)
+      matrix[0, 3] = index
+      recorder.recordMatrix(index % 2, matrix, timestamp=0.5 * index)
+    recorder.close()
+
+  def test_recordedSessionIsRead(self):
+    self.record(10)
+    reader = SessionReader(self.path)
+    self.assertEqual(len(reader), 10)
+    self.assertEqual(reader.nodeNames, ['PointerToTracker', 'ReferenceToTracker'])
+    self.assertEqual(reader.metadata['target'], [1.0, 2.0, 3.0])
+    self.assertAlmostEqual(reader.duration(), 4.5)
+    np.testing.assert_array_equal(reader.nodeRecords('ReferenceToTracker')['matrix'][:, 0, 3], [1, 3, 5, 7, 9])
+
+  def test_emptySession(self):
+    self.record(0)
+    reader = SessionReader(self.path)
+    self.assertEqual(len(reader), 0)
+    self.assertEqual(reader.duration(), 0.0)
+
+  def test_trailingPartialRecordIsDropped(self):
+    self.record(5)
+    with open(self.path, 'ab') as logFile:
+      logFile.write(b'\0' * (RECORD_DTYPE.itemsize // 2))
+    with self.assertLogs(level='WARNING') as logs:
+      reader = SessionReader(self.path)
+    self.assertIn('partial record', logs.output[0])
+    self.assertEqual(len(reader), 5)
+    self.assertEqual(reader.records[-1]['timestamp'], 2.0)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,126 @@
+"""Headless tests of the surface distance locator, run with python -m unittest or ctest."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from SoundGuidanceLib.SurfaceDistance import SurfaceLocator, closestPointsOnTriangles, loadOrBuildLocator
+
+
+def cubeMesh(divisions):
+  """Closed, outward oriented triangle mesh of the cube [-1,1]^3 with divisions x divisions quads per face."""
+  steps = np.linspace(-1.0, 1.0, divisions + 1)
+  points = []
+  triangles = []
+  for axis in range(3):
+    for side in (-1.0, 1.0):
+      # u x v is the outward normal of the face
+      uAxis, vAxis = (axis + 1) % 3, (axis + 2) % 3
+      if side < 0:
+        uAxis, vAxis = vAxis, uAxis
+      start = len(points)
+      for v in steps:
+        for u in steps:
+          point = np.zeros(3)
+          point[axis] = side
+          point[uAxis] = u
+          point[vAxis] = v
+          points.append(point)
+      for row in range(divisions):
+        for column in range(divisions):
+          corner = start + row * (divisions + 1) + column
+          triangles.append((corner, corner + 1, corner + divisions + 2))
+          triangles.append((corner, corner + divisions + 2, corner + divisions + 1))
+  # Faces share their border vertices, the edge and vertex pseudo-normals need a connected mesh
+  vertices, inverse = np.unique(np.round(points, 9), axis=0, return_inverse=True)
+  return vertices, inverse.ravel()[np.array(triangles)]
+
+
+def cubeSignedDistances(points):
+  """Exact signed distance to the cube [-1,1]^3, negative inside."""
+  offsets = np.abs(points) - 1.0
+  outside = np.sqrt(np.sum(np.maximum(offsets, 0.0) ** 2, axis=1))
+  inside = np.minimum(np.max(offsets, axis=1), 0.0)
+  return outside + inside
+
+
+def bruteForceDistances(vertices, triangles, points):
+  corners = vertices[triangles]
+  distances = []
+  for point in points:
+    closestPoints = closestPointsOnTriangles(point, corners[:, 0], corners[:, 1], corners[:, 2])
+    distances.append(np.sqrt(np.min(np.sum((closestPoints - point) ** 2, axis=1))))
+  return np.array(distances)
+
+
+class SurfaceDistanceTest(unittest.TestCase):
+
+  def setUp(self):
+    self.random = np.random.RandomState(3)
+    self.vertices, self.triangles = cubeMesh(6)
+    self.locator = SurfaceLocator(self.vertices, self.triangles)
+
+  def assertClosestPointsMatch(self, points, expected):
+    for point, expectedDistance in zip(points, expected):
+      closestPoint, signedDistance, triangle = self.locator.closestPoint(point)
+      self.assertAlmostEqual(signedDistance, expectedDistance, places=9, msg=str(point))
+      self.assertAlmostEqual(np.linalg.norm(closestPoint - point), abs(expectedDistance), places=9, msg=str(point))
+      self.assertGreaterEqual(triangle, 0)
+    np.testing.assert_allclose(self.locator.signedDistances(points), expected, atol=1e-9)
+
+  def test_cubeRandomPoints(self):
+    points = self.random.uniform(-2.5, 2.5, size=(300, 3))
+    self.assertClosestPointsMatch(points, cubeSignedDistances(points))
+
+  def test_cubeEdgeAndVertexNearest(self):
+    points = np.array([
+      [2.0, 2.0, 0.0],     # outside, nearest to an edge
+      [1.5, 0.3, -1.5],    # outside, nearest to an edge between mesh vertices
+      [2.0, 2.0, 2.0],     # outside, nearest to a corner
+      [-1.1, 1.2, -1.3],   # outside, nearest to another corner
+      [0.9, 0.9, 0.0],     # inside, equally near two faces at an edge
+      [0.95, 0.95, 0.95],  # inside, near a corner
+      [1.0 / 3.0 + 2.0, 1.0 / 3.0, 0.0],  # outside, nearest to a mesh vertex on a face
+      ])
+    self.assertClosestPointsMatch(points, cubeSignedDistances(points))
+
+  def test_sphereAgainstBruteForce(self):
+    vertices, triangles = cubeMesh(8)
+    vertices = vertices / np.linalg.norm(vertices, axis=1)[:, np.newaxis]
+    locator = SurfaceLocator(vertices, triangles)
+    directions = self.random.normal(size=(200, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+    # Radii away from the surface, where the sign is known without the mesh
+    radii = np.concatenate((self.random.uniform(0.2, 0.9, 100), self.random.uniform(1.1, 3.0, 100)))
+    points = directions * radii[:, np.newaxis]
+    expected = bruteForceDistances(vertices, triangles, points) * np.where(radii < 1.0, -1.0, 1.0)
+    closest = np.array([locator.closestPoint(point)[1] for point in points])
+    np.testing.assert_allclose(closest, expected, atol=1e-9)
+    np.testing.assert_allclose(locator.signedDistances(points), expected, atol=1e-9)
+
+  def test_maxDistance(self):
+    self.assertEqual(self.locator.closestPoint([10.0, 0.0, 0.0], maxDistance=5.0), (None, 5.0, -1))
+    distances = self.locator.signedDistances(np.array([[10.0, 0.0, 0.0], [1.5, 0.0, 0.0]]), maxDistance=5.0)
+    np.testing.assert_allclose(distances, [5.0, 0.5])
+
+  def test_cachedLocatorMatchesBuiltOne(self):
+    cacheDirectory = tempfile.mkdtemp()
+    try:
+      built = loadOrBuildLocator(self.vertices, self.triangles, cacheDirectory)
+      self.assertEqual(len(os.listdir(cacheDirectory)), 1)
+      loaded = loadOrBuildLocator(self.vertices, self.triangles, cacheDirectory)
+      points = self.random.uniform(-2.0, 2.0, size=(50, 3))
+      for point in points:
+        self.assertAlmostEqual(loaded.closestPoint(point)[1], built.closestPoint(point)[1], places=12)
+    finally:
+      shutil.rmtree(cacheDirectory)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,82 @@
+"""Headless tests of the nearest target index, run with python -m unittest or ctest."""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from SoundGuidanceLib.TargetIndex import BRUTE_FORCE_LIMIT, TargetIndex
+
+
+class TargetIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    self.random = np.random.RandomState(7)
+
+  def assertNearestMatchesBruteForce(self, index, queries):
+    for query in queries:
+      distances = np.sqrt(np.sum((index.points - query) ** 2, axis=1))
+      nearestIndex, nearestDistance = index.nearest(query)
+      # Ties may pick another target at the same distance
+      self.assertAlmostEqual(nearestDistance, distances.min(), places=9, msg=str(query))
+      self.assertAlmostEqual(distances[nearestIndex], distances.min(), places=9, msg=str(query))
+
+  def clusteredPoints(self):
+    """Two dense clusters far apart, so most cells of the grid between them are empty."""
+    count = 2 * BRUTE_FORCE_LIMIT
+    points = self.random.normal(scale=5.0, size=(count, 3))
+    points[count // 2:] += [200.0, 150.0, -100.0]
+    return points
+
+  def test_gridIsUsed(self):
+    index = TargetIndex(self.clusteredPoints())
+    self.assertIsNotNone(index.cellSize)
+    self.assertEqual(len(index), 2 * BRUTE_FORCE_LIMIT)
+
+  def test_randomQueries(self):
+    index = TargetIndex(self.clusteredPoints())
+    queries = self.random.uniform(-30.0, 230.0, size=(200, 3))
+    self.assertNearestMatchesBruteForce(index, queries)
+
+  def test_emptyCells(self):
+    index = TargetIndex(self.clusteredPoints())
+    # Midway between the clusters every cell around the query is empty
+    queries = np.linspace([0.0, 0.0, 0.0], [200.0, 150.0, -100.0], 21)
+    self.assertNearestMatchesBruteForce(index, queries)
+
+  def test_cellBoundaries(self):
+    # Targets on a regular lattice, queried exactly on cell faces, edges and corners
+    axis = np.arange(20.0)
+    points = np.stack(np.meshgrid(axis, axis, axis, indexing='ij'), axis=-1).reshape(-1, 3)
+    index = TargetIndex(points)
+    self.assertIsNotNone(index.cellSize)
+    cells = self.random.randint(0, index.gridSize.min() + 1, size=(100, 3))
+    queries = index.lowerBound + cells * index.cellSize
+    queries[0:50, 0] += 0.25 * index.cellSize
+    self.assertNearestMatchesBruteForce(index, np.concatenate((queries, points[::97] + 0.5)))
+
+  def test_farOutsideGrid(self):
+    index = TargetIndex(self.clusteredPoints())
+    queries = [[1e5, 0.0, 0.0], [-1e5, -1e5, 1e5], [100.0, 75.0, 1e4], [0.0, -5e3, 0.0]]
+    self.assertNearestMatchesBruteForce(index, queries)
+
+  def test_planarTargets(self):
+    points = self.random.uniform(0.0, 100.0, size=(BRUTE_FORCE_LIMIT + 500, 3))
+    points[:, 2] = 10.0
+    index = TargetIndex(points)
+    queries = self.random.uniform(-20.0, 120.0, size=(100, 3))
+    self.assertNearestMatchesBruteForce(index, queries)
+
+  def test_smallAndEmptyIndex(self):
+    self.assertEqual(TargetIndex().nearest([0.0, 0.0, 0.0]), (-1, float('inf')))
+    points = self.random.uniform(0.0, 10.0, size=(50, 3))
+    index = TargetIndex(points)
+    self.assertIsNone(index.cellSize)
+    self.assertNearestMatchesBruteForce(index, self.random.uniform(-5.0, 15.0, size=(20, 3)))
+
+
+if __name__ == '__main__':
+  unittest.main()
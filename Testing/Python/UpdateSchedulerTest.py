@@ -0,0 +1,36 @@
+"""Headless tests of the update scheduler, run with python -m unittest or ctest."""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from SoundGuidanceLib.UpdateScheduler import UpdateScheduler
+
+
+class UpdateSchedulerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.poses = []
+    self.scheduler = UpdateScheduler()
+    self.consumer = self.scheduler.addConsumer('osc', self.poses.append, rateHz=0, epsilon=0.5)
+
+  def test_stillPoseIsSkipped(self):
+    for pose in ([0.0, 0.0, 0.0], [0.2, 0.0, 0.0], [1.0, 0.0, 0.0]):
+      self.scheduler.update(pose)
+    self.assertEqual([list(pose) for pose in self.poses], [[0.0, 0.0, 0.0], [1.0, 0.0, 0.0]])
+    self.assertEqual(self.consumer.skipped, 1)
+
+  def test_stillPoseIsSentAfterTheMappingChanged(self):
+    self.scheduler.update([0.0, 0.0, 0.0])
+    self.scheduler.forgetLastPoses()
+    self.scheduler.update([0.0, 0.0, 0.0])
+    self.assertEqual(len(self.poses), 2)
+    # Unlike reset, the statistics are kept
+    self.assertEqual(self.consumer.runs, 2)
+    self.assertEqual(self.consumer.events, 2)
+
+
+if __name__ == '__main__':
+  unittest.main()